@@ -0,0 +1,308 @@
+import calendar
+import threading
+from collections import OrderedDict
+from datetime import date, timedelta
+
+from db import db, Purchase, Item, assoc_purchases_item, data_version
+
+EPOCH = date(1970, 1, 1)
+# julianday() of 1970-01-01 00:00, turns SQLite dates into days since the epoch
+JULIAN_EPOCH = 2440587.5
+ROLLING_WINDOWS = (7, 30)
+# Days of recent spending the end-of-month forecast extrapolates from
+FORECAST_WINDOW = 30
+
+
+def epoch_day(value):
+    return (value - EPOCH).days
+
+
+class SpendingArrays:
+    """
+    A user's purchases as NumPy columns, ordered by date
+    amount, day (days since 1970-01-01) and type_code (index into types) hold one value per purchase,
+    item_row (index of the purchase) and item_code (index into item_names) one value per purchase item
+    """
+
+    def __init__(self, amount, day, type_code, types, item_row, item_code, item_names):
+        self.amount = amount
+        self.day = day
+        self.type_code = type_code
+        self.types = types
+        self.item_row = item_row
+        self.item_code = item_code
+        self.item_names = item_names
+        # Spending per item name does not depend on the date, it is computed on first use
+        self.item_totals = None
+
+    @property
+    def nbytes(self):
+        return (self.amount.nbytes + self.day.nbytes + self.type_code.nbytes
+                + self.item_row.nbytes + self.item_code.nbytes)
+
+    def span(self, first_day, last_day):
+        """
+        Returns the slice of purchases made from first_day to last_day inclusive
+        """
+        import numpy as np
+
+        start, stop = np.searchsorted(self.day, [first_day, last_day + 1])
+        return slice(int(start), int(stop))
+
+    def daily_totals(self, first_day, last_day):
+        """
+        Returns the total spent on each day from first_day to last_day inclusive
+        """
+        import numpy as np
+
+        rows = self.span(first_day, last_day)
+        return np.bincount(self.day[rows] - first_day, weights=self.amount[rows],
+                           minlength=last_day - first_day + 1)
+
+    def totals_by_type(self, first_day, last_day):
+        """
+        Returns the total spent on each type from first_day to last_day inclusive, indexed by type code
+        """
+        import numpy as np
+
+        rows = self.span(first_day, last_day)
+        return np.bincount(self.type_code[rows], weights=self.amount[rows], minlength=len(self.types))
+
+    def spending_by_item(self):
+        """
+        Returns the total spent on and the number of purchases of each item name, indexed by item code
+        A purchase's amount is shared equally between its items
+        """
+        import numpy as np
+
+        if self.item_totals is None:
+            items_per_purchase = np.bincount(self.item_row, minlength=len(self.amount))
+            share = self.amount[self.item_row] / items_per_purchase[self.item_row]
+            self.item_totals = (np.bincount(self.item_code, weights=share, minlength=len(self.item_names)),
+                                np.bincount(self.item_code, minlength=len(self.item_names)))
+        return self.item_totals
+
+
+def encode(values):
+    """
+    Returns the distinct values, sorted, and the array of each value's index in them
+    """
+    import numpy as np
+
+    distinct, codes = np.unique(np.array(values, dtype=object).astype(str), return_inverse=True)
+    return distinct.tolist(), codes.astype(np.int32)
+
+
+def load_arrays(user_id):
+    """
+    Load a user's purchases and their item names into a SpendingArrays with two queries
+    Dates are converted to days in SQLite, so no datetime or ORM object is built per row
+    """
+    import numpy as np
+
+    # Read through the session's connection, ORM result processing would add half again to large reads
+    # Rows come in table order, which is cheaper for SQLite than date order, and are sorted below
+    connection = db.session.connection()
+    rows = connection.execute(
+        db.select(Purchase.id, Purchase.amount, db.func.julianday(Purchase.date), Purchase.type)
+        .where(Purchase.user_id == user_id)).all()
+    count = len(rows)
+    ids, amounts, days, types = zip(*rows) if rows else ((), (), (), ())
+
+    day = np.floor(np.fromiter(days, dtype=np.float64, count=count) - JULIAN_EPOCH).astype(np.int32)
+    order = np.argsort(day, kind="stable")
+    day = day[order]
+    purchase_id = np.fromiter(ids, dtype=np.int64, count=count)[order]
+    amount = np.fromiter(amounts, dtype=np.float64, count=count)[order]
+    type_names, type_code = encode(types)
+
+    links = connection.execute(
+        db.select(assoc_purchases_item.c.purchase_id, Item.name)
+        .join(Item, Item.id == assoc_purchases_item.c.item_id)
+        .join(Purchase, Purchase.id == assoc_purchases_item.c.purchase_id)
+        .where(Purchase.user_id == user_id)).all()
+    linked_ids, names = zip(*links) if links else ((), ())
+
+    # Map each item's purchase id to the row of that purchase
+    by_id = np.argsort(purchase_id)
+    linked = np.fromiter(linked_ids, dtype=np.int64, count=len(links))
+    item_row = by_id[np.searchsorted(purchase_id, linked, sorter=by_id)].astype(np.int32)
+    item_names, item_code = encode(names)
+
+    return SpendingArrays(amount, day, type_code[order].astype(np.int16), type_names,
+                          item_row, item_code, item_names)
+
+
+def rolling_averages(arrays, today, days):
+    """
+    Returns the spending and the rolling 7 and 30 day daily averages of each of the last days days
+    """
+    import numpy as np
+
+    last = epoch_day(today)
+    first = last - days + 1
+    widest = max(ROLLING_WINDOWS)
+    totals = arrays.daily_totals(first - widest + 1, last)
+    cumulative = np.concatenate(([0.0], np.cumsum(totals)))
+    # cumulative[i + 1] - cumulative[i + 1 - window] is the total of the window ending on day i
+    ends = np.arange(widest, len(totals) + 1)
+    averages = {window: (cumulative[ends] - cumulative[ends - window]) / window for window in ROLLING_WINDOWS}
+    return [
+        {"date": (today - timedelta(days=days - 1 - n)).isoformat(), "total": totals[widest - 1 + n],
+         **{"avg_%d" % window: averages[window][n] for window in ROLLING_WINDOWS}}
+        for n in range(days)
+    ]
+
+
+def month_over_month(arrays, today):
+    """
+    Returns the spending per type this month to date against the same days of the previous month
+    """
+    month_start = today.replace(day=1)
+    previous_start = (month_start - timedelta(days=1)).replace(day=1)
+    previous_end = min(previous_start.replace(day=calendar.monthrange(previous_start.year, previous_start.month)[1]),
+                       previous_start + timedelta(days=today.day - 1))
+
+    current = arrays.totals_by_type(epoch_day(month_start), epoch_day(today))
+    previous = arrays.totals_by_type(epoch_day(previous_start), epoch_day(previous_end))
+    return [
+        {"type": expense_type, "this_month": current[code], "last_month": previous[code],
+         "change": round(float((current[code] - previous[code]) / previous[code]), 4) if previous[code] else None}
+        for code, expense_type in enumerate(arrays.types)
+        if current[code] or previous[code]
+    ]
+
+
+def top_items(arrays, limit):
+    """
+    Returns the limit item names with the most spent on them
+    """
+    import numpy as np
+
+    if not arrays.item_names:
+        return []
+    spent, counts = arrays.spending_by_item()
+    limit = min(limit, len(spent))
+    top = np.argpartition(-spent, limit - 1)[:limit]
+    top = top[np.argsort(-spent[top], kind="stable")]
+    return [{"name": arrays.item_names[code], "spent": spent[code], "count": int(counts[code])} for code in top]
+
+
+def month_forecast(arrays, today):
+    """
+    Returns the spending of this month to date and its projection to the end of the month
+    at the average daily spending of the last FORECAST_WINDOW days
+    """
+    last = epoch_day(today)
+    days_in_month = calendar.monthrange(today.year, today.month)[1]
+    spent = arrays.daily_totals(epoch_day(today.replace(day=1)), last).sum()
+    daily_rate = arrays.daily_totals(last - FORECAST_WINDOW + 1, last).sum() / FORECAST_WINDOW
+    return {
+        "month": today.strftime("%Y-%m"),
+        "spent": spent,
+        "daily_rate": daily_rate,
+        "forecast": spent + daily_rate * (days_in_month - today.day),
+    }
+
+
+def analyze(arrays, today, days=30, top=10, rate=1):
+    """
+    Compute the spending trends of a user's arrays as of today, amounts converted at rate
+    """
+
+    def money(value):
+        return round(float(value) * rate, 2)
+
+    rolling = rolling_averages(arrays, today, days)
+    for row in rolling:
+        for key in ("total",) + tuple("avg_%d" % window for window in ROLLING_WINDOWS):
+            row[key] = money(row[key])
+
+    by_type = month_over_month(arrays, today)
+    for row in by_type:
+        row["this_month"] = money(row["this_month"])
+        row["last_month"] = money(row["last_month"])
+
+    items = top_items(arrays, top)
+    for row in items:
+        row["spent"] = money(row["spent"])
+
+    forecast = {key: money(value) if key != "month" else value
+                for key, value in month_forecast(arrays, today).items()}
+
+    return {
+        "date": today.isoformat(),
+        "purchases": len(arrays.amount),
+        "rolling": rolling,
+        "month_over_month": by_type,
+        "top_items": items,
+        "forecast": forecast,
+    }
+
+
+class AnalyticsCache:
+    """
+    Bounded LRU cache of users' SpendingArrays, so trends are computed without reloading the purchases
+    An entry is reused only while the user's data version is unchanged, every purchase write bumps it,
+    and at most ANALYTICS_CACHE_MAX_ENTRIES users or ANALYTICS_CACHE_MAX_BYTES of arrays are kept per process
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("ANALYTICS_CACHE_MAX_ENTRIES", 32)
+        app.config.setdefault("ANALYTICS_CACHE_MAX_BYTES", 256 * 1024 * 1024)
+        app.extensions["analytics_cache"] = self
+        self.app = app
+
+    def arrays(self, user_id):
+        """
+        Returns the SpendingArrays of a user, loading them when missing or out of date
+        """
+        version = data_version(user_id)
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        # Loaded after reading the version, so a concurrent write can only make the entry look older than it is
+        arrays = load_arrays(user_id)
+        with self.lock:
+            previous = self.entries.pop(user_id, None)
+            if previous is not None:
+                self.nbytes -= previous[1].nbytes
+            self.entries[user_id] = (version, arrays)
+            self.nbytes += arrays.nbytes
+            while len(self.entries) > 1 and (len(self.entries) > self.app.config["ANALYTICS_CACHE_MAX_ENTRIES"]
+                                             or self.nbytes > self.app.config["ANALYTICS_CACHE_MAX_BYTES"]):
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+        return arrays
+
+    def stats(self):
+        """
+        Returns the hit/miss counters and size of this process's cache
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.nbytes,
+            }
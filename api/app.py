@@ -1,52 +1,197 @@
 import os
-import jwt
-import requests
+import io
+import codecs
+import csv
+import json
 import secrets
-
-from db import db, Purchase, User, Item
-from flask import Flask, request, render_template, redirect, url_for, current_app, jsonify, make_response, session, abort, flash
+import hmac
+from functools import wraps
+from itertools import chain
+
+from db import db, User, ReceiptJob, create_schema, apply_sqlite_pragmas, insert_purchases, \
+    delete_purchases, update_purchase, rebuild_rollups, verify_rollups, Budget
+from ocr_jobs import ReceiptJobQueue, QueueFull
+from ocr_cache import ReceiptCache
+from rates import ExchangeRateStore, BASE_CURRENCY, convert_amounts
+from write_batcher import PurchaseWriter, WriteTimeout
+from importer import import_purchases, csv_records, ofx_records, is_export
+from budgets import check_budget, list_budgets
+from user_cache import UserCache
+from metrics import Metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from http_client import HttpClient, UpstreamError
+from conditional import conditional
+from compression import Compression
+from json_provider import JSONProvider
+from analytics import AnalyticsCache, analyze
+from reports import summarize_purchases, list_purchases, all_purchases, iter_purchases, PERIOD_FORMATS
+from flask import Blueprint, Flask, Response, request, render_template, redirect, url_for, current_app, jsonify, make_response, session, abort, flash, stream_with_context
 from flask_login import LoginManager, login_user, logout_user, current_user, login_required
 from dotenv import load_dotenv
 from urllib.parse import urlencode
 from datetime import datetime, timedelta
 from werkzeug.security import generate_password_hash, check_password_hash
-from receipt import get_total_amount
-from PIL import Image
+from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import RequestEntityTooLarge
+from sqlalchemy.pool import QueuePool
 
 
 load_dotenv()
 
-app = Flask(__name__, template_folder="../front-end/templates",
-            static_folder="../front-end/static")
 db_filename = "expense_tracker.db"
 
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///%s" % db_filename
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_ECHO"] = True
-app.config['JWT_EXPIRATION_DELTA'] = timedelta(minutes=15)
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
-app.config['OAUTH2_PROVIDERS'] = {
-    'google': {
-        'client_id': os.environ.get('GOOGLE_CLIENT_ID'),
-        'client_secret': os.environ.get('GOOGLE_CLIENT_SECRET'),
-        'authorize_url': 'https://accounts.google.com/o/oauth2/auth',
-        'token_url': 'https://accounts.google.com/o/oauth2/token',
-        'userinfo': {
-            'url': 'https://www.googleapis.com/oauth2/v3/userinfo',
-            'email': lambda json: json['email'],
+# Routes are registered on this blueprint, create_app() builds the app around it
+bp = Blueprint("main", __name__, cli_group=None)
+
+login_manager = LoginManager()
+login_manager.login_view = 'main.main_page'
+
+metrics = Metrics()
+receipt_cache = ReceiptCache()
+receipt_jobs = ReceiptJobQueue(cache=receipt_cache)
+http_client = HttpClient()
+exchange_rates = ExchangeRateStore(http=http_client)
+purchase_writer = PurchaseWriter()
+user_cache = UserCache()
+analytics_cache = AnalyticsCache()
+compression = Compression()
+
+
+def create_app(config=None):
+    """
+    Create the app, configured from the environment and then from the optional config mapping
+    Nothing is read from or written to the database here, run `flask --app app init-db`
+    to create or migrate the schema before serving
+    """
+    app = Flask(__name__, template_folder="../front-end/templates",
+                static_folder="../front-end/static")
+    app.json_provider_class = JSONProvider
+    app.json = JSONProvider(app)
+
+    # EXPENSE_TRACKER_ENV=production selects the runtime profile the Dockerfile runs under gunicorn:
+    # no SQL echo, pooled SQLite connections in WAL mode with tuned pragmas
+    production = os.environ.get('EXPENSE_TRACKER_ENV') == 'production'
+
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get('DATABASE_URI', "sqlite:///%s" % db_filename)
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ECHO"] = not production
+    if production:
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+            "poolclass": QueuePool,
+            "pool_size": 5,
+            "max_overflow": 10,
+            "connect_args": {"check_same_thread": False},
+        }
+        app.config["SQLITE_PRAGMAS"] = {
+            "journal_mode": "WAL",
+            "busy_timeout": 5000,
+            "synchronous": "NORMAL",
+            "mmap_size": 256 * 1024 * 1024,
+            "cache_size": -64 * 1024,
+        }
+    else:
+        app.config["SQLITE_PRAGMAS"] = {"busy_timeout": 5000}
+    app.config["EXPENSES_PAGE_SIZE"] = 50
+    app.config["EXPENSES_MAX_PAGE_SIZE"] = 500
+    # WRITE_BEHIND=1 group-commits purchase inserts from concurrent requests, see write_batcher.py
+    app.config["WRITE_BEHIND"] = os.environ.get('WRITE_BEHIND') == '1'
+    app.config["BUDGET_NEAR_RATIO"] = 0.9
+    app.config["ANALYTICS_MAX_DAYS"] = 366
+    app.config["ANALYTICS_MAX_TOP_ITEMS"] = 100
+    # SLOW_REQUEST_MS=<ms> logs requests slower than that with their SQL/OCR/HTTP breakdown, see metrics.py
+    if os.environ.get('SLOW_REQUEST_MS'):
+        app.config["SLOW_REQUEST_THRESHOLD"] = float(os.environ['SLOW_REQUEST_MS']) / 1000
+    app.config["RECEIPT_BATCH_MAX_FILES"] = 20
+    # Largest request body accepted, receipt batches and statement imports included
+    app.config["MAX_CONTENT_LENGTH"] = 50 * 1024 * 1024
+    app.config['JWT_EXPIRATION_DELTA'] = timedelta(minutes=15)
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
+    # Bearer token for /metrics and the stats routes, without it they are open to logged in users only
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+    app.config['OAUTH2_PROVIDERS'] = {
+        'google': {
+            'client_id': os.environ.get('GOOGLE_CLIENT_ID'),
+            'client_secret': os.environ.get('GOOGLE_CLIENT_SECRET'),
+            'authorize_url': 'https://accounts.google.com/o/oauth2/auth',
+            'token_url': 'https://accounts.google.com/o/oauth2/token',
+            'userinfo': {
+                'url': 'https://www.googleapis.com/oauth2/v3/userinfo',
+                'email': lambda json: json['email'],
+            },
+            'scopes': ['https://www.googleapis.com/auth/userinfo.email'],
         },
-        'scopes': ['https://www.googleapis.com/auth/userinfo.email'],
-    },
-}
+    }
+    if config:
+        app.config.update(config)
+
+    login_manager.init_app(app)
+    db.init_app(app)
+    metrics.init_app(app)
+    receipt_cache.init_app(app)
+    receipt_jobs.init_app(app)
+    http_client.init_app(app)
+    exchange_rates.init_app(app)
+    purchase_writer.init_app(app)
+    user_cache.init_app(app)
+    analytics_cache.init_app(app)
+    compression.init_app(app)
+    app.register_blueprint(bp)
+
+    with app.app_context():
+        apply_sqlite_pragmas(db.engine, app.config["SQLITE_PRAGMAS"])
+        metrics.instrument_engine(db.engine)
+
+    return app
+
+
+class BoundedInput:
+    """
+    Request body stream that answers 413 once more than limit bytes have been read
+    """
 
+    def __init__(self, stream, limit):
+        self.stream = stream
+        self.remaining = limit
 
-login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = 'main_page'
+    def consumed(self, data):
+        self.remaining -= len(data)
+        if self.remaining < 0:
+            raise RequestEntityTooLarge()
+        return data
+
+    def read(self, size=-1):
+        return self.consumed(self.stream.read(size))
+
+    def readline(self, size=-1):
+        return self.consumed(self.stream.readline(size))
 
-db.init_app(app)
-with app.app_context():
-    db.create_all()
+
+@bp.before_app_request
+def limit_request_body():
+    """
+    Werkzeug only compares MAX_CONTENT_LENGTH with the Content-Length header, so bound
+    chunked request bodies, which have none, while they are read
+    """
+    limit = current_app.config["MAX_CONTENT_LENGTH"]
+    if limit is not None and request.content_length is None and request.environ.get("wsgi.input_terminated"):
+        request.environ["wsgi.input"] = BoundedInput(request.environ["wsgi.input"], limit)
+
+
+def operator_required(view):
+    """
+    Restrict a view exposing internal counters to requests carrying the METRICS_TOKEN bearer token,
+    or to logged in users when no token is configured
+    """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = current_app.config["METRICS_TOKEN"]
+        if not token:
+            return login_required(view)(*args, **kwargs)
+        if not hmac.compare_digest(request.headers.get("Authorization", "").encode(), ("Bearer " + token).encode()):
+            return failure_response("Unauthorized", 401)
+        return view(*args, **kwargs)
+
+    return wrapper
 
 
 def success_response(body, code=200):
@@ -57,17 +202,59 @@ def failure_response(message, code=404):
     return jsonify({"error": message}), code
 
 
+def parse_date_range():
+    """
+    Read the optional since/until query parameters as ISO dates or datetimes
+    A plain date given as until includes that whole day
+    Returns (since, until) where until is exclusive, raises ValueError on bad input
+    """
+    since = request.args.get('since')
+    until = request.args.get('until')
+
+    if since:
+        since = datetime.fromisoformat(since)
+    else:
+        since = None
+
+    if until:
+        until_date = datetime.fromisoformat(until)
+        if len(until) == 10:
+            until_date += timedelta(days=1)
+        until = until_date
+    else:
+        until = None
+
+    return since, until
+
+
+def convert_purchases(purchases, rate):
+    """
+    Serialize purchases with their amounts multiplied by an exchange rate
+    The purchases nested under each item are converted too, so the whole response is in one currency
+    """
+    serialized = [purchase.serialize() for purchase in purchases]
+    if rate != 1:
+        for purchase in serialized:
+            purchase["amount"] = round(purchase["amount"] * rate, 2)
+            for item in purchase["items"]:
+                for item_purchase in item["purchases"]:
+                    item_purchase["amount"] = round(item_purchase["amount"] * rate, 2)
+    return serialized
+
+
 def generate_tokens(user):
+    import jwt
+
     # Generate access token
     access_token_payload = {'user_id': user.id, 'exp': datetime.utcnow(
-    ) + app.config['JWT_EXPIRATION_DELTA']}
+    ) + current_app.config['JWT_EXPIRATION_DELTA']}
     access_token = jwt.encode(access_token_payload,
-                              app.config['SECRET_KEY'], algorithm='HS256')
+                              current_app.config['SECRET_KEY'], algorithm='HS256')
 
     # Generate refresh token
     refresh_token_payload = {'user_id': user.id}
     refresh_token = jwt.encode(
-        refresh_token_payload, app.config['SECRET_KEY'], algorithm='HS256')
+        refresh_token_payload, current_app.config['SECRET_KEY'], algorithm='HS256')
 
     return access_token, refresh_token
 
@@ -82,52 +269,54 @@ def verify_password(hashed_password, password):
 
 @login_manager.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    return user_cache.load(int(id))
 
 # ---------------------Render pages-------------------
 
 
-@app.route("/")
+@bp.route("/")
 def main_page():
     # main page
     return render_template('index.html')
 
 
-@app.route('/currency/', methods=['GET', 'POST'])
+@bp.route('/currency/', methods=['GET', 'POST'])
 def currency_page():
     if request.method == 'POST':
-        return redirect(url_for('currency'))
+        return redirect(url_for('.currency'))
 
     return render_template('currency.html')
 
 
-@app.route('/header/', methods=['GET', 'POST'])
+@bp.route('/header/', methods=['GET', 'POST'])
 def header_page():
     if request.method == 'POST':
-        return redirect(url_for('header'))
+        return redirect(url_for('.header'))
 
     return render_template('header.html')
 
 
-@app.route('/report/', methods=['GET', 'POST'])
+@bp.route('/report/', methods=['GET', 'POST'])
 def report_page():
     if request.method == 'POST':
-        return redirect(url_for('report'))
+        return redirect(url_for('.report'))
 
-    return render_template('report.html')
+    # The table only shows type, date and amount, so plain rows are read instead of purchases with their items
+    purchases = chain.from_iterable(iter_purchases(current_user.id)) if current_user.is_authenticated else []
+    return render_template('report.html', purchases=purchases)
 
 
-@app.route('/login/', methods=['GET', 'POST'])
+@bp.route('/login/', methods=['GET', 'POST'])
 def login_page():
     if request.method == 'POST':
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
 
     return render_template('login.html')
 
 
 # -----------------------------API routes---------------------
 
-@app.route('/api/login/', methods=['POST'])
+@bp.route('/api/login/', methods=['POST'])
 def login():
     """
     Get the username and password from the request body
@@ -165,19 +354,21 @@ def login():
         return jsonify({'error': 'Invalid credentials'}), 401
 
 
-@app.route('/api/refresh-token/', methods=['POST'])
+@bp.route('/api/refresh-token/', methods=['POST'])
 def refresh_token():
     """
     Refresh the access token
     Given a refresh token in the request body, verify it and generate a new access token
     Set the new access token as a cookie in the response
     """
+    import jwt
+
     data = request.get_json()
     refresh_token = data.get('refresh_token')
 
     try:
         payload = jwt.decode(
-            refresh_token, app.config['SECRET_KEY'], algorithms=['HS256'])
+            refresh_token, current_app.config['SECRET_KEY'], algorithms=['HS256'])
         user = User.query.get(payload['user_id'])
 
         if user:
@@ -200,13 +391,14 @@ def refresh_token():
         return jsonify({'message': 'Invalid refresh token'}), 401
 
 
-@app.route('/api/logout/', methods=['POST'])
+@bp.route('/api/logout/', methods=['POST'])
 @login_required
 def logout():
     """
     Logout the user
     Clear the access and refresh tokens by setting their expiration to the immediate time
     """
+    user_cache.invalidate(current_user.id)
     logout_user()
     response = make_response(jsonify({'message': 'Logout successful'}))
     # Clear the access and refresh tokens by setting their expiration to the past
@@ -218,7 +410,7 @@ def logout():
     return response
 
 
-@app.route('/api/register/', methods=['POST'])
+@bp.route('/api/register/', methods=['POST'])
 def register():
     """
     Register a new user
@@ -237,16 +429,23 @@ def register():
 
     new_user = User(username=username, password=hash_password(password))
     db.session.add(new_user)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another request registered the same username since the check above
+        db.session.rollback()
+        return jsonify({'error': 'User with this email already exists'}), 400
+    user_cache.invalidate(new_user.id)
     return jsonify({'message': 'Registration successful. You can now log in.'}), 201
 
 
-@app.route("/api/submit_expense/", methods=['POST'])
+@bp.route("/api/submit_expense/", methods=['POST'])
 def submit_expense():
     """
     Takes in a receipt or amount and returns the amount and type of expense
     If amount is provided, it will be used with the highest piroity
-    If the receipt is provided, it will be given to the OCR method to extracted the amount #TODO
+    If the receipt is provided, it is queued for OCR and a job id is returned right away,
+    the amount is available from /api/receipt_job/<job_id>/ once it has been extracted
     Records the expense in the database
     """
     amount = request.form.get('amount')
@@ -263,88 +462,464 @@ def submit_expense():
                                      "type": expense_type
                                      })
 
-        # If user is logged in, store the purchase into the database and return the amount and type
+        # If user is logged in, store the purchase into the database and return the amount and type,
+        # along with the budget status of the type for this month if it has a budget
         amount = int(request.form.get('amount'))  # type: ignore
-        user = User.query.filter_by(id=current_user.id).first()
-        purchase = Purchase(
-            amount=amount, type=expense_type, date=datetime.now())
-        user.purchases.append(purchase)
-        db.session.add(purchase)
-        db.session.add(user)
-        db.session.commit()
+        date = datetime.now()
+        try:
+            purchase_writer.write([{"user_id": current_user.id, "amount": amount,
+                                    "type": expense_type, "date": date}])
+        except WriteTimeout:
+            return failure_response("expense was not saved, try again", 503)
+        except Exception:
+            current_app.logger.exception("failed to record expense")
+            return failure_response("expense could not be saved", 500)
         return success_response({"adjustedAmount": amount,
-                                 "type": expense_type
+                                 "type": expense_type,
+                                 "budget": check_budget(current_user.id, expense_type, date,
+                                                        current_app.config["BUDGET_NEAR_RATIO"])
                                  })
     elif receipt_file is not None:
-        # If user is not logged in, don't store the purchase into the database and return the amount and type
-        receipt = Image.open(receipt_file)
-        amount = get_total_amount(receipt)
-        if amount is None:
-            return failure_response("total not found", 400)
-        
-        if current_user.is_anonymous:
-            return success_response({"adjustedAmount": amount,
-                                     "type": expense_type
-                                     })
-
-        # If user is logged in, store the purchase into the database and return the amount and type
-        user = User.query.filter_by(id=current_user.id).first()
-        purchase = Purchase(
-            amount=amount, type=expense_type, date=datetime.now())
-        user.purchases.append(purchase)
-        db.session.add(purchase)
-        db.session.add(user)
-        db.session.commit()
-        return success_response({"adjustedAmount": amount,
+        # OCR runs in the background, the client polls the returned job for the amount
+        # If user is logged in, the purchase is stored into the database once the total is read
+        user_id = None if current_user.is_anonymous else current_user.id
+        try:
+            job_id = receipt_jobs.submit(receipt_file.read(), user_id, expense_type)
+        except QueueFull:
+            return failure_response("too many receipts are being processed, try again later", 429)
+        return success_response({"jobId": job_id,
                                  "type": expense_type
-                                 })
+                                 }, 202)
     else:
         return failure_response("parameter not provided", 400)
 
 
-@app.route("/api/get_expenses/", methods=['GET'])
+@bp.route("/api/submit_receipts/", methods=['POST'])
+def submit_receipts():
+    """
+    Takes in many receipt files and returns the amount read from each one
+    The receipts are read in parallel across the OCR process pool
+    If user is logged in, every purchase found is recorded in a single transaction
+    """
+    receipt_files = request.files.getlist('receipts')
+    expense_type = request.form.get('type')
+
+    if expense_type is None:
+        expense_type = "uncategorized"
+
+    if not receipt_files:
+        return failure_response("parameter not provided", 400)
+    if len(receipt_files) > current_app.config["RECEIPT_BATCH_MAX_FILES"]:
+        return failure_response("too many receipts, at most %d per request"
+                                % current_app.config["RECEIPT_BATCH_MAX_FILES"], 400)
+
+    try:
+        scans = receipt_jobs.scan_many([receipt_file.read() for receipt_file in receipt_files])
+    except QueueFull:
+        return failure_response("too many receipts are being processed, try again later", 429)
+
+    results = []
+    rows = []
+    for receipt_file, (amount, error) in zip(receipt_files, scans):
+        if amount is None:
+            results.append({"filename": receipt_file.filename, "error": error})
+            continue
+
+        results.append({"filename": receipt_file.filename,
+                        "adjustedAmount": amount,
+                        "type": expense_type
+                        })
+        if not current_user.is_anonymous:
+            rows.append({"user_id": current_user.id, "amount": amount,
+                         "type": expense_type, "date": datetime.now()})
+    insert_purchases(rows)
+    db.session.commit()
+
+    return success_response({"results": results})
+
+
+@bp.route("/api/import_expenses/", methods=['POST'])
 @login_required
+def import_expenses():
+    """
+    Imports a bank or credit card statement (CSV or OFX) as purchases
+    The file is read row by row and inserted in chunks, so memory stays flat whatever its size
+    Optional form fields: format (csv or ofx, guessed from the file name), type (default type),
+    amount_column, date_column, type_column (CSV column names), encoding (of a CSV, utf-8 by default),
+    date_format (strptime format) and negative_is_expense (1: negative amounts are expenses, positive ones
+    deposits; 0 for statements that list charges as positive amounts). negative_is_expense defaults to 1,
+    except for CSVs exported by this app, whose amounts are positive expenses; the response reports the value used
+    Rows the user already has are skipped, invalid rows are reported by row number
+    """
+    statement = request.files.get('statement')
+    if statement is None:
+        return failure_response("parameter not provided", 400)
+
+    statement_format = request.form.get('format')
+    if statement_format is None:
+        statement_format = "ofx" if statement.filename.lower().endswith((".ofx", ".qfx")) else "csv"
+
+    negative_is_expense = request.form.get('negative_is_expense')
+    if statement_format == "csv":
+        encoding = request.form.get('encoding', 'utf-8-sig')
+        try:
+            codecs.lookup(encoding)
+        except LookupError:
+            return failure_response("unknown encoding", 400)
+        if negative_is_expense is None and is_export(statement.stream):
+            negative_is_expense = '0'
+        records = csv_records(statement.stream,
+                              amount_column=request.form.get('amount_column', 'amount'),
+                              date_column=request.form.get('date_column', 'date'),
+                              type_column=request.form.get('type_column', 'type'),
+                              encoding=encoding)
+    elif statement_format == "ofx":
+        records = ofx_records(statement.stream)
+    else:
+        return failure_response("format must be csv or ofx", 400)
+
+    result = import_purchases(current_user.id, records,
+                              default_type=request.form.get('type') or "uncategorized",
+                              date_format=request.form.get('date_format'),
+                              negative_is_expense=negative_is_expense != '0')
+    return success_response(result)
+
+
+@bp.route("/api/receipt_job/<job_id>/", methods=['GET'])
+def get_receipt_job(job_id):
+    """
+    Returns the status of a receipt OCR job, and the amount once it has been read
+    A job still pending after OCR_JOB_TIMEOUT is reported as failed
+    Jobs of a logged in user are only visible to that user
+    """
+    job = db.session.get(ReceiptJob, job_id)
+    if job is None:
+        return failure_response("job not found")
+
+    if job.user_id is not None and (current_user.is_anonymous or current_user.id != job.user_id):
+        return failure_response("job not found")
+
+    if receipt_jobs.expire(job):
+        db.session.commit()
+    return success_response(job.serialize())
+
+
+@bp.route("/api/ocr_cache/stats/", methods=['GET'])
+@operator_required
+def get_ocr_cache_stats():
+    """
+    Returns the hit/miss counters of the receipt OCR cache and the OCR time it has saved
+    """
+    return success_response(receipt_cache.stats())
+
+
+@bp.route("/api/user_cache/stats/", methods=['GET'])
+@operator_required
+def get_user_cache_stats():
+    """
+    Returns the hit/miss counters of the login user cache and the user queries it has saved
+    """
+    return success_response(user_cache.stats())
+
+
+@bp.route("/metrics", methods=['GET'])
+@operator_required
+def get_metrics():
+    """
+    Returns this process's request, SQL, OCR and outbound HTTP metrics and cache counters
+    in the Prometheus text format
+    """
+    user_stats = user_cache.stats()
+    analytics_stats = analytics_cache.stats()
+    rate_stats = exchange_rates.status()
+    counters = [
+        ("ocr_cache_hits_total", "counter", "Receipt OCR cache hits", receipt_cache.hits),
+        ("ocr_cache_misses_total", "counter", "Receipt OCR cache misses", receipt_cache.misses),
+        ("ocr_cache_seconds_saved_total", "counter", "OCR time saved by the receipt cache", receipt_cache.seconds_saved),
+        ("ocr_queue_pending", "gauge", "Receipts waiting for or in OCR", receipt_jobs.pending),
+        ("user_cache_hits_total", "counter", "Login user cache hits", user_stats["hits"]),
+        ("user_cache_misses_total", "counter", "Login user cache misses", user_stats["misses"]),
+        ("analytics_cache_hits_total", "counter", "Analytics array cache hits", analytics_stats["hits"]),
+        ("analytics_cache_misses_total", "counter", "Analytics array cache misses", analytics_stats["misses"]),
+        ("analytics_cache_bytes", "gauge", "Memory held by cached analytics arrays", analytics_stats["bytes"]),
+        ("purchase_write_batches_total", "counter", "Purchase insert transactions", purchase_writer.batches),
+        ("purchase_write_rows_total", "counter", "Purchases inserted by the writer", purchase_writer.rows),
+        ("exchange_rate_refreshes_total", "counter", "Exchange rate refreshes", rate_stats["refreshes"]),
+        ("exchange_rate_refresh_failures_total", "counter", "Failed exchange rate refreshes", rate_stats["failures"]),
+    ]
+    if rate_stats["age_seconds"] is not None:
+        counters.append(("exchange_rate_age_seconds", "gauge", "Age of the shared exchange rates",
+                         rate_stats["age_seconds"]))
+    return Response(metrics.render(counters), mimetype=METRICS_CONTENT_TYPE)
+
+
+def rates_version():
+    """
+    Version of the exchange rates the response depends on, None when amounts are not converted
+    """
+    if request.args.get('currency', BASE_CURRENCY) == BASE_CURRENCY:
+        return None
+    return exchange_rates.version()
+
+
+@bp.route("/api/get_expenses/", methods=['GET'])
+@login_required
+@conditional(depends_on=rates_version)
 def get_expenses():
     """
-    Returns all the expenses for the user
+    Returns the user's expenses one page at a time, newest first
+    Optional query parameters: limit, cursor (next_cursor from the previous page), since, until, type,
+    currency to convert the amounts into
+    Passing all=true returns every expense in one response as before
     """
-    user = User.query.filter_by(id=current_user.id).first()
-    purchases = user.purchases
-    return success_response({"purchases": [purchase.serialize() for purchase in purchases]})
+    currency = request.args.get('currency', BASE_CURRENCY)
+    try:
+        rate = exchange_rates.rate(BASE_CURRENCY, currency) if currency != BASE_CURRENCY else 1
+    except LookupError as e:
+        return failure_response(str(e), 400)
 
+    if request.args.get('all') == 'true':
+        purchases = all_purchases(current_user.id)
+        return success_response({"purchases": convert_purchases(purchases, rate),
+                                 "currency": currency})
 
-#Temporary storing the data from the api, reduce the number of api calls and optimize the performance
-#Set to be expired after 1 day
-exchange_rate=(datetime.now()-timedelta(days=1), 
-               {
-                     "rates": None
-               })
+    limit = request.args.get('limit', current_app.config["EXPENSES_PAGE_SIZE"], type=int)
+    limit = max(1, min(limit, current_app.config["EXPENSES_MAX_PAGE_SIZE"]))
 
-@app.route("/api/exchange/")
-def get_exchange():
+    try:
+        since, until = parse_date_range()
+        purchases, next_cursor = list_purchases(current_user.id, limit,
+                                                cursor=request.args.get('cursor'),
+                                                since=since, until=until,
+                                                expense_type=request.args.get('type'))
+    except ValueError:
+        return failure_response("invalid cursor or date range", 400)
+
+    return success_response({"purchases": convert_purchases(purchases, rate),
+                             "currency": currency,
+                             "next_cursor": next_cursor})
 
+
+@bp.route("/api/delete_expense/<int:purchase_id>/", methods=['DELETE'])
+@login_required
+def delete_expense(purchase_id):
+    """
+    Deletes one of the user's expenses
+    """
+    if not delete_purchases(current_user.id, [purchase_id]):
+        return failure_response("expense not found")
+    db.session.commit()
+    return success_response({"message": "Expense deleted"})
+
+
+@bp.route("/api/update_expense/<int:purchase_id>/", methods=['POST'])
+@login_required
+def update_expense(purchase_id):
+    """
+    Changes the amount, type or date of one of the user's expenses
+    The rollups, and so the budgets, of the old and new month and type are adjusted
+    """
+    changes = {}
+    try:
+        if request.form.get('amount'):
+            changes["amount"] = int(request.form.get('amount'))  # type: ignore
+        if request.form.get('date'):
+            changes["date"] = datetime.fromisoformat(request.form.get('date'))  # type: ignore
+    except ValueError:
+        return failure_response("amount must be a number and date an ISO date", 400)
+    if request.form.get('type'):
+        changes["type"] = request.form.get('type')
+
+    if not changes:
+        return failure_response("parameter not provided", 400)
+    if not update_purchase(current_user.id, purchase_id, **changes):
+        return failure_response("expense not found")
+    db.session.commit()
+    return success_response({"message": "Expense updated"})
+
+
+@bp.route("/api/set_budget/", methods=['POST'])
+@login_required
+def set_budget():
+    """
+    Sets the monthly limit of an expense type, an empty or zero limit removes the budget
+    """
+    expense_type = request.form.get('type')
+    if not expense_type:
+        return failure_response("parameter not provided", 400)
+
+    try:
+        monthly_limit = float(request.form.get('limit') or 0)
+    except ValueError:
+        return failure_response("limit must be a number", 400)
+
+    budget = db.session.get(Budget, (current_user.id, expense_type))
+    if monthly_limit <= 0:
+        if budget is not None:
+            db.session.delete(budget)
+    elif budget is None:
+        db.session.add(Budget(user_id=current_user.id, type=expense_type, monthly_limit=monthly_limit))
+    else:
+        budget.monthly_limit = monthly_limit
+    db.session.commit()
+
+    return success_response({"budget": check_budget(current_user.id, expense_type, datetime.now(),
+                                                    current_app.config["BUDGET_NEAR_RATIO"])})
+
+
+@bp.route("/api/get_budgets/", methods=['GET'])
+@login_required
+def get_budgets():
+    """
+    Returns the user's budgets with how much has been spent of each this month
+    """
+    return success_response({"budgets": list_budgets(current_user.id, datetime.now(),
+                                                     current_app.config["BUDGET_NEAR_RATIO"])})
+
+
+@bp.route("/api/export_expenses/", methods=['GET'])
+@login_required
+def export_expenses():
+    """
+    Streams the user's expenses as CSV or NDJSON, oldest first
+    Rows are read from the database in batches and sent as they are read
+    Optional query parameters: format (csv or ndjson, defaults to csv), since, until, type
+    """
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ('csv', 'ndjson'):
+        return failure_response("format must be csv or ndjson", 400)
+
+    try:
+        since, until = parse_date_range()
+    except ValueError:
+        return failure_response("since and until must be ISO dates", 400)
+
+    batches = iter_purchases(current_user.id, since=since, until=until,
+                             expense_type=request.args.get('type'))
+
+    def generate_csv():
+        yield "id,date,amount,type\r\n"
+        for batch in batches:
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(
+                (purchase_id, date.isoformat(), amount, expense_type)
+                for purchase_id, date, amount, expense_type in batch)
+            yield buffer.getvalue()
+
+    def generate_ndjson():
+        for batch in batches:
+            yield "".join(json.dumps({"id": purchase_id, "date": date.isoformat(),
+                                      "amount": amount, "type": expense_type}) + "\n"
+                          for purchase_id, date, amount, expense_type in batch)
+
+    if export_format == 'csv':
+        body, mimetype = generate_csv(), "text/csv"
+    else:
+        body, mimetype = generate_ndjson(), "application/x-ndjson"
+
+    return Response(stream_with_context(body), mimetype=mimetype, headers={
+        "Content-Disposition": "attachment; filename=expenses.%s" % export_format})
+
+
+@bp.route("/api/get_summary/", methods=['GET'])
+@login_required
+@conditional(depends_on=rates_version)
+def get_summary():
+    """
+    Returns the user's spending totals computed in the database
+    Totals are given overall, per type and per day, week or month
+    Optional query parameters: since, until, type, period (defaults to month),
+    currency to convert the totals into
+    """
+    period = request.args.get('period', 'month')
+    if period not in PERIOD_FORMATS:
+        return failure_response("period must be one of day, week or month", 400)
+
+    try:
+        since, until = parse_date_range()
+    except ValueError:
+        return failure_response("since and until must be ISO dates", 400)
+
+    currency = request.args.get('currency', BASE_CURRENCY)
+    try:
+        rate = exchange_rates.rate(BASE_CURRENCY, currency) if currency != BASE_CURRENCY else 1
+    except LookupError as e:
+        return failure_response(str(e), 400)
+
+    summary = summarize_purchases(current_user.id, period=period, since=since,
+                                  until=until, expense_type=request.args.get('type'))
+    if rate != 1:
+        summary["total"] = round(summary["total"] * rate, 2)
+        for row in summary["by_type"] + summary["by_period"]:
+            row["total"] = round(row["total"] * rate, 2)
+    summary["currency"] = currency
+    return success_response(summary)
+
+
+def analytics_version():
+    """
+    Analytics depend on the current date as well as on the exchange rates
+    """
+    return datetime.now().date(), rates_version()
+
+
+@bp.route("/api/get_analytics/", methods=['GET'])
+@login_required
+@conditional(depends_on=analytics_version)
+def get_analytics():
+    """
+    Returns the user's spending trends: the rolling 7 and 30 day averages of each of the last days days,
+    the spending per type this month against the same days of last month, the items with the most spent
+    on them and a forecast of this month's total
+    Optional query parameters: days (defaults to 30), top (defaults to 10), currency to convert the amounts into
+    """
+    days = max(1, min(request.args.get('days', 30, type=int), current_app.config["ANALYTICS_MAX_DAYS"]))
+    top = max(1, min(request.args.get('top', 10, type=int), current_app.config["ANALYTICS_MAX_TOP_ITEMS"]))
+
+    currency = request.args.get('currency', BASE_CURRENCY)
+    try:
+        rate = exchange_rates.rate(BASE_CURRENCY, currency) if currency != BASE_CURRENCY else 1
+    except LookupError as e:
+        return failure_response(str(e), 400)
+
+    analytics = analyze(analytics_cache.arrays(current_user.id), datetime.now().date(), days=days, top=top, rate=rate)
+    analytics["currency"] = currency
+    return success_response(analytics)
+
+
+@bp.route("/api/analytics/stats/", methods=['GET'])
+@operator_required
+def get_analytics_stats():
+    """
+    Returns the hit/miss counters and memory use of the analytics array cache
+    """
+    return success_response(analytics_cache.stats())
+
+
+@bp.route("/api/exchange/")
+def get_exchange():
+    """
+    Converts an amount between two currencies
+    Rates come from the shared exchange rate store, which refreshes them in the background once a day
+    """
     amount = request.args.get('fromCurrencyAmount', type=float)
     fromCurrencyCode = request.args.get('fromCurrency', type=str)
     toCurrencyCode = request.args.get('toCurrency', type=str)
-    
-    global exchange_rate
 
-    if datetime.now() - exchange_rate[0] >= timedelta(days=1):
-        # this is an api i found online that does not require a api key
-        api_key = os.environ.get('CURRENCY_API_KEY')
-        url = f'https://api.freecurrencyapi.com/v1/latest?apikey={api_key}'
-        response = requests.get(url)
+    if amount is None:
+        return failure_response("parameter not provided", 400)
 
-        # The 'data' dictionary holds exchange rates for various currencies, 
-        # with the US Dollar (USD) as the base currency.
-        data = response.json()
-        
-        exchange_rate = (datetime.now(), data.get('data'))
+    rates = exchange_rates.get_rates()
+    if rates is None:
+        return failure_response("exchange rates are unavailable", 503)
 
     # get the fromCurrency rate
-    fromCurrencyCode_rate = exchange_rate[1].get(fromCurrencyCode)
+    fromCurrencyCode_rate = rates.get(fromCurrencyCode)
     # get the toCurrency_rate
-    toCurrencyCode_rate = exchange_rate[1].get(toCurrencyCode)
+    toCurrencyCode_rate = rates.get(toCurrencyCode)
+
+    if not fromCurrencyCode_rate or toCurrencyCode_rate is None:
+        return failure_response("unknown currency", 400)
 
     # do some simple math
     rate = toCurrencyCode_rate/fromCurrencyCode_rate
@@ -353,14 +928,60 @@ def get_exchange():
     return success_response({"toCurrencyAmount": round(res,2)})
 
 
+@bp.route("/api/exchange/batch/", methods=['POST'])
+def get_exchange_batch():
+    """
+    Converts many amounts in one call
+    Takes a JSON body with a list of conversions, each with amount, fromCurrency and toCurrency,
+    fromCurrency and toCurrency given at the top level apply to every conversion that leaves them out
+    """
+    data = request.get_json(silent=True) or {}
+    conversions = data.get('conversions')
+    if not isinstance(conversions, list) or not conversions:
+        return failure_response("parameter not provided", 400)
+
+    try:
+        amounts = [float(conversion['amount']) for conversion in conversions]
+        from_codes = [conversion.get('fromCurrency', data.get('fromCurrency')) for conversion in conversions]
+        to_codes = [conversion.get('toCurrency', data.get('toCurrency')) for conversion in conversions]
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return failure_response("every conversion needs a numeric amount", 400)
+    # Codes missing or given as lists, numbers or objects would fail to sort in convert_amounts
+    if not all(isinstance(code, str) for code in from_codes + to_codes):
+        return failure_response("every conversion needs fromCurrency and toCurrency codes", 400)
+
+    rates = exchange_rates.get_rates()
+    if rates is None:
+        return failure_response("exchange rates are unavailable", 503)
+
+    try:
+        results = convert_amounts(rates, amounts, from_codes, to_codes)
+    except KeyError:
+        return failure_response("unknown currency", 400)
+
+    return success_response({"toCurrencyAmounts": results})
+
+
+@bp.route("/api/exchange/status/")
+@operator_required
+def get_exchange_status():
+    """
+    Returns the age of the exchange rates, their TTL, the refresh counters and whether
+    calls to the currency API are currently refused by the circuit breaker
+    """
+    status = exchange_rates.status()
+    status["breaker"] = http_client.status().get("currency_api", "closed")
+    return success_response(status)
+
+
 #---------------------OAuth login api-------------------
-@app.route('/api/authorize/<provider>')
+@bp.route('/api/authorize/<provider>')
 def oauth2_authorize(provider):
     """
     Authorize the user with the given provider
     """
     if not current_user.is_anonymous:
-        return redirect(url_for('main_page'))
+        return redirect(url_for('.main_page'))
 
     provider_data = current_app.config['OAUTH2_PROVIDERS'].get(provider)
     if provider_data is None:
@@ -370,7 +991,7 @@ def oauth2_authorize(provider):
     
     qs = urlencode({
         'client_id': provider_data['client_id'],
-        'redirect_uri': url_for('oauth2_callback', provider=provider, _external=True),
+        'redirect_uri': url_for('.oauth2_callback', provider=provider, _external=True),
         'response_type': 'code',
         'scope': ' '.join(provider_data['scopes']),
         'state': session['oauth2_state'],
@@ -378,17 +999,17 @@ def oauth2_authorize(provider):
 
     return redirect(provider_data['authorize_url'] + '?' + qs)
 
-@app.route("/api/callback/<provider>")
+@bp.route("/api/callback/<provider>")
 def oauth2_callback(provider):
     if not current_user.is_anonymous:
-        return redirect(url_for('main_page'))
+        return redirect(url_for('.main_page'))
     
     provider_data = current_app.config['OAUTH2_PROVIDERS'].get(provider)
     if provider_data is None:
         abort(404)
     
     if 'error' in request.args:
-        return redirect(url_for('main_page'))
+        return redirect(url_for('.main_page'))
     
     if request.args.get('state') != session.pop('oauth2_state', None):
         abort(401)
@@ -396,24 +1017,29 @@ def oauth2_callback(provider):
     if 'code' not in request.args:
         abort(401)
 
-    response = requests.post(provider_data['token_url'], data = {
-        'client_id': provider_data['client_id'],
-        'client_secret': provider_data['client_secret'],
-        'code': request.args.get('code'),
-        'grant_type': 'authorization_code',
-        'redirect_uri': url_for('oauth2_callback', provider=provider, _external=True),
-    }, headers = {'Accept': 'application/json'})
-
-    if response.status_code != 200:
-        abort(401)
-    oauth2_token = response.json().get('access_token')
-    if not oauth2_token:
-        abort(401)
-    
-    response = requests.get(provider_data['userinfo']['url'], headers = {
-        'Authorization': 'Bearer ' + oauth2_token,
-        'Accept': 'application/json',
-    })
+    # Both calls reuse pooled connections and give up after the client's timeouts and retries
+    try:
+        response = http_client.post(provider + '_token', provider_data['token_url'], data = {
+            'client_id': provider_data['client_id'],
+            'client_secret': provider_data['client_secret'],
+            'code': request.args.get('code'),
+            'grant_type': 'authorization_code',
+            'redirect_uri': url_for('.oauth2_callback', provider=provider, _external=True),
+        }, headers = {'Accept': 'application/json'})
+
+        if response.status_code != 200:
+            abort(401)
+        oauth2_token = response.json().get('access_token')
+        if not oauth2_token:
+            abort(401)
+
+        response = http_client.get(provider + '_userinfo', provider_data['userinfo']['url'], headers = {
+            'Authorization': 'Bearer ' + oauth2_token,
+            'Accept': 'application/json',
+        })
+    except UpstreamError:
+        current_app.logger.exception("%s login failed", provider)
+        abort(503)
     if response.status_code != 200:
         abort(401)
     
@@ -423,21 +1049,68 @@ def oauth2_callback(provider):
     if user is None:
         user = User(username=username, password=hash_password(os.urandom(16).hex()))
         db.session.add(user)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # A concurrent callback created this user first
+            db.session.rollback()
+            user = db.session.scalar(db.select(User).where(User.username == username))
     
     login_user(user)
     flash('Welcome, ' + username + '!')
-    return redirect(url_for('main_page'))
+    return redirect(url_for('.main_page'))
 
 
-@app.errorhandler(404)
+@bp.cli.command("init-db")
+def init_db_command():
+    """
+    Create any missing tables and indexes and migrate an existing database
+    """
+    create_schema()
+    print("database schema is up to date")
+
+
+@bp.cli.command("rebuild-rollups")
+def rebuild_rollups_command():
+    """
+    Recompute the daily and monthly rollups from the purchase table and verify them
+    """
+    rebuild_rollups()
+    db.session.commit()
+    for table, mismatches in verify_rollups().items():
+        print("%s: %d mismatched buckets" % (table, mismatches))
+
+
+@bp.cli.command("verify-rollups")
+def verify_rollups_command():
+    """
+    Compare the daily and monthly rollups with the purchase table, exits with status 1 on a mismatch
+    """
+    mismatches = verify_rollups()
+    for table, count in mismatches.items():
+        print("%s: %d mismatched buckets" % (table, count))
+    if any(mismatches.values()):
+        raise SystemExit(1)
+
+
+@bp.app_errorhandler(404)
 def page_not_found(e):
     return render_template('404.html'), 404
 
+
+@bp.app_errorhandler(413)
+def request_too_large(e):
+    return failure_response("request is too large, at most %d bytes"
+                            % current_app.config["MAX_CONTENT_LENGTH"], 413)
+
 @login_manager.unauthorized_handler
 def unauthorized():
     return jsonify({'error': 'Unauthorized'}), 401
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8000, debug=True)
+    app = create_app()
+    # The development server sets up the schema itself, in production run init-db first
+    with app.app_context():
+        create_schema()
+    app.run(host="0.0.0.0", port=8000, debug=os.environ.get('EXPENSE_TRACKER_ENV') != 'production')
@@ -0,0 +1,58 @@
+from db import db, Budget, MonthlyRollup
+
+# Spending at or past this share of a limit is reported as near the budget
+NEAR_BUDGET_RATIO = 0.9
+
+
+def budget_status(monthly_limit, spent, month, near_ratio=NEAR_BUDGET_RATIO):
+    """
+    Describe how much of a monthly limit has been spent
+    """
+    if spent > monthly_limit:
+        status = "over"
+    elif spent >= monthly_limit * near_ratio:
+        status = "near"
+    else:
+        status = "ok"
+
+    return {
+        "month": month,
+        "limit": monthly_limit,
+        "spent": spent,
+        "remaining": monthly_limit - spent,
+        "status": status,
+    }
+
+
+def check_budget(user_id, expense_type, date, near_ratio=NEAR_BUDGET_RATIO):
+    """
+    Returns the budget status of a type for the month of date, or None if the type has no budget
+    Reads the running monthly total kept by the rollups, a single primary key lookup
+    """
+    month = date.strftime("%Y-%m")
+    row = db.session.execute(
+        db.select(Budget.monthly_limit, MonthlyRollup.total)
+        .outerjoin(MonthlyRollup, db.and_(MonthlyRollup.user_id == Budget.user_id,
+                                          MonthlyRollup.type == Budget.type,
+                                          MonthlyRollup.month == month))
+        .where(Budget.user_id == user_id)
+        .where(Budget.type == expense_type)).first()
+    if row is None:
+        return None
+    return budget_status(row.monthly_limit, row.total or 0, month, near_ratio)
+
+
+def list_budgets(user_id, date, near_ratio=NEAR_BUDGET_RATIO):
+    """
+    Returns every budget of a user with its status for the month of date
+    """
+    month = date.strftime("%Y-%m")
+    rows = db.session.execute(
+        db.select(Budget.type, Budget.monthly_limit, MonthlyRollup.total)
+        .outerjoin(MonthlyRollup, db.and_(MonthlyRollup.user_id == Budget.user_id,
+                                          MonthlyRollup.type == Budget.type,
+                                          MonthlyRollup.month == month))
+        .where(Budget.user_id == user_id)
+        .order_by(Budget.type)).all()
+    return [dict(budget_status(row.monthly_limit, row.total or 0, month, near_ratio), type=row.type)
+            for row in rows]
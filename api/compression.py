@@ -0,0 +1,59 @@
+import gzip
+
+from flask import request
+
+# brotli is optional, responses fall back to gzip without it
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class Compression:
+    """
+    Compresses JSON and text responses of at least COMPRESS_MIN_SIZE bytes,
+    with brotli when it is installed and accepted by the client, otherwise with gzip
+    Streamed responses such as exports and static files are sent as they are
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("COMPRESS_MIN_SIZE", 1024)
+        app.config.setdefault("COMPRESS_GZIP_LEVEL", 6)
+        app.config.setdefault("COMPRESS_BROTLI_QUALITY", 4)
+        app.config.setdefault("COMPRESS_MIMETYPES", {"application/json", "text/html", "text/css",
+                                                     "text/javascript", "application/javascript"})
+        app.extensions["compression"] = self
+        app.after_request(self.compress)
+        self.app = app
+
+    def compress(self, response):
+        config = self.app.config
+        if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+                or "Content-Encoding" in response.headers or response.mimetype not in config["COMPRESS_MIMETYPES"]):
+            return response
+
+        data = response.get_data()
+        if len(data) < config["COMPRESS_MIN_SIZE"]:
+            return response
+
+        response.vary.add("Accept-Encoding")
+        accepted = request.accept_encodings
+        if brotli is not None and accepted["br"]:
+            encoding, body = "br", brotli.compress(data, quality=config["COMPRESS_BROTLI_QUALITY"])
+        elif accepted["gzip"]:
+            encoding, body = "gzip", gzip.compress(data, compresslevel=config["COMPRESS_GZIP_LEVEL"])
+        else:
+            return response
+
+        response.set_data(body)
+        response.headers["Content-Encoding"] = encoding
+        # A strong ETag names one exact representation, so the encoded body gets its own
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag("%s-%s" % (etag, encoding), weak)
+        return response
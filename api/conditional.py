@@ -0,0 +1,54 @@
+import hashlib
+from functools import wraps
+
+from flask import make_response, request
+from flask_login import current_user
+
+from db import data_version
+
+# Suffixes the compression layer adds to the ETag of an encoded response
+ENCODING_SUFFIXES = ("", "-gzip", "-br")
+
+
+def data_etag(user_id, extra=None):
+    """
+    Strong ETag of the current request for a user's data
+    Built from the endpoint, the query string and the user's data version, plus any extra
+    value the response depends on, so computing it never reads the purchases
+    """
+    key = "%s|%s|%s|%s|%s" % (request.endpoint, user_id, data_version(user_id),
+                              sorted(request.args.items(multi=True)), extra)
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+
+def conditional(depends_on=None):
+    """
+    Answer a view with 304 Not Modified when the client already has the current version of its data
+    depends_on is an optional function returning anything else the response depends on
+    Must be applied below login_required
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            etag = data_etag(current_user.id, depends_on() if depends_on is not None else None)
+            for suffix in ENCODING_SUFFIXES:
+                if request.if_none_match.contains(etag + suffix):
+                    response = make_response("", 304)
+                    response.set_etag(etag + suffix)
+                    response.headers["Cache-Control"] = "private, no-cache"
+                    # The ETag depends on the encoding, so caches must key the 304 on it like the 200
+                    response.vary.add("Accept-Encoding")
+                    return response
+
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag)
+                response.vary.add("Accept-Encoding")
+                # Let browsers keep the body but revalidate it on every use
+                response.headers["Cache-Control"] = "private, no-cache"
+            return response
+
+        return wrapper
+
+    return decorator
@@ -1,12 +1,19 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
+import time
+from collections import defaultdict
+from sqlalchemy import event
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 db = SQLAlchemy()
 
 assoc_purchases_item = db.Table(
     "association_purchases_items",
     db.Column("purchase_id", db.Integer, db.ForeignKey("purchase.id")),
-    db.Column("item_id", db.Integer, db.ForeignKey("item.id"))
+    db.Column("item_id", db.Integer, db.ForeignKey("item.id")),
+    # Items are loaded per purchase and purchases per item, both sides are looked up by id
+    db.Index("ix_association_purchases_items_purchase_id", "purchase_id"),
+    db.Index("ix_association_purchases_items_item_id", "item_id"),
 )
 
 
@@ -16,6 +23,9 @@ class User(UserMixin, db.Model):
     """
 
     __tablename__ = "user"
+    __table_args__ = (
+        db.Index("ix_user_username", "username", unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     username = db.Column(db.String, nullable=False)
     password = db.Column(db.String, nullable=False)
@@ -48,6 +58,9 @@ class Purchase(db.Model):
     """
 
     __tablename__ = "purchase"
+    __table_args__ = (
+        db.Index("ix_purchase_user_date_type", "user_id", "date", "type"),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     amount = db.Column(db.Integer, nullable=False)
@@ -122,3 +135,389 @@ class Item(db.Model):
             "name": self.name,
             "purchases": [purchase.simple_serialize() for purchase in self.purchases]
         }
+
+
+class ReceiptJob(db.Model):
+    """
+    Receipt OCR job model
+    Tracks a receipt from upload until its total has been read
+    """
+
+    __tablename__ = "receipt_job"
+    id = db.Column(db.String, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    type = db.Column(db.String, nullable=False)
+    status = db.Column(db.String, nullable=False)
+    amount = db.Column(db.Float)
+    error = db.Column(db.String)
+    created_at = db.Column(db.DateTime, nullable=False)
+    finished_at = db.Column(db.DateTime, index=True)
+
+    def __init__(self, **kwargs):
+        """
+        Initialize a receipt job object
+        """
+
+        self.id = kwargs.get("id")
+        self.user_id = kwargs.get("user_id")
+        self.type = kwargs.get("type", "uncategorized")
+        self.status = kwargs.get("status", "pending")
+        self.created_at = kwargs.get("created_at")
+
+    def serialize(self):
+        """
+        Serialize a receipt job object
+        """
+
+        return {
+            "jobId": self.id,
+            "status": self.status,
+            "adjustedAmount": self.amount,
+            "type": self.type,
+            "error": self.error,
+        }
+
+
+class ReceiptCacheEntry(db.Model):
+    """
+    Receipt OCR cache model
+    Keyed by the SHA-256 of the uploaded bytes, with a perceptual hash of the image
+    so re-encoded copies of the same receipt can also be matched
+    """
+
+    __tablename__ = "receipt_cache"
+    digest = db.Column(db.String, primary_key=True)
+    phash = db.Column(db.String, index=True)
+    total = db.Column(db.Float)
+    text = db.Column(db.Text, nullable=False)
+    ocr_seconds = db.Column(db.Float, nullable=False)
+    hits = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+    last_used_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __init__(self, **kwargs):
+        """
+        Initialize a receipt cache entry object
+        """
+
+        self.digest = kwargs.get("digest")
+        self.phash = kwargs.get("phash")
+        self.total = kwargs.get("total")
+        self.text = kwargs.get("text", "")
+        self.ocr_seconds = kwargs.get("ocr_seconds", 0)
+        self.hits = 0
+        self.created_at = kwargs.get("created_at")
+        self.last_used_at = self.created_at
+
+
+class ExchangeRates(db.Model):
+    """
+    Exchange rate model
+    A single row holding the latest USD based rates, shared by every worker
+    """
+
+    __tablename__ = "exchange_rates"
+    id = db.Column(db.Integer, primary_key=True)
+    rates = db.Column(db.Text)
+    fetched_at = db.Column(db.DateTime)
+    refresh_until = db.Column(db.DateTime)
+    last_error = db.Column(db.String)
+
+    def __init__(self, **kwargs):
+        """
+        Initialize an exchange rates object
+        """
+
+        self.id = kwargs.get("id", 1)
+        self.rates = kwargs.get("rates")
+        self.fetched_at = kwargs.get("fetched_at")
+
+
+class DailyRollup(db.Model):
+    """
+    Daily rollup model
+    Sum and count of a user's purchases of one type on one day
+    """
+
+    __tablename__ = "purchase_rollup_daily"
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    type = db.Column(db.String, primary_key=True)
+    total = db.Column(db.Float, nullable=False)
+    count = db.Column(db.Integer, nullable=False)
+
+
+class MonthlyRollup(db.Model):
+    """
+    Monthly rollup model
+    Sum and count of a user's purchases of one type in one month (YYYY-MM)
+    """
+
+    __tablename__ = "purchase_rollup_monthly"
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    month = db.Column(db.String, primary_key=True)
+    type = db.Column(db.String, primary_key=True)
+    total = db.Column(db.Float, nullable=False)
+    count = db.Column(db.Integer, nullable=False)
+
+
+class Budget(db.Model):
+    """
+    Budget model
+    Monthly spending limit of a user for one expense type
+    """
+
+    __tablename__ = "budget"
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    type = db.Column(db.String, primary_key=True)
+    monthly_limit = db.Column(db.Float, nullable=False)
+
+    def __init__(self, **kwargs):
+        """
+        Initialize a budget object
+        """
+
+        self.user_id = kwargs.get("user_id")
+        self.type = kwargs.get("type", "uncategorized")
+        self.monthly_limit = kwargs.get("monthly_limit", 0)
+
+
+class DataVersion(db.Model):
+    """
+    Data version model
+    Changes whenever one of a user's purchases is added, changed or deleted,
+    so responses built from them can be validated without reading the purchases
+    """
+
+    __tablename__ = "user_data_version"
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+
+
+# Loader option that fetches purchase items, and the purchases of those items,
+# in two extra SELECT ... IN queries no matter how many purchases are loaded,
+# so serialize() never falls back to a lazy load per purchase or per item
+PURCHASE_ITEMS_LOADER = db.selectinload(Purchase.items).selectinload(Item.purchases)
+
+
+def update_rollups(rows, sign=1):
+    """
+    Add (sign=1) or remove (sign=-1) purchases, given as dicts of user_id, amount, type and date,
+    from the daily and monthly rollups
+    """
+    daily = defaultdict(lambda: [0, 0])
+    monthly = defaultdict(lambda: [0, 0])
+    for row in rows:
+        if row["user_id"] is None:
+            continue
+        for buckets, key in ((daily, (row["user_id"], row["date"].date(), row["type"])),
+                             (monthly, (row["user_id"], row["date"].strftime("%Y-%m"), row["type"]))):
+            buckets[key][0] += sign * row["amount"]
+            buckets[key][1] += sign
+
+    for model, period, buckets in ((DailyRollup, "day", daily), (MonthlyRollup, "month", monthly)):
+        if not buckets:
+            continue
+        upsert = sqlite_insert(model.__table__)
+        db.session.execute(
+            upsert.on_conflict_do_update(
+                index_elements=["user_id", period, "type"],
+                set_={"total": model.__table__.c.total + upsert.excluded.total,
+                      "count": model.__table__.c.count + upsert.excluded.count}),
+            [{"user_id": user_id, period: bucket, "type": expense_type, "total": total, "count": count}
+             for (user_id, bucket, expense_type), (total, count) in buckets.items()])
+        if sign < 0:
+            db.session.execute(db.delete(model.__table__).where(model.count <= 0))
+
+
+def bump_data_versions(user_ids):
+    """
+    Give the users a new data version, runs in the caller's transaction
+    """
+    user_ids = {user_id for user_id in user_ids if user_id is not None}
+    if user_ids:
+        # New rows start from the clock so versions are not reused if the table is ever lost
+        start = time.time_ns() // 1000
+        db.session.execute(
+            sqlite_insert(DataVersion.__table__).on_conflict_do_update(
+                index_elements=["user_id"], set_={"version": DataVersion.version + 1}),
+            [{"user_id": user_id, "version": start} for user_id in user_ids])
+
+
+def data_version(user_id):
+    """
+    Returns the current data version of a user, a single primary key lookup
+    """
+    return db.session.scalar(db.select(DataVersion.version).where(DataVersion.user_id == user_id)) or 0
+
+
+def insert_purchases(rows):
+    """
+    Insert purchases given as dicts of user_id, amount, type and date, without loading any user
+    Runs in the caller's transaction, every path that records purchases goes through here
+    so the rollups stay in step with the purchase table
+    """
+    if rows:
+        db.session.execute(db.insert(Purchase.__table__), rows)
+        update_rollups(rows)
+        bump_data_versions(row["user_id"] for row in rows)
+
+
+def delete_purchases(user_id, purchase_ids):
+    """
+    Delete purchases of a user and take them out of the rollups
+    Runs in the caller's transaction, returns the number of purchases deleted
+    """
+    rows = [row._asdict() for row in db.session.execute(
+        db.select(Purchase.id, Purchase.user_id, Purchase.amount, Purchase.type, Purchase.date)
+        .where(Purchase.user_id == user_id)
+        .where(Purchase.id.in_(purchase_ids)))]
+    if not rows:
+        return 0
+
+    ids = [row["id"] for row in rows]
+    db.session.execute(db.delete(assoc_purchases_item).where(assoc_purchases_item.c.purchase_id.in_(ids)))
+    db.session.execute(db.delete(Purchase.__table__).where(Purchase.id.in_(ids)))
+    update_rollups(rows, sign=-1)
+    bump_data_versions([user_id])
+    return len(rows)
+
+
+def update_purchase(user_id, purchase_id, **changes):
+    """
+    Change the amount, type or date of one of a user's purchases and move it between rollup buckets
+    Runs in the caller's transaction, returns False if the user has no such purchase
+    """
+    old = db.session.execute(
+        db.select(Purchase.user_id, Purchase.amount, Purchase.type, Purchase.date)
+        .where(Purchase.user_id == user_id)
+        .where(Purchase.id == purchase_id)).first()
+    if old is None:
+        return False
+
+    old = old._asdict()
+    new = dict(old, **changes)
+    db.session.execute(db.update(Purchase.__table__).where(Purchase.id == purchase_id).values(**changes))
+    update_rollups([old], sign=-1)
+    update_rollups([new])
+    bump_data_versions([user_id])
+    return True
+
+
+def rollup_queries():
+    """
+    Returns (model, query) pairs that aggregate the purchase table the way each rollup does
+    """
+    owned = Purchase.user_id.isnot(None)
+    day = db.func.date(Purchase.date)
+    month = db.func.strftime("%Y-%m", Purchase.date)
+    return [
+        (model, db.select(Purchase.user_id, bucket.label(period), Purchase.type,
+                          db.func.sum(Purchase.amount).label("total"),
+                          db.func.count(Purchase.id).label("count"))
+         .where(owned).group_by(Purchase.user_id, bucket, Purchase.type))
+        for model, period, bucket in ((DailyRollup, "day", day), (MonthlyRollup, "month", month))
+    ]
+
+
+def rebuild_rollups():
+    """
+    Recompute the rollups from the purchase table, in the caller's transaction
+    """
+    for model, query in rollup_queries():
+        db.session.execute(db.delete(model.__table__))
+        db.session.execute(db.insert(model.__table__).from_select(
+            ["user_id", query.selected_columns[1].name, "type", "total", "count"], query))
+
+
+def verify_rollups():
+    """
+    Compare the rollups with the purchase table
+    returns the number of mismatched buckets per rollup table, missing and extra buckets included
+    """
+    mismatches = {}
+    for model, query in rollup_queries():
+        raw = query.subquery()
+        period = query.selected_columns[1].name
+        keys = db.and_(model.user_id == raw.c.user_id,
+                       getattr(model, period) == raw.c[period],
+                       model.type == raw.c.type)
+        wrong = db.session.scalar(
+            db.select(db.func.count()).select_from(raw.outerjoin(model, keys))
+            .where(db.or_(model.count.is_(None), model.count != raw.c.count,
+                          db.func.abs(model.total - raw.c.total) > 1e-6)))
+        extra = db.session.scalar(
+            db.select(db.func.count()).select_from(model.__table__.outerjoin(raw, keys))
+            .where(raw.c.count.is_(None)))
+        mismatches[model.__tablename__] = wrong + extra
+    return mismatches
+
+
+def apply_sqlite_pragmas(engine, pragmas):
+    """
+    Run the given PRAGMA statements on every new connection the engine opens to SQLite
+    """
+    if engine.dialect.name != "sqlite" or not pragmas:
+        return
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute("PRAGMA %s = %s" % (name, value))
+        cursor.close()
+
+
+def merge_duplicate_users():
+    """
+    Merge users sharing a username into the one with the lowest id, so the unique username index can be built
+    Purchases, receipt jobs and budgets of the duplicates are moved to the kept user and the rollups rebuilt
+    Returns the number of users removed, does not commit
+    """
+    groups = db.session.execute(
+        db.select(User.username, db.func.min(User.id))
+        .group_by(User.username)
+        .having(db.func.count(User.id) > 1)).all()
+
+    removed = 0
+    for username, keep_id in groups:
+        duplicates = db.select(User.id).where(User.username == username).where(User.id != keep_id)
+        for model in (Purchase, ReceiptJob):
+            db.session.execute(db.update(model.__table__).where(model.user_id.in_(duplicates))
+                               .values(user_id=keep_id))
+        # A budget the kept user already has for the same type wins
+        db.session.execute(db.update(Budget.__table__).prefix_with("OR IGNORE")
+                           .where(Budget.user_id.in_(duplicates)).values(user_id=keep_id))
+        db.session.execute(db.delete(Budget.__table__).where(Budget.user_id.in_(duplicates)))
+        db.session.execute(db.delete(DataVersion.__table__).where(DataVersion.user_id.in_(duplicates)))
+        removed += db.session.execute(db.delete(User.__table__).where(User.id.in_(duplicates))).rowcount
+        bump_data_versions([keep_id])
+
+    if removed:
+        rebuild_rollups()
+    return removed
+
+
+def create_schema():
+    """
+    Create any missing tables and indexes
+    create_all skips tables that already exist along with their indexes,
+    so indexes added to an existing table are created explicitly
+    Rollup tables created here are filled from the existing purchases
+    Duplicate usernames are merged before the unique username index is built
+    """
+
+    inspector = db.inspect(db.engine)
+    existing = set(inspector.get_table_names())
+    db.create_all()
+    if "user" in existing and "ix_user_username" not in {index["name"] for index in inspector.get_indexes("user")}:
+        merge_duplicate_users()
+        db.session.commit()
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+    rollups = {DailyRollup.__tablename__, MonthlyRollup.__tablename__}
+    if "purchase" in existing and not rollups <= existing:
+        rebuild_rollups()
+        db.session.commit()
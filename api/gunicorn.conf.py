@@ -0,0 +1,25 @@
+import os
+
+# Production server settings, see the Dockerfile
+# flask --app app init-db && gunicorn --config gunicorn.conf.py "app:create_app()" (from the api directory)
+
+os.environ.setdefault("EXPENSE_TRACKER_ENV", "production")
+
+bind = "0.0.0.0:%s" % os.environ.get("PORT", "8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", (os.cpu_count() or 1) * 2 + 1))
+# The app divides the host's OCR processes between the workers
+os.environ["WEB_CONCURRENCY"] = str(workers)
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+timeout = 60
+
+# Build the app once in the master, workers fork from it instead of each importing the code
+preload_app = True
+
+
+def pre_fork(server, worker):
+    # Workers must open their own SQLite connections instead of inheriting the master's
+    from db import db
+
+    with server.app.wsgi().app_context():
+        db.engine.dispose()
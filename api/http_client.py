@@ -0,0 +1,190 @@
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+from metrics import timed_http, record_http_retry, record_http_rejected
+
+# Methods that can be sent again without risk when a response was lost
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+# Statuses meaning the upstream is briefly unavailable rather than rejecting the request
+RETRY_STATUSES = {429, 502, 503, 504}
+
+
+class UpstreamError(Exception):
+    """
+    Raised when an upstream could not be reached or did not answer in time
+    """
+
+
+class CircuitOpen(UpstreamError):
+    """
+    Raised instead of calling an upstream that has failed too many times in a row
+    """
+
+
+class CircuitBreaker:
+    """
+    Opens after threshold consecutive failures of an upstream, then lets a single trial
+    request through every reset_after seconds until one succeeds
+    """
+
+    def __init__(self, threshold, reset_after):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if not self.trial and time.monotonic() - self.opened_at >= self.reset_after:
+                self.trial = True
+                return True
+            return False
+
+    def record(self, ok):
+        with self.lock:
+            self.trial = False
+            if ok:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.opened_at is not None or self.failures >= self.threshold:
+                    self.opened_at = time.monotonic()
+
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            return "half_open" if self.trial else "open"
+
+
+class HttpClient:
+    """
+    Shared client for calls to third-party APIs
+    Keeps a pool of keep-alive connections per host, bounds every call with HTTP_CONNECT_TIMEOUT and
+    HTTP_READ_TIMEOUT, retries failures up to HTTP_RETRIES times with jittered exponential backoff and
+    stops calling an upstream for HTTP_BREAKER_RESET seconds after HTTP_BREAKER_THRESHOLD failures in a row
+    Latency, retries and refused calls are recorded per upstream in the app metrics
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.breakers = {}
+        self.pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("HTTP_CONNECT_TIMEOUT", 3.05)
+        app.config.setdefault("HTTP_READ_TIMEOUT", 10)
+        app.config.setdefault("HTTP_RETRIES", 2)
+        app.config.setdefault("HTTP_RETRY_BACKOFF", 0.2)
+        app.config.setdefault("HTTP_POOL_SIZE", 10)
+        app.config.setdefault("HTTP_BREAKER_THRESHOLD", 5)
+        app.config.setdefault("HTTP_BREAKER_RESET", 30)
+        app.extensions["http_client"] = self
+        self.app = app
+
+    def session(self, url):
+        """
+        Returns the pooled session for the scheme and host of url
+        """
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        with self.lock:
+            # A forked worker must open its own connections instead of sharing the parent's sockets
+            if self.pid != os.getpid():
+                self.sessions = {}
+                self.pid = os.getpid()
+            session = self.sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                session.mount("%s://" % parts.scheme, HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.app.config["HTTP_POOL_SIZE"], max_retries=0))
+                self.sessions[key] = session
+            return session
+
+    def breaker(self, upstream):
+        with self.lock:
+            breaker = self.breakers.get(upstream)
+            if breaker is None:
+                breaker = self.breakers[upstream] = CircuitBreaker(
+                    self.app.config["HTTP_BREAKER_THRESHOLD"], self.app.config["HTTP_BREAKER_RESET"])
+            return breaker
+
+    def request(self, upstream, method, url, **kwargs):
+        """
+        Send a request to the upstream named upstream and return its response
+        Requests that may already have reached the upstream are only repeated for idempotent methods
+        Raises CircuitOpen while the upstream's breaker is open and UpstreamError once retries run out,
+        responses with any other status are returned to the caller
+        """
+        import requests
+
+        config = self.app.config
+        breaker = self.breaker(upstream)
+        if not breaker.allow():
+            record_http_rejected(upstream)
+            raise CircuitOpen("%s is unavailable after repeated failures" % upstream)
+
+        kwargs.setdefault("timeout", (config["HTTP_CONNECT_TIMEOUT"], config["HTTP_READ_TIMEOUT"]))
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        session = self.session(url)
+        attempt = 0
+        ok = False
+        with timed_http(upstream):
+            try:
+                while True:
+                    error = None
+                    response = None
+                    try:
+                        response = session.request(method, url, **kwargs)
+                    except requests.ConnectTimeout as e:
+                        # Nothing was sent, so any method can be tried again
+                        error, retryable = e, True
+                    except requests.RequestException as e:
+                        error, retryable = e, idempotent
+                    else:
+                        if response.status_code not in RETRY_STATUSES:
+                            ok = response.status_code < 500
+                            return response
+                        retryable = idempotent
+
+                    if not retryable or attempt >= config["HTTP_RETRIES"]:
+                        if error is not None:
+                            raise UpstreamError("%s request failed: %s" % (upstream, error)) from error
+                        return response
+
+                    attempt += 1
+                    record_http_retry(upstream)
+                    time.sleep(random.uniform(0, config["HTTP_RETRY_BACKOFF"] * 2 ** attempt))
+            finally:
+                # Recorded however the call ends, an unexpected error during a half-open trial
+                # would otherwise leave the breaker refusing every call
+                breaker.record(ok)
+
+    def get(self, upstream, url, **kwargs):
+        return self.request(upstream, "GET", url, **kwargs)
+
+    def post(self, upstream, url, **kwargs):
+        return self.request(upstream, "POST", url, **kwargs)
+
+    def status(self):
+        """
+        Returns the circuit breaker state of every upstream called so far
+        """
+        with self.lock:
+            breakers = dict(self.breakers)
+        return {upstream: breaker.state() for upstream, breaker in sorted(breakers.items())}
@@ -0,0 +1,196 @@
+import codecs
+import csv
+import re
+import time
+from datetime import datetime, timezone
+
+from db import db, Purchase, insert_purchases
+
+# Rows are validated, de-duplicated and inserted this many at a time
+CHUNK_SIZE = 500
+# Only the first errors are reported, the rest are counted
+MAX_REPORTED_ERRORS = 100
+DATE_FORMATS = ("%Y-%m-%d", "%m/%d/%Y", "%Y%m%d", "%d.%m.%Y")
+# Header of the CSV written by /api/export_expenses/, which lists expenses as positive amounts
+EXPORT_HEADER = ["id", "date", "amount", "type"]
+
+
+def parse_amount(value):
+    """
+    Parse an amount like "$1,234.50" or "(12.00)", raises ValueError if it is not a number
+    """
+    value = (value or "").strip()
+    negative = value.startswith("(") and value.endswith(")")
+    value = re.sub(r"[^0-9.\-]", "", value)
+    amount = float(value)
+    return -amount if negative else amount
+
+
+def parse_date(value, date_format=None):
+    """
+    Parse a statement date, in date_format if given, otherwise ISO or one of DATE_FORMATS
+    OFX dates such as 20240131120000[-5:EST] are read up to the day
+    Dates with a UTC offset are converted to UTC and stored naive like every other purchase date
+    """
+    date = read_date((value or "").strip(), date_format)
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+
+def read_date(value, date_format):
+    if date_format:
+        return datetime.strptime(value, date_format)
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        pass
+    # Also try without a trailing time, and the leading YYYYMMDD of OFX dates
+    for candidate in (value, value.split(" ")[0], value[:8]):
+        for fmt in DATE_FORMATS:
+            try:
+                return datetime.strptime(candidate, fmt)
+            except ValueError:
+                continue
+    raise ValueError("unrecognized date %r" % value)
+
+
+def decoded(value):
+    """
+    Returns a raw CSV value, raises ValueError if it holds bytes the statement's encoding could not decode
+    """
+    if value is not None:
+        try:
+            value.encode("utf-8")
+        except UnicodeEncodeError:
+            raise ValueError("%r is not text in the statement's encoding, set the encoding field" % value) from None
+    return value
+
+
+def is_export(stream):
+    """
+    Returns True if a CSV statement was exported by this app, leaves the stream at its start
+    """
+    header = stream.readline()
+    stream.seek(0)
+    return next(csv.reader([header.decode("utf-8-sig", errors="replace")]), None) == EXPORT_HEADER
+
+
+def csv_records(stream, amount_column="amount", date_column="date", type_column="type", encoding="utf-8-sig"):
+    """
+    Read a CSV statement row by row
+    yields (line number, amount, date, type) with the raw values of the mapped columns
+    Bytes that are not valid in encoding are kept as surrogates, so only the rows whose mapped
+    values hold them fail, as row errors, instead of the whole import
+    """
+    # Lines are decoded here rather than through io.TextIOWrapper, which needs a readable() that
+    # the SpooledTemporaryFile of uploads only has from Python 3.11
+    reader = csv.DictReader(codecs.iterdecode(stream, encoding, errors="surrogateescape"))
+    for record in reader:
+        yield (reader.line_num, record.get(amount_column), record.get(date_column),
+               record.get(type_column))
+
+
+def ofx_records(stream, block_size=64 * 1024):
+    """
+    Read the transactions of an OFX statement without loading the whole file
+    Works for both SGML (unclosed tags) and XML OFX
+    yields (transaction number, amount, date, None) with the raw values of each STMTTRN,
+    OFX has no expense categories so the type is left to the importer's default
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    buffer = ""
+    transaction = None
+    number = 0
+    while True:
+        data = stream.read(block_size)
+        block = decoder.decode(data, final=not data)
+        parts = (buffer + block).split("<")
+        buffer = ""
+        if block:
+            # The text after the last "<" may be a tag cut in half, keep it for the next block
+            buffer = parts.pop()
+            if parts:
+                buffer = "<" + buffer
+        for part in parts:
+            tag, _, value = part.partition(">")
+            tag = tag.strip().upper()
+            if tag == "STMTTRN":
+                transaction = {}
+            elif tag == "/STMTTRN" and transaction is not None:
+                number += 1
+                yield number, transaction.get("TRNAMT"), transaction.get("DTPOSTED"), None
+                transaction = None
+            elif transaction is not None and not tag.startswith("/"):
+                transaction[tag] = value.strip()
+        if not block:
+            break
+
+
+def import_purchases(user_id, records, default_type="uncategorized", date_format=None,
+                     negative_is_expense=True, chunk_size=CHUNK_SIZE):
+    """
+    Validate and insert statement records for a user in chunks
+    With negative_is_expense (bank statements) negative amounts are debits, recorded as positive expenses,
+    and positive amounts are deposits, which are skipped; without it (credit card exports that list charges
+    as positive) positive amounts are expenses and negative ones, payments and refunds, are skipped
+    Records matching a purchase the user already had (same date, amount and type) are skipped
+    returns counts of imported, duplicate, skipped and invalid rows, the first errors, rows/sec
+    and the sign convention used
+    """
+    start = time.perf_counter()
+    result = {"rows": 0, "imported": 0, "duplicates": 0, "skipped": 0,
+              "error_count": 0, "errors": [], "negative_is_expense": negative_is_expense}
+    # Purchases inserted by this import are not duplicates of each other
+    last_existing_id = db.session.scalar(
+        db.select(db.func.max(Purchase.id)).where(Purchase.user_id == user_id)) or 0
+
+    chunk = []
+    for line, raw_amount, raw_date, raw_type in records:
+        result["rows"] += 1
+        try:
+            amount = parse_amount(decoded(raw_amount))
+            date = parse_date(decoded(raw_date), date_format)
+            expense_type = (decoded(raw_type) or "").strip() or default_type
+        except (ValueError, TypeError) as e:
+            result["error_count"] += 1
+            if len(result["errors"]) < MAX_REPORTED_ERRORS:
+                result["errors"].append({"row": line, "error": str(e)})
+            continue
+
+        if amount == 0 or (amount < 0) != negative_is_expense:
+            result["skipped"] += 1
+            continue
+
+        chunk.append({"user_id": user_id, "amount": abs(amount),
+                      "type": expense_type, "date": date})
+        if len(chunk) >= chunk_size:
+            insert_chunk(user_id, chunk, last_existing_id, result)
+            chunk = []
+    insert_chunk(user_id, chunk, last_existing_id, result)
+
+    seconds = time.perf_counter() - start
+    result["seconds"] = round(seconds, 3)
+    result["rows_per_second"] = round(result["rows"] / seconds, 1) if seconds > 0 else None
+    return result
+
+
+def insert_chunk(user_id, chunk, last_existing_id, result):
+    """
+    Insert one chunk of rows in its own transaction, leaving out rows the user already had
+    """
+    if not chunk:
+        return
+
+    existing = set(db.session.execute(
+        db.select(Purchase.date, Purchase.amount, Purchase.type)
+        .where(Purchase.user_id == user_id)
+        .where(Purchase.id <= last_existing_id)
+        .where(Purchase.date.between(min(row["date"] for row in chunk),
+                                     max(row["date"] for row in chunk)))).all())
+
+    rows = [row for row in chunk if (row["date"], row["amount"], row["type"]) not in existing]
+    insert_purchases(rows)
+    db.session.commit()
+    result["imported"] += len(rows)
+    result["duplicates"] += len(chunk) - len(rows)
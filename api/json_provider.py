@@ -0,0 +1,54 @@
+from datetime import date, datetime, timezone
+
+from flask.json.provider import DefaultJSONProvider
+
+# orjson is optional, the standard library encoder is used without it
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+WEEKDAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+
+def http_date(value):
+    """
+    Format a date or datetime like werkzeug's http_date, which Flask uses for dates in JSON,
+    without going through email.utils
+    Naive datetimes are taken as UTC
+    """
+    if not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    elif value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    return "%s, %02d %s %04d %02d:%02d:%02d GMT" % (
+        WEEKDAYS[value.weekday()], value.day, MONTHS[value.month - 1], value.year,
+        value.hour, value.minute, value.second)
+
+
+def default(o):
+    if isinstance(o, date):
+        return http_date(o)
+    return DefaultJSONProvider.default(o)
+
+
+class JSONProvider(DefaultJSONProvider):
+    """
+    Flask's JSON provider with a faster date formatter, and orjson when it is installed
+    Produces the same JSON as the default provider, dates included, except that orjson
+    writes non-ASCII characters as UTF-8 instead of \\u escapes
+    """
+
+    default = staticmethod(default)
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or set(kwargs) - {"separators", "indent"}:
+            return super().dumps(obj, **kwargs)
+
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get("indent"):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=default, option=option).decode()
@@ -0,0 +1,246 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from flask import current_app, g, has_app_context, has_request_context, request
+from sqlalchemy import event
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = ['%s="%s"' % (name, escape(value)) for name, value in list(zip(names, values)) + list(extra)]
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+
+class Histogram:
+    """
+    Prometheus histogram with a fixed set of labels
+    """
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # label values -> [per-bucket counts, sum, count]
+        self.series = {}
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.description), "# TYPE %s histogram" % self.name]
+        with self.lock:
+            for label_values, (counts, total, count) in sorted(self.series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(list(self.buckets) + ["+Inf"], counts):
+                    cumulative += bucket_count
+                    lines.append("%s_bucket%s %d" % (
+                        self.name, format_labels(self.labels, label_values, [("le", bound)]), cumulative))
+                lines.append("%s_sum%s %r" % (self.name, format_labels(self.labels, label_values), total))
+                lines.append("%s_count%s %d" % (self.name, format_labels(self.labels, label_values), count))
+        return lines
+
+
+class Counter:
+    """
+    Prometheus counter with a fixed set of labels
+    """
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.series[label_values] = self.series.get(label_values, 0) + amount
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.description), "# TYPE %s counter" % self.name]
+        with self.lock:
+            for label_values, value in sorted(self.series.items()):
+                lines.append("%s%s %r" % (self.name, format_labels(self.labels, label_values), value))
+        return lines
+
+
+class Metrics:
+    """
+    In-process request instrumentation
+    Records per-route latency, the number and time of SQL statements of each request,
+    OCR stage timings and outbound HTTP durations, rendered in the Prometheus text format
+    Requests slower than SLOW_REQUEST_THRESHOLD seconds are logged with their breakdown
+    Each gunicorn worker keeps its own metrics
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.request_duration = Histogram(
+            "http_request_duration_seconds", "Time spent handling a request", ("route", "method"))
+        self.requests = Counter(
+            "http_requests_total", "Requests handled", ("route", "method", "status"))
+        self.request_sql_queries = Histogram(
+            "http_request_sql_queries", "SQL statements executed by a request", ("route",), QUERY_COUNT_BUCKETS)
+        self.request_sql_duration = Histogram(
+            "http_request_sql_seconds", "Time a request spent in SQL statements", ("route",))
+        self.sql_duration = Histogram(
+            "sql_statement_duration_seconds", "Time spent executing a SQL statement")
+        self.ocr_duration = Histogram(
+            "ocr_stage_duration_seconds", "Time spent in each receipt OCR stage", ("stage",))
+        self.http_duration = Histogram(
+            "outbound_http_duration_seconds", "Time spent in outbound HTTP calls", ("upstream", "outcome"))
+        self.http_retries = Counter(
+            "outbound_http_retries_total", "Outbound HTTP attempts repeated after a failure", ("upstream",))
+        self.http_rejected = Counter(
+            "outbound_http_rejected_total", "Outbound HTTP calls refused by an open circuit breaker", ("upstream",))
+        self.slow_requests = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("SLOW_REQUEST_THRESHOLD", None)
+        app.extensions["metrics"] = self
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        self.app = app
+
+    def instrument_engine(self, engine):
+        """
+        Time every SQL statement run on engine and charge it to the current request
+        """
+
+        @event.listens_for(engine, "before_cursor_execute")
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault("metrics_query_start", []).append(time.perf_counter())
+
+        @event.listens_for(engine, "after_cursor_execute")
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            elapsed = time.perf_counter() - conn.info["metrics_query_start"].pop()
+            self.sql_duration.observe(elapsed)
+            breakdown = current_breakdown()
+            if breakdown is not None:
+                breakdown["sql_queries"] += 1
+                breakdown["sql_seconds"] += elapsed
+
+    def start_request(self):
+        g.metrics_start = time.perf_counter()
+        g.metrics_breakdown = {"sql_queries": 0, "sql_seconds": 0.0, "ocr_seconds": 0.0, "http_seconds": 0.0}
+
+    def finish_request(self, response):
+        start = g.pop("metrics_start", None)
+        breakdown = g.pop("metrics_breakdown", None)
+        if start is None:
+            return response
+
+        elapsed = time.perf_counter() - start
+        # Label by the matched rule rather than the path so ids in URLs don't create new series
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        self.request_duration.observe(elapsed, route, request.method)
+        self.requests.inc(route, request.method, str(response.status_code))
+        self.request_sql_queries.observe(breakdown["sql_queries"], route)
+        self.request_sql_duration.observe(breakdown["sql_seconds"], route)
+
+        threshold = self.app.config["SLOW_REQUEST_THRESHOLD"]
+        if threshold is not None and elapsed >= threshold:
+            self.slow_requests += 1
+            self.app.logger.warning(
+                "slow request %s %s %d: %.1f ms total, %d SQL statements in %.1f ms, OCR %.1f ms, HTTP %.1f ms",
+                request.method, request.path, response.status_code, elapsed * 1000,
+                breakdown["sql_queries"], breakdown["sql_seconds"] * 1000,
+                breakdown["ocr_seconds"] * 1000, breakdown["http_seconds"] * 1000)
+        return response
+
+    def observe_ocr(self, timings):
+        for stage, seconds in timings.items():
+            self.ocr_duration.observe(seconds, stage)
+        breakdown = current_breakdown()
+        if breakdown is not None:
+            breakdown["ocr_seconds"] += sum(timings.values())
+
+    def observe_http(self, upstream, seconds, outcome="ok"):
+        self.http_duration.observe(seconds, upstream, outcome)
+        breakdown = current_breakdown()
+        if breakdown is not None:
+            breakdown["http_seconds"] += seconds
+
+    def render(self, counters=()):
+        """
+        Returns the metrics in the Prometheus text format
+        counters is a list of extra (name, type, description, value) samples such as cache counters
+        """
+        lines = []
+        for metric in (self.request_duration, self.requests, self.request_sql_queries, self.request_sql_duration,
+                       self.sql_duration, self.ocr_duration, self.http_duration, self.http_retries,
+                       self.http_rejected):
+            lines.extend(metric.render())
+        for name, kind, description, value in list(counters) + [
+                ("slow_requests_total", "counter", "Requests logged as slow", self.slow_requests)]:
+            lines.extend(["# HELP %s %s" % (name, description), "# TYPE %s %s" % (name, kind),
+                          "%s %r" % (name, value)])
+        return "\n".join(lines) + "\n"
+
+
+def current_breakdown():
+    """
+    Returns the SQL/OCR/HTTP time breakdown of the request being handled, if any
+    """
+    return g.get("metrics_breakdown") if has_request_context() else None
+
+
+def current_metrics():
+    return current_app.extensions.get("metrics") if has_app_context() else None
+
+
+def record_ocr(timings):
+    """
+    Record the stage timings returned by scan_receipt with the current app's metrics
+    """
+    metrics = current_metrics()
+    if metrics is not None:
+        metrics.observe_ocr(timings)
+
+
+def record_http_retry(upstream):
+    metrics = current_metrics()
+    if metrics is not None:
+        metrics.http_retries.inc(upstream)
+
+
+def record_http_rejected(upstream):
+    metrics = current_metrics()
+    if metrics is not None:
+        metrics.http_rejected.inc(upstream)
+
+
+@contextmanager
+def timed_http(upstream):
+    """
+    Time an outbound HTTP call to upstream with the current app's metrics
+    """
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        metrics = current_metrics()
+        if metrics is not None:
+            metrics.observe_http(upstream, time.perf_counter() - start, outcome)
@@ -0,0 +1,143 @@
+import hashlib
+import io
+import threading
+from datetime import datetime, timedelta
+
+from db import db, ReceiptCacheEntry
+
+
+def perceptual_hash(data):
+    """
+    Difference hash of an image, stable across re-encoding and small resizes
+    Returns None if the bytes cannot be decoded as an image
+    """
+    from PIL import Image
+    import numpy as np
+
+    try:
+        img = Image.open(io.BytesIO(data))
+        # Let JPEG decode at a reduced scale, the hash only needs 9x8 pixels
+        img.draft("L", (64, 64))
+        pixels = np.asarray(img.convert("L").resize((9, 8)), dtype=np.int16)
+    except Exception:
+        return None
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return "%016x" % int("".join("1" if bit else "0" for bit in bits), 2)
+
+
+class ReceiptCache:
+    """
+    Content-addressed cache of receipt OCR results
+    Entries are stored in the receipt_cache table so they survive restarts, and are
+    evicted least recently used first past OCR_CACHE_MAX_ENTRIES or when older than OCR_CACHE_MAX_AGE
+    Only identical bytes are hits, with OCR_CACHE_PHASH an entry with the same perceptual hash is
+    a candidate whose total still has to be confirmed on the new image
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.phash_hits = 0
+        self.seconds_saved = 0.0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("OCR_CACHE_MAX_ENTRIES", 10000)
+        app.config.setdefault("OCR_CACHE_MAX_AGE", timedelta(days=30))
+        # Receipts of the same layout share a perceptual hash whatever their totals
+        app.config.setdefault("OCR_CACHE_PHASH", False)
+        app.extensions["receipt_cache"] = self
+        self.app = app
+
+    def keys(self, data):
+        """
+        Returns the (digest, phash) cache keys of the raw bytes of an image
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        phash = perceptual_hash(data) if self.app.config["OCR_CACHE_PHASH"] else None
+        return digest, phash
+
+    def lookup(self, keys):
+        """
+        Returns the cached entry for the exact bytes of the given keys, or None on a miss
+        """
+        digest, _ = keys
+        cutoff = datetime.now() - self.app.config["OCR_CACHE_MAX_AGE"]
+
+        entry = db.session.get(ReceiptCacheEntry, digest)
+        if entry is None or entry.created_at < cutoff:
+            with self.lock:
+                self.misses += 1
+            return None
+
+        entry.hits += 1
+        entry.last_used_at = datetime.now()
+        db.session.commit()
+        with self.lock:
+            self.hits += 1
+            self.seconds_saved += entry.ocr_seconds
+        return entry
+
+    def candidate(self, keys):
+        """
+        Returns the most recently used entry with the perceptual hash of the given keys, or None
+        Its total must not be used before confirm_total has read the same total on the new image
+        """
+        _, phash = keys
+        if phash is None:
+            return None
+        cutoff = datetime.now() - self.app.config["OCR_CACHE_MAX_AGE"]
+        return ReceiptCacheEntry.query.filter(
+            ReceiptCacheEntry.phash == phash, ReceiptCacheEntry.created_at >= cutoff).order_by(
+            ReceiptCacheEntry.last_used_at.desc()).first()
+
+    def confirmed(self):
+        """
+        Count a candidate whose total was confirmed on the new image
+        """
+        with self.lock:
+            self.phash_hits += 1
+
+    def store(self, keys, result):
+        """
+        Cache the scan_receipt result for the given keys and evict old entries
+        Does not commit, the entry is written with the caller's transaction
+        """
+        digest, phash = keys
+        now = datetime.now()
+        db.session.merge(ReceiptCacheEntry(digest=digest, phash=phash, total=result["total"],
+                                           text=result["text"], ocr_seconds=sum(result["timings"].values()),
+                                           created_at=now))
+        db.session.flush()
+
+        cutoff = now - self.app.config["OCR_CACHE_MAX_AGE"]
+        ReceiptCacheEntry.query.filter(ReceiptCacheEntry.created_at < cutoff).delete()
+        overflow = ReceiptCacheEntry.query.count() - self.app.config["OCR_CACHE_MAX_ENTRIES"]
+        if overflow > 0:
+            oldest = db.select(ReceiptCacheEntry.digest).order_by(
+                ReceiptCacheEntry.last_used_at).limit(overflow)
+            ReceiptCacheEntry.query.filter(ReceiptCacheEntry.digest.in_(oldest)).delete(
+                synchronize_session=False)
+
+    def stats(self):
+        """
+        Returns the hit/miss counters of this process and the totals stored in the table
+        """
+        entries, stored_hits, stored_seconds_saved = db.session.execute(db.select(
+            db.func.count(ReceiptCacheEntry.digest),
+            db.func.coalesce(db.func.sum(ReceiptCacheEntry.hits), 0),
+            db.func.coalesce(db.func.sum(ReceiptCacheEntry.hits * ReceiptCacheEntry.ocr_seconds), 0))).one()
+
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "phash_hits": self.phash_hits,
+                "seconds_saved": round(self.seconds_saved, 3),
+                "entries": entries,
+                "stored_hits": stored_hits,
+                "stored_seconds_saved": round(stored_seconds_saved, 3),
+            }
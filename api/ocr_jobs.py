@@ -0,0 +1,296 @@
+import io
+import os
+import queue
+import secrets
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+
+from db import db, ReceiptJob, insert_purchases
+from metrics import record_ocr
+
+
+class QueueFull(Exception):
+    """
+    Raised when too many receipts are already waiting for OCR
+    """
+
+
+def run_ocr(data, expected_total=None):
+    """
+    Worker process entry point
+    Reads the total amount and OCR text from the raw bytes of a receipt image
+    expected_total is the total of a cache candidate, when only the TOTAL lines read it again
+    the rest of the receipt is not read
+    """
+    from PIL import Image
+    from receipt import scan_receipt, confirm_total
+
+    img = Image.open(io.BytesIO(data))
+    if expected_total is not None:
+        result = confirm_total(img, expected_total)
+        if result is not None:
+            return result
+    return scan_receipt(img)
+
+
+class ReceiptJobQueue:
+    """
+    Runs receipt OCR on a bounded process pool instead of inside the request
+    Job state is kept in the receipt_job table so every web worker can report on it, results are
+    recorded by a finisher thread of the web worker and jobs still pending after OCR_JOB_TIMEOUT fail
+    Receipts already in the cache are answered without running OCR again, and a cache entry
+    found by perceptual hash is only used once OCR of the TOTAL lines confirms its total
+    """
+
+    def __init__(self, app=None, cache=None):
+        self.app = None
+        self.cache = cache
+        self.executor = None
+        self.finished = queue.Queue()
+        self.finisher = None
+        self.pending = 0
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        # OCR_HOST_WORKERS processes are shared between the host's web workers, WEB_CONCURRENCY
+        # of them under gunicorn, instead of every web worker starting one per CPU
+        host_workers = int(os.environ.get("OCR_HOST_WORKERS", os.cpu_count() or 1))
+        web_workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+        app.config.setdefault("OCR_WORKERS", max(1, host_workers // web_workers))
+        app.config.setdefault("OCR_MAX_PENDING", 16)
+        app.config.setdefault("OCR_JOB_TIMEOUT", timedelta(minutes=5))
+        app.config.setdefault("OCR_JOB_RETENTION", timedelta(days=1))
+        app.extensions["receipt_jobs"] = self
+        self.app = app
+
+    def reserve(self, count=1):
+        """
+        Claim room for count receipts in the queue and return the process pool
+        Raises QueueFull when the queue-depth limit would be exceeded
+        """
+        with self.lock:
+            if self.pending + count > self.app.config["OCR_MAX_PENDING"]:
+                raise QueueFull()
+            self.pending += count
+            return self.pool()
+
+    def pool(self):
+        """
+        Returns the process pool, starting it and the finisher thread when needed, the lock must be held
+        """
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.app.config["OCR_WORKERS"])
+        if self.finisher is None or not self.finisher.is_alive():
+            self.finisher = threading.Thread(target=self.run_finisher, daemon=True)
+            self.finisher.start()
+        return self.executor
+
+    def release(self, count=1):
+        with self.lock:
+            self.pending -= count
+
+    def run(self, executor, data, expected_total):
+        """
+        Submit OCR of a receipt to executor, or to a new pool if a worker that died has broken it
+        returns the future and the pool it runs on
+        """
+        try:
+            return executor.submit(run_ocr, data, expected_total), executor
+        except BrokenProcessPool:
+            self.reset(executor)
+            with self.lock:
+                executor = self.pool()
+            return executor.submit(run_ocr, data, expected_total), executor
+
+    def submit(self, data, user_id, expense_type):
+        """
+        Queue a receipt image for OCR and return the id of its job
+        The purchase is recorded for user_id once the total has been read
+        """
+        job = ReceiptJob(id=secrets.token_urlsafe(16), user_id=user_id,
+                         type=expense_type, created_at=datetime.now())
+        keys = None
+        expected_total = None
+        if self.cache is not None:
+            keys = self.cache.keys(data)
+            entry = self.cache.lookup(keys)
+            if entry is not None:
+                db.session.add(job)
+                self.complete(job, entry.total)
+                db.session.commit()
+                return job.id
+            candidate = self.cache.candidate(keys)
+            expected_total = candidate.total if candidate is not None else None
+
+        executor = self.reserve()
+        try:
+            db.session.add(job)
+            db.session.commit()
+            future, executor = self.run(executor, data, expected_total)
+        except Exception:
+            self.release()
+            raise
+
+        job_id = job.id
+        # The callback runs on the pool's management thread, which must not wait on the database
+        future.add_done_callback(lambda future: self.finished.put((job_id, keys, future, executor)))
+        return job_id
+
+    def scan_many(self, blobs):
+        """
+        Read the totals of many receipt images in parallel on the process pool and wait for all of them
+        returns one (total, error) pair per image, in order
+        Cache entries for new results are added to the session without committing
+        """
+        results = [None] * len(blobs)
+        keys = [None] * len(blobs)
+        expected_totals = [None] * len(blobs)
+        misses = []
+        for i, data in enumerate(blobs):
+            if self.cache is not None:
+                keys[i] = self.cache.keys(data)
+                entry = self.cache.lookup(keys[i])
+                if entry is not None:
+                    results[i] = (entry.total, None)
+                    continue
+                candidate = self.cache.candidate(keys[i])
+                if candidate is not None:
+                    expected_totals[i] = candidate.total
+            misses.append(i)
+
+        # Batches larger than the queue are read a queue's worth at a time, so an idle server takes any batch
+        chunk_size = self.app.config["OCR_MAX_PENDING"]
+        for start in range(0, len(misses), chunk_size):
+            chunk = misses[start:start + chunk_size]
+            executor = self.reserve(len(chunk))
+            try:
+                futures = []
+                for i in chunk:
+                    future, executor = self.run(executor, blobs[i], expected_totals[i])
+                    futures.append((i, future, executor))
+                for i, future, executor in futures:
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool:
+                        self.reset(executor)
+                        results[i] = (None, "receipt could not be processed")
+                        continue
+                    except Exception:
+                        results[i] = (None, "receipt could not be processed")
+                        continue
+                    record_ocr(result["timings"])
+                    results[i] = (result["total"], None)
+                    if self.cache is not None:
+                        self.store(keys[i], result)
+            finally:
+                self.release(len(chunk))
+
+        return [(total, error or ("total not found" if total is None else None))
+                for total, error in results]
+
+    def store(self, keys, result):
+        """
+        Cache an OCR result, a confirmed candidate is counted as a perceptual hash hit
+        """
+        if result["mode"] == "confirmed":
+            self.cache.confirmed()
+        self.cache.store(keys, result)
+
+    def complete(self, job, amount, error=None):
+        """
+        Mark a new job as finished and record the purchase if a total was found
+        """
+        if amount is None:
+            job.status = "failed"
+            job.error = error or "total not found"
+        else:
+            job.status = "done"
+            job.amount = amount
+            if job.user_id is not None:
+                insert_purchases([{"user_id": job.user_id, "amount": amount,
+                                   "type": job.type, "date": job.created_at}])
+        job.finished_at = datetime.now()
+
+    def settle(self, job_id, amount, error=None, created_before=None):
+        """
+        Finish a pending job and record the purchase if a total was found, in the caller's transaction
+        Only a job still pending is updated, so OCR and expiry cannot both finish it: whichever commits
+        first wins and the other changes nothing. Returns False if the job was no longer pending
+        """
+        if amount is None:
+            values = {"status": "failed", "error": error or "total not found"}
+        else:
+            values = {"status": "done", "amount": amount}
+        query = (db.update(ReceiptJob.__table__)
+                 .where(ReceiptJob.id == job_id)
+                 .where(ReceiptJob.status == "pending"))
+        if created_before is not None:
+            query = query.where(ReceiptJob.created_at < created_before)
+        if db.session.execute(query.values(finished_at=datetime.now(), **values)).rowcount != 1:
+            return False
+
+        if amount is not None:
+            job = db.session.execute(db.select(ReceiptJob.user_id, ReceiptJob.type, ReceiptJob.created_at)
+                                     .where(ReceiptJob.id == job_id)).one()
+            if job.user_id is not None:
+                insert_purchases([{"user_id": job.user_id, "amount": amount,
+                                   "type": job.type, "date": job.created_at}])
+        return True
+
+    def expire(self, job):
+        """
+        Fail a job still pending after OCR_JOB_TIMEOUT, its result was lost with the worker that ran it
+        Returns True if the job was expired, the caller commits
+        """
+        cutoff = datetime.now() - self.app.config["OCR_JOB_TIMEOUT"]
+        if job.status != "pending" or job.created_at >= cutoff:
+            return False
+        return self.settle(job.id, None, "receipt was not read in time", created_before=cutoff)
+
+    def run_finisher(self):
+        """
+        Record the outcome of every finished OCR job in turn
+        """
+        while True:
+            self.finish(*self.finished.get())
+
+    def finish(self, job_id, keys, future, executor):
+        """
+        Record the outcome of an OCR job, runs on the finisher thread
+        A job that has expired or been deleted in the meantime is left as it is
+        """
+        try:
+            with self.app.app_context():
+                try:
+                    result = future.result()
+                except BrokenProcessPool:
+                    self.reset(executor)
+                    self.settle(job_id, None, "receipt could not be processed")
+                except Exception:
+                    self.settle(job_id, None, "receipt could not be processed")
+                else:
+                    record_ocr(result["timings"])
+                    self.settle(job_id, result["total"])
+                    if self.cache is not None:
+                        self.store(keys, result)
+
+                cutoff = datetime.now() - self.app.config["OCR_JOB_RETENTION"]
+                ReceiptJob.query.filter(ReceiptJob.finished_at < cutoff).delete()
+                db.session.commit()
+        except Exception:
+            self.app.logger.exception("failed to record receipt job %s", job_id)
+        finally:
+            self.release()
+
+    def reset(self, executor):
+        """
+        Drop a process pool whose worker died so the next receipt starts a new one
+        """
+        with self.lock:
+            if self.executor is executor:
+                executor.shutdown(wait=False)
+                self.executor = None
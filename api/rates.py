@@ -0,0 +1,190 @@
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+
+from db import db, ExchangeRates
+
+
+# Currency the stored purchase amounts and the upstream rates are expressed in
+BASE_CURRENCY = "USD"
+
+
+def convert_amounts(rates, amounts, from_codes, to_codes):
+    """
+    Convert many amounts at once
+    from_codes and to_codes hold one currency code per amount
+    raises KeyError naming the first unknown currency
+    """
+    import numpy as np
+
+    codes = sorted(set(from_codes) | set(to_codes))
+    for code in codes:
+        if not rates.get(code):
+            raise KeyError(code)
+
+    # Map every code to its position in a small rate table, then convert with one vector operation
+    table = np.array([rates[code] for code in codes], dtype=np.float64)
+    index = {code: i for i, code in enumerate(codes)}
+    from_rates = table[np.fromiter((index[code] for code in from_codes), dtype=np.intp, count=len(from_codes))]
+    to_rates = table[np.fromiter((index[code] for code in to_codes), dtype=np.intp, count=len(to_codes))]
+    return np.round(np.asarray(amounts, dtype=np.float64) * to_rates / from_rates, 2).tolist()
+
+
+class ExchangeRateStore:
+    """
+    Exchange rates shared by every worker through the exchange_rates table
+    Rates older than EXCHANGE_RATE_TTL are still served while a single background
+    refresh fetches new ones, and keep being served if that refresh fails
+    """
+
+    def __init__(self, app=None, http=None):
+        self.app = None
+        self.http = http
+        self.lock = threading.Lock()
+        self.thread = None
+        self.refreshes = 0
+        self.failures = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("CURRENCY_API_URL", "https://api.freecurrencyapi.com/v1/latest")
+        app.config.setdefault("CURRENCY_API_KEY", os.environ.get('CURRENCY_API_KEY'))
+        app.config.setdefault("EXCHANGE_RATE_TTL", timedelta(days=1))
+        # How long a refresh may hold the lease, and how long to wait after a failed one
+        app.config.setdefault("EXCHANGE_RATE_REFRESH_TIMEOUT", timedelta(seconds=30))
+        app.config.setdefault("EXCHANGE_RATE_RETRY_DELAY", timedelta(minutes=1))
+        app.extensions["exchange_rates"] = self
+        self.app = app
+
+    def fetch(self):
+        """
+        Fetch the latest rates from the upstream API
+        The 'data' dictionary holds exchange rates for various currencies,
+        with the US Dollar (USD) as the base currency
+        """
+        # Every attempt, retries included, has to fit in the refresh lease
+        timeout = (self.app.config["EXCHANGE_RATE_REFRESH_TIMEOUT"].total_seconds()
+                   / (self.app.config["HTTP_RETRIES"] + 1))
+        response = self.http.get("currency_api", self.app.config["CURRENCY_API_URL"],
+                                 params={"apikey": self.app.config["CURRENCY_API_KEY"]},
+                                 timeout=(min(timeout, self.app.config["HTTP_CONNECT_TIMEOUT"]), timeout))
+        response.raise_for_status()
+        rates = response.json().get('data')
+        if not rates:
+            raise ValueError("no rates in upstream response")
+        return rates
+
+    def acquire_lease(self, now):
+        """
+        Claim the right to refresh the rates across all workers
+        Returns True if no other refresh holds the lease
+        """
+        lease = now + self.app.config["EXCHANGE_RATE_REFRESH_TIMEOUT"]
+        db.session.execute(db.insert(ExchangeRates.__table__).prefix_with("OR IGNORE").values(id=1))
+        claimed = db.session.execute(
+            db.update(ExchangeRates.__table__)
+            .where(ExchangeRates.id == 1)
+            .where(db.or_(ExchangeRates.refresh_until.is_(None), ExchangeRates.refresh_until < now))
+            .values(refresh_until=lease)).rowcount == 1
+        db.session.commit()
+        return claimed
+
+    def refresh(self):
+        """
+        Fetch new rates and store them, the caller must hold the lease
+        On failure the old rates are kept and the lease is held until the retry delay has passed
+        """
+        try:
+            rates = self.fetch()
+        except Exception as e:
+            self.app.logger.warning("exchange rate refresh failed: %s", e)
+            with self.lock:
+                self.failures += 1
+            db.session.execute(
+                db.update(ExchangeRates.__table__)
+                .where(ExchangeRates.id == 1)
+                .values(refresh_until=datetime.now() + self.app.config["EXCHANGE_RATE_RETRY_DELAY"],
+                        last_error=str(e)))
+            db.session.commit()
+            return None
+
+        with self.lock:
+            self.refreshes += 1
+        db.session.execute(
+            db.update(ExchangeRates.__table__)
+            .where(ExchangeRates.id == 1)
+            .values(rates=json.dumps(rates), fetched_at=datetime.now(),
+                    refresh_until=None, last_error=None))
+        db.session.commit()
+        return rates
+
+    def refresh_in_background(self):
+        """
+        Start a refresh on a background thread unless one is already running in any worker
+        """
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            if not self.acquire_lease(datetime.now()):
+                return
+            self.thread = threading.Thread(target=self.run_refresh, daemon=True)
+            self.thread.start()
+
+    def run_refresh(self):
+        with self.app.app_context():
+            self.refresh()
+
+    def get_rates(self):
+        """
+        Returns the USD based rates, or None if none could ever be fetched
+        Stale rates trigger a background refresh and are returned as they are
+        """
+        now = datetime.now()
+        row = db.session.get(ExchangeRates, 1)
+        # While another refresh holds the lease there is nothing to claim, so skip the write that would find out
+        leased = row is not None and row.refresh_until is not None and row.refresh_until > now
+        if row is None or row.rates is None:
+            # Nothing to serve yet, so this request has to wait for the rates
+            if not leased and self.acquire_lease(now):
+                return self.refresh()
+            return None
+
+        if not leased and now - row.fetched_at >= self.app.config["EXCHANGE_RATE_TTL"]:
+            self.refresh_in_background()
+        return json.loads(row.rates)
+
+    def version(self):
+        """
+        Returns a value that changes whenever new rates are stored
+        """
+        return db.session.scalar(db.select(ExchangeRates.fetched_at).where(ExchangeRates.id == 1))
+
+    def rate(self, from_code, to_code):
+        """
+        Returns the rate converting from_code amounts into to_code
+        raises LookupError if the rates are unavailable or a currency is unknown
+        """
+        rates = self.get_rates()
+        if rates is None:
+            raise LookupError("exchange rates are unavailable")
+        if not rates.get(from_code) or rates.get(to_code) is None:
+            raise LookupError("unknown currency")
+        return rates[to_code] / rates[from_code]
+
+    def status(self):
+        """
+        Returns the age of the shared rates and the refresh counters of this process
+        """
+        row = db.session.get(ExchangeRates, 1)
+        fetched_at = row.fetched_at if row is not None else None
+        with self.lock:
+            return {
+                "ttl_seconds": self.app.config["EXCHANGE_RATE_TTL"].total_seconds(),
+                "age_seconds": (datetime.now() - fetched_at).total_seconds() if fetched_at else None,
+                "refreshing": self.thread is not None and self.thread.is_alive(),
+                "refreshes": self.refreshes,
+                "failures": self.failures,
+                "last_error": row.last_error if row is not None else None,
+            }
@@ -1,22 +1,34 @@
-from PIL import Image
+from PIL import Image, ImageOps
 import pytesseract
 import numpy as np
 import os
+import time
 from dotenv import load_dotenv
 
 load_dotenv()
 
 pytesseract.pytesseract.tesseract_cmd = os.getenv('TESSERACT_PATH')
 
-def get_total_amount(img):
+# Both are off until `python api/receipt.py` shows they read the same totals as the raw path on test/receipts
+# Set RECEIPT_PREPROCESS=1 to orient, crop, downscale and binarize the image before tesseract
+PREPROCESS = os.getenv('RECEIPT_PREPROCESS', '0') == '1'
+# Resolution tesseract is given, it reads printed text well at 300 DPI
+TARGET_DPI = int(os.getenv('RECEIPT_TARGET_DPI', '300'))
+# Set RECEIPT_TWO_PASS=1 to read only the TOTAL lines at full quality when a cheap pass finds them
+TWO_PASS = os.getenv('RECEIPT_TWO_PASS', '0') == '1'
+# Width the receipt is shrunk to for the cheap passes that locate the content and the TOTAL lines
+LOCATE_WIDTH = 500
+# Width of a standard 80mm thermal receipt, used to estimate the DPI of a photo
+RECEIPT_WIDTH_INCHES = 3.15
+
+def parse_total(text):
     """
-    Using OCR, gets the total amount from a receipt image
+    Gets the total amount from the OCR text of a receipt
     returns None if no total amount is found
     """
-    img = np.array(img)
-    text = pytesseract.image_to_string(img)
     text = text.upper()
     total_arr = text.split("TOTAL")
+    total = None
     try:
         for i in reversed(range(len(total_arr))):
             # logic to get the total amount
@@ -25,24 +37,262 @@ def get_total_amount(img):
             # attemping to remove the first character that is not a nunber (ex: $)
             # Then remove all the commas, values after \n, whitespaces around it, and one period to get raw number
             # If that raw number is a digit, then that is the total
+            if not total_arr[i].strip():
+                continue
             if not total_arr[i].strip()[0].isdigit():
                 total_arr[i] = total_arr[i].strip()[1:]
             if total_arr[i].replace(",","").split("\n")[0].strip().replace('.','',1).isdigit():
                 total = total_arr[i].replace(",","").split("\n")[0].strip()
                 break
         total = float(total)
-    except ValueError:
+    except (ValueError, TypeError):
         total = None
     return total
 
 
+def otsu_threshold(pixels):
+    """
+    Gets the grayscale level that best separates ink from paper (Otsu's method)
+    """
+    hist = np.bincount(pixels.ravel(), minlength=256).astype(np.float64)
+    weight = np.cumsum(hist)
+    mean = np.cumsum(hist * np.arange(256))
+    total_weight, total_mean = weight[-1], mean[-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        between = (total_mean * weight - mean * total_weight) ** 2 / (weight * (total_weight - weight))
+    if np.isnan(between).all():
+        # A single gray level has nothing to separate, keep it all as paper
+        return max(int(pixels.min()) - 1, 0)
+    return int(np.nanargmax(between))
+
+
+def content_bounds(dark, margin):
+    """
+    Gets the (start, end) of the rows holding receipt content
+    Rows with no ink are blank paper and rows that are almost all dark are background
+    """
+    coverage = dark.mean(axis=1)
+    rows = np.flatnonzero((coverage > 0) & (coverage < 0.95))
+    if rows.size == 0:
+        return 0, dark.shape[0]
+    return max(rows[0] - margin, 0), min(rows[-1] + margin + 1, dark.shape[0])
+
+
+def content_box(img, margin=5):
+    """
+    Gets the (left, top, right, bottom) box of the receipt content in img
+    The bounds are found on a binarized copy LOCATE_WIDTH wide, so they are cheap at any resolution
+    """
+    scale = min(1.0, LOCATE_WIDTH / img.width)
+    probe = img
+    if scale < 1:
+        probe = img.resize((round(img.width * scale), max(round(img.height * scale), 1)), reducing_gap=2.0)
+    pixels = np.asarray(ImageOps.autocontrast(probe.convert("L"), cutoff=1))
+    dark = pixels <= otsu_threshold(pixels)
+    top, bottom = content_bounds(dark, margin)
+    left, right = content_bounds(dark.T, margin)
+    return (int(left / scale), int(top / scale),
+            min(int(np.ceil(right / scale)), img.width), min(int(np.ceil(bottom / scale)), img.height))
+
+
+def preprocess_image(img, target_dpi=TARGET_DPI, binarize=True, crop_borders=True):
+    """
+    Prepares a receipt photo for tesseract
+    Rotates it upright from its EXIF orientation, crops the borders, downscales it so the receipt
+    is at target_dpi, converts it to grayscale, stretches the contrast and binarizes it
+    The borders are cropped first so the scale comes from the width of the receipt rather than the photo
+    returns the processed image and the time spent on each step in seconds
+    """
+    timings = {}
+
+    start = time.perf_counter()
+    img = ImageOps.exif_transpose(img)
+    timings["orient"] = time.perf_counter() - start
+
+    if crop_borders:
+        start = time.perf_counter()
+        img = img.crop(content_box(img))
+        timings["crop"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    scale = target_dpi * RECEIPT_WIDTH_INCHES / img.width
+    if scale < 1:
+        img = img.resize((round(img.width * scale), round(img.height * scale)),
+                         Image.LANCZOS, reducing_gap=3.0)
+    timings["downscale"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    img = img.convert("L")
+    timings["grayscale"] = time.perf_counter() - start
+
+    if binarize:
+        start = time.perf_counter()
+        pixels = np.asarray(ImageOps.autocontrast(img, cutoff=1))
+        pixels = np.where(pixels > otsu_threshold(pixels), 255, 0).astype(np.uint8)
+        img = Image.fromarray(pixels)
+        timings["binarize"] = time.perf_counter() - start
+
+    return img, timings
+
+
+def locate_total_lines(img):
+    """
+    Finds the words containing TOTAL with a cheap OCR pass over a low resolution copy of the receipt
+    returns their bounding boxes (left, top, right, bottom) in full resolution coordinates, top to bottom
+    """
+    scale = min(1.0, LOCATE_WIDTH / img.width)
+    if scale < 1:
+        img = img.resize((round(img.width * scale), round(img.height * scale)), reducing_gap=2.0)
+
+    data = pytesseract.image_to_data(np.array(img), output_type=pytesseract.Output.DICT)
+    boxes = []
+    for i, word in enumerate(data["text"]):
+        if "TOTAL" in word.upper():
+            left, top = data["left"][i] / scale, data["top"][i] / scale
+            right = left + data["width"][i] / scale
+            bottom = top + data["height"][i] / scale
+            boxes.append((left, top, right, bottom))
+    return sorted(boxes, key=lambda box: box[1])
+
+
+def read_total_line(img, box):
+    """
+    Runs full quality OCR on the line of a TOTAL keyword, from the keyword to the right edge
+    returns the OCR text of that line
+    """
+    left, top, right, bottom = box
+    pad = (bottom - top) / 2
+    line = img.crop((max(int(left - pad), 0), max(int(top - pad), 0),
+                     img.width, min(int(bottom + pad) + 1, img.height)))
+    # Page segmentation mode 7 treats the image as a single line of text
+    return pytesseract.image_to_string(np.array(line), config="--psm 7")
+
+
+def read_total_lines(img, timings):
+    """
+    Reads the total from the TOTAL lines found by a low resolution pass, without reading the whole receipt
+    Like the full page parser, the last TOTAL followed by a number wins
+    returns the total (None if no TOTAL line holds one) and the text of its line, and adds the time
+    spent on each step to timings
+    """
+    start = time.perf_counter()
+    boxes = locate_total_lines(img)
+    timings["locate"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    total, text = None, ""
+    for box in reversed(boxes):
+        text = read_total_line(img, box)
+        total = parse_total(text)
+        if total is not None:
+            break
+    timings["total_line"] = time.perf_counter() - start
+    return total, text
+
+
+def confirm_total(img, expected, preprocess=None):
+    """
+    Checks that the total of a receipt is expected by reading only its TOTAL lines
+    Used for cache entries found by perceptual hash, which receipts of the same layout share
+    whatever their totals
+    returns a scan_receipt result if the total read is expected, None otherwise
+    """
+    if preprocess is None:
+        preprocess = PREPROCESS
+
+    timings = {}
+    if preprocess:
+        img, steps = preprocess_image(img)
+        timings.update(("preprocess_" + step, seconds) for step, seconds in steps.items())
+
+    total, text = read_total_lines(img, timings)
+    if total is None or round(total, 2) != round(expected, 2):
+        return None
+    return {
+        "total": total,
+        "text": text,
+        "mode": "confirmed",
+        "timings": timings,
+    }
+
+
+def scan_receipt(img, preprocess=None, two_pass=None):
+    """
+    Runs OCR on a receipt image, after the preprocessing pipeline unless preprocess is False
+    In two-pass mode only the TOTAL lines found by a low resolution pass are read at full quality,
+    the whole receipt is read if none of them holds a total
+    preprocess and two_pass default to the RECEIPT_PREPROCESS and RECEIPT_TWO_PASS settings
+    returns the total amount (None if not found), the OCR text, the mode used and the time spent on each step in seconds
+    """
+    if preprocess is None:
+        preprocess = PREPROCESS
+    if two_pass is None:
+        two_pass = TWO_PASS
+
+    timings = {}
+    if preprocess:
+        img, steps = preprocess_image(img)
+        timings.update(("preprocess_" + step, seconds) for step, seconds in steps.items())
+
+    if two_pass:
+        total, text = read_total_lines(img, timings)
+        if total is not None:
+            return {
+                "total": total,
+                "text": text,
+                "mode": "two_pass",
+                "timings": timings,
+            }
+
+    start = time.perf_counter()
+    text = pytesseract.image_to_string(np.array(img))
+    timings["ocr"] = time.perf_counter() - start
+    return {
+        "total": parse_total(text),
+        "text": text,
+        "mode": "full_page",
+        "timings": timings,
+    }
+
+
+def get_total_amount(img):
+    """
+    Using OCR, gets the total amount from a receipt image
+    returns None if no total amount is found
+    """
+    return scan_receipt(img)["total"]
+
+
 # For testing purposes
+# Compares the preprocessing pipeline and two-pass mode with the raw full page path on every test receipt
 if __name__ == '__main__':
+    variants = {
+        "raw": {"preprocess": False, "two_pass": False},
+        "preprocessed": {"preprocess": True, "two_pass": False},
+        "two-pass": {"preprocess": True, "two_pass": True},
+    }
     directory = os.fsencode('test/receipts')
-    for file in os.listdir(directory):
+    latency = {name: [] for name in variants}
+    changed = {name: 0 for name in variants}
+    for file in sorted(os.listdir(directory)):
         filename = os.fsdecode(file)
         if filename.endswith(".jpg") or filename.endswith(".png"):
             img = Image.open('test/receipts/' + filename)
-            print(get_total_amount(img))
-    
-
+            img.load()
+            print(filename)
+            baseline = None
+            for name, options in variants.items():
+                result = scan_receipt(img, **options)
+                seconds = sum(result["timings"].values())
+                if baseline is None:
+                    baseline = result["total"]
+                latency[name].append(seconds)
+                changed[name] += result["total"] != baseline
+                print("  %s: %s in %.3fs%s (%s)" % (
+                    name, result["total"], seconds,
+                    "" if result["total"] == baseline else " (total changed)",
+                    ", ".join("%s %.3fs" % step for step in result["timings"].items())))
+    if latency["raw"]:
+        for name in variants:
+            print("%s: mean latency %.3fs, total changed on %d of %d receipts" % (
+                name, np.mean(latency[name]), changed[name], len(latency[name])))
@@ -0,0 +1,170 @@
+import base64
+from datetime import datetime, time
+from db import db, Purchase, DailyRollup, MonthlyRollup, PURCHASE_ITEMS_LOADER
+
+# Number of purchases fetched from the database at a time when exporting
+EXPORT_BATCH_SIZE = 1000
+
+# strftime formats used to bucket purchases by period in SQLite
+PERIOD_FORMATS = {
+    "day": "%Y-%m-%d",
+    "week": "%Y-W%W",
+    "month": "%Y-%m",
+}
+
+
+def purchase_filters(user_id, since=None, until=None, expense_type=None):
+    """
+    Build the WHERE conditions shared by the expense queries
+    since is inclusive, until is exclusive
+    """
+    conditions = [Purchase.user_id == user_id]
+    if since is not None:
+        conditions.append(Purchase.date >= since)
+    if until is not None:
+        conditions.append(Purchase.date < until)
+    if expense_type is not None:
+        conditions.append(Purchase.type == expense_type)
+    return conditions
+
+
+def is_aligned(value, month=False):
+    """
+    Whether a range bound falls on midnight, and on the first of a month if month is True
+    """
+    return value is None or (value.time() == time.min and (not month or value.day == 1))
+
+
+def summary_source(user_id, period, since, until, expense_type):
+    """
+    Choose what a summary aggregates: the monthly rollups when the range covers whole months,
+    the daily rollups when it covers whole days, the purchase rows otherwise
+    returns the WHERE conditions, type column, period bucket, total and count expressions
+    Totals are cast to REAL on every path, the rollups store them as REAL and SQLite sums
+    whole amounts to an integer, so the same summary does not change type with the range
+    """
+    if period == "month" and is_aligned(since, month=True) and is_aligned(until, month=True):
+        model, key, bucket = MonthlyRollup, MonthlyRollup.month, MonthlyRollup.month
+        bound = lambda value: value.strftime("%Y-%m")
+    elif is_aligned(since) and is_aligned(until):
+        model, key = DailyRollup, DailyRollup.day
+        bucket = db.func.strftime(PERIOD_FORMATS[period], DailyRollup.day)
+        bound = lambda value: value.date()
+    else:
+        return (purchase_filters(user_id, since, until, expense_type), Purchase.type,
+                db.func.strftime(PERIOD_FORMATS[period], Purchase.date),
+                db.cast(db.func.coalesce(db.func.sum(Purchase.amount), 0), db.Float), db.func.count(Purchase.id))
+
+    conditions = [model.user_id == user_id]
+    if since is not None:
+        conditions.append(key >= bound(since))
+    if until is not None:
+        conditions.append(key < bound(until))
+    if expense_type is not None:
+        conditions.append(model.type == expense_type)
+    return (conditions, model.type, bucket,
+            db.cast(db.func.coalesce(db.func.sum(model.total), 0), db.Float),
+            db.func.coalesce(db.func.sum(model.count), 0))
+
+
+def summarize_purchases(user_id, period="month", since=None, until=None, expense_type=None):
+    """
+    Aggregate a user's purchases in SQL, from the rollup tables whenever the date range allows
+    Returns the overall total and count, totals per type and totals per period
+    """
+    conditions, type_column, bucket, total, count = summary_source(
+        user_id, period, since, until, expense_type)
+
+    overall_total, overall_count = db.session.execute(
+        db.select(total, count).where(*conditions)).one()
+
+    by_type = db.session.execute(
+        db.select(type_column, total, count)
+        .where(*conditions)
+        .group_by(type_column)
+        .order_by(total.desc())).all()
+
+    by_period = db.session.execute(
+        db.select(bucket, total, count)
+        .where(*conditions)
+        .group_by(bucket)
+        .order_by(bucket)).all()
+
+    return {
+        "total": overall_total,
+        "count": overall_count,
+        "period": period,
+        "by_type": [{"type": row[0], "total": row[1], "count": row[2]} for row in by_type],
+        "by_period": [{"period": row[0], "total": row[1], "count": row[2]} for row in by_period],
+    }
+
+
+def encode_cursor(purchase):
+    """
+    Encode the (date, id) position of a purchase as an opaque cursor token
+    """
+    position = "%s|%d" % (purchase.date.isoformat(), purchase.id)
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(token):
+    """
+    Decode a cursor token back into (date, id), raises ValueError if it is malformed
+    """
+    try:
+        date, purchase_id = base64.urlsafe_b64decode(token.encode()).decode().split("|")
+        return datetime.fromisoformat(date), int(purchase_id)
+    except (TypeError, UnicodeDecodeError, base64.binascii.Error) as e:
+        raise ValueError("invalid cursor") from e
+
+
+def list_purchases(user_id, limit, cursor=None, since=None, until=None, expense_type=None):
+    """
+    Return one page of a user's purchases, newest first
+    Pages are keyed on (date, id) so each page is a single index range scan
+    Returns (purchases, next_cursor), next_cursor is None on the last page
+    """
+    conditions = purchase_filters(user_id, since, until, expense_type)
+    if cursor is not None:
+        cursor_date, cursor_id = decode_cursor(cursor)
+        conditions.append(db.or_(
+            Purchase.date < cursor_date,
+            db.and_(Purchase.date == cursor_date, Purchase.id < cursor_id)))
+
+    # Fetch one extra row to know whether another page follows
+    purchases = db.session.execute(
+        db.select(Purchase)
+        .where(*conditions)
+        .order_by(Purchase.date.desc(), Purchase.id.desc())
+        .limit(limit + 1)
+        .options(PURCHASE_ITEMS_LOADER)).scalars().all()
+
+    if len(purchases) > limit:
+        purchases = purchases[:limit]
+        return purchases, encode_cursor(purchases[-1])
+    return purchases, None
+
+
+def all_purchases(user_id):
+    """
+    Return every purchase of a user with items eagerly loaded, oldest first
+    """
+    return db.session.execute(
+        db.select(Purchase)
+        .where(Purchase.user_id == user_id)
+        .order_by(Purchase.id)
+        .options(PURCHASE_ITEMS_LOADER)).scalars().all()
+
+
+def iter_purchases(user_id, since=None, until=None, expense_type=None, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yield the (id, date, amount, type) rows of a user's purchases, oldest first
+    Rows are fetched batch_size at a time, so the full history is never held in memory
+    """
+    result = db.session.execute(
+        db.select(Purchase.id, Purchase.date, Purchase.amount, Purchase.type)
+        .where(*purchase_filters(user_id, since, until, expense_type))
+        .order_by(Purchase.date, Purchase.id)
+        .execution_options(yield_per=batch_size))
+    for partition in result.partitions():
+        yield partition
@@ -0,0 +1,111 @@
+import threading
+import time
+from collections import OrderedDict
+
+from flask_login import UserMixin
+from sqlalchemy import event
+
+from db import db, User
+
+
+class CachedUser(UserMixin):
+    """
+    Lightweight, session-independent copy of a user row kept in the user cache
+    """
+
+    def __init__(self, id, username):
+        self.id = id
+        self.username = username
+
+    def serialize(self):
+        """
+        Serialize a cached user
+        """
+
+        return {
+            "id": self.id,
+            "username": self.username,
+        }
+
+
+class UserCache:
+    """
+    Bounded LRU cache of the users loaded by flask-login, so authenticated requests do not
+    look the user row up again
+    Entries expire after USER_CACHE_TTL seconds and at most USER_CACHE_MAX_ENTRIES are kept per process,
+    any update or delete of a user row through the ORM evicts its entry
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("USER_CACHE_MAX_ENTRIES", 1024)
+        app.config.setdefault("USER_CACHE_TTL", 300)
+        app.extensions["user_cache"] = self
+        self.app = app
+        for name in ("after_update", "after_delete"):
+            if not event.contains(User, name, self.on_user_changed):
+                event.listen(User, name, self.on_user_changed)
+
+    def on_user_changed(self, mapper, connection, target):
+        self.invalidate(target.id)
+
+    def load(self, user_id):
+        """
+        Returns the cached record of a user, loading it from the database on a miss
+        Returns None if the user does not exist
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        row = db.session.execute(db.select(User.id, User.username).where(User.id == user_id)).first()
+        if row is None:
+            return None
+
+        user = CachedUser(row.id, row.username)
+        with self.lock:
+            self.entries[user_id] = (now + self.app.config["USER_CACHE_TTL"], user)
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.app.config["USER_CACHE_MAX_ENTRIES"]:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return user
+
+    def invalidate(self, user_id):
+        """
+        Drop the cached record of a user
+        """
+        with self.lock:
+            if self.entries.pop(user_id, None) is not None:
+                self.invalidations += 1
+
+    def stats(self):
+        """
+        Returns the hit/miss counters of this process, each hit is a user query saved
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "queries_saved": self.hits,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "entries": len(self.entries),
+            }
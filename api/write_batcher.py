@@ -0,0 +1,137 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+from db import db, insert_purchases
+
+
+class WriteTimeout(Exception):
+    """
+    Raised when queued rows were not written within WRITE_BATCH_TIMEOUT, they have been
+    taken off the queue and will not be written, so the request can safely be retried
+    """
+
+
+class PurchaseWriter:
+    """
+    Records purchases, optionally through a write-behind queue (group commit)
+
+    With WRITE_BEHIND off every write is its own transaction. With it on, requests
+    enqueue their rows and a single flusher thread writes everything queued in one
+    transaction, once WRITE_BATCH_SIZE rows are waiting or WRITE_BATCH_DELAY seconds
+    have passed since the first of them. A request is acknowledged once the transaction
+    holding its rows has committed.
+
+    Ordering: requests are written in the order they were queued by this process,
+    and the rows of one request in the order given.
+    Errors: if a batch fails it is rolled back and each request in it is retried in
+    its own transaction, so a bad request only fails itself.
+    Timeouts: a request whose rows are still queued after WRITE_BATCH_TIMEOUT withdraws
+    them and raises WriteTimeout, so they are never written after the request failed.
+    Rows the flusher has already started writing are waited for instead, the outcome of
+    their transaction is the outcome of the request.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.batches = 0
+        self.rows = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("WRITE_BEHIND", False)
+        app.config.setdefault("WRITE_BATCH_SIZE", 100)
+        app.config.setdefault("WRITE_BATCH_DELAY", 0.005)
+        app.config.setdefault("WRITE_BATCH_TIMEOUT", 10)
+        app.extensions["purchase_writer"] = self
+        self.app = app
+
+    def write(self, rows):
+        """
+        Insert purchase rows and return once they are committed
+        Raises the error of the transaction if they could not be written,
+        or WriteTimeout if they were withdrawn from the queue unwritten
+        """
+        if not self.app.config["WRITE_BEHIND"]:
+            insert_purchases(rows)
+            db.session.commit()
+            return
+
+        future = Future()
+        self.start()
+        self.queue.put((rows, future))
+        try:
+            future.result(timeout=self.app.config["WRITE_BATCH_TIMEOUT"])
+        except FutureTimeout:
+            # Cancelling fails once the flusher has taken the rows, then their transaction decides
+            if future.cancel():
+                raise WriteTimeout("purchases were not written within %s seconds"
+                                   % self.app.config["WRITE_BATCH_TIMEOUT"])
+            future.result()
+
+    def start(self):
+        # Started on first use so each forked web worker gets its own flusher
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            count = len(batch[0][0])
+            deadline = time.monotonic() + self.app.config["WRITE_BATCH_DELAY"]
+            while count < self.app.config["WRITE_BATCH_SIZE"]:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+                count += len(batch[-1][0])
+            self.flush(batch)
+
+    def flush(self, batch):
+        """
+        Write a batch of queued requests in one transaction
+        Requests that timed out while queued have been cancelled and are left out
+        """
+        batch = [(rows, future) for rows, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+
+        with self.app.app_context():
+            try:
+                insert_purchases([row for rows, future in batch for row in rows])
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                self.app.logger.warning("batched purchase write failed, retrying requests one by one")
+                for rows, future in batch:
+                    self.flush_one(rows, future)
+                return
+
+        with self.lock:
+            self.batches += 1
+            self.rows += sum(len(rows) for rows, future in batch)
+        for rows, future in batch:
+            future.set_result(None)
+
+    def flush_one(self, rows, future):
+        try:
+            insert_purchases(rows)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            future.set_exception(e)
+        else:
+            with self.lock:
+                self.batches += 1
+                self.rows += len(rows)
+            future.set_result(None)
@@ -0,0 +1,159 @@
+"""
+Spending analytics benchmark at a large number of purchases
+Seeds a throwaway SQLite database with one user's purchases and items, then times loading them into
+NumPy arrays, computing the trends from the arrays (what a cache hit costs) and the same trends computed
+row by row over Purchase objects, and prints the results as JSON
+
+    python benchmarks/analytics.py [--purchases 1000000] [--items 1] [--runs 5] [--orm-runs 1] [--output results.json]
+"""
+import argparse
+import calendar
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api")
+EXPENSE_TYPES = ["meals", "travel", "groceries", "utilities", "entertainment"]
+ITEM_NAMES = ["item%d" % n for n in range(500)]
+SEED_CHUNK = 50000
+
+
+def seed(purchases, items, days):
+    """
+    Insert purchases spread over the last days days for user 1, each with items random item names
+    Rows are inserted directly rather than through insert_purchases, the rollups are not needed here
+    """
+    from db import db, User, Purchase, Item, assoc_purchases_item, bump_data_versions
+
+    now = datetime.now()
+    db.session.execute(db.insert(User.__table__), [{"username": "analytics", "password": "x"}])
+    for start in range(0, purchases, SEED_CHUNK):
+        count = min(SEED_CHUNK, purchases - start)
+        db.session.execute(db.insert(Purchase.__table__), [
+            {"user_id": 1, "amount": round(random.uniform(1, 200), 2), "type": random.choice(EXPENSE_TYPES),
+             "date": now - timedelta(minutes=random.randrange(days * 24 * 60))} for _ in range(count)])
+        # Purchase and item ids are 1..n in insertion order on the fresh database
+        first_item = start * items + 1
+        db.session.execute(db.insert(Item.__table__),
+                           [{"name": random.choice(ITEM_NAMES)} for _ in range(count * items)])
+        db.session.execute(assoc_purchases_item.insert(), [
+            {"purchase_id": start + n + 1, "item_id": first_item + n * items + k}
+            for n in range(count) for k in range(items)])
+    bump_data_versions([1])
+    db.session.commit()
+
+
+def orm_trends(user_id, today):
+    """
+    The trends computed by looping over Purchase objects and their items, for comparison
+    """
+    from db import db, Purchase
+    from sqlalchemy.orm import selectinload
+
+    daily = defaultdict(float)
+    month_start = today.replace(day=1)
+    previous_start = (month_start - timedelta(days=1)).replace(day=1)
+    this_month, last_month, items = defaultdict(float), defaultdict(float), defaultdict(float)
+    for purchase in db.session.scalars(db.select(Purchase).where(Purchase.user_id == user_id)
+                                       .options(selectinload(Purchase.items))):
+        day = purchase.date.date()
+        daily[day] += purchase.amount
+        if month_start <= day <= today:
+            this_month[purchase.type] += purchase.amount
+        elif previous_start <= day < previous_start + timedelta(days=today.day):
+            last_month[purchase.type] += purchase.amount
+        for item in purchase.items:
+            items[item.name] += purchase.amount / len(purchase.items)
+
+    rolling = [(sum(daily[today - timedelta(days=n + k)] for k in range(7)) / 7,
+                sum(daily[today - timedelta(days=n + k)] for k in range(30)) / 30) for n in range(30)]
+    daily_rate = sum(daily[today - timedelta(days=k)] for k in range(30)) / 30
+    forecast = sum(this_month.values()) + daily_rate * (calendar.monthrange(today.year, today.month)[1] - today.day)
+    return rolling, this_month, last_month, sorted(items.items(), key=lambda item: -item[1])[:10], forecast
+
+
+def timed(function, runs):
+    """
+    Returns the median milliseconds of runs calls of function
+    """
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - start) * 1000)
+    return round(statistics.median(times), 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--purchases", type=int, default=1000000)
+    parser.add_argument("--items", type=int, default=1, help="items per purchase")
+    parser.add_argument("--days", type=int, default=730, help="days the purchases are spread over")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--orm-runs", type=int, default=0,
+                        help="runs of the row by row version, which takes minutes at 1M purchases")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    workdir = tempfile.mkdtemp(prefix="expense-tracker-bench-")
+    os.environ["DATABASE_URI"] = "sqlite:///" + os.path.join(workdir, "bench.db")
+    os.environ.setdefault("EXPENSE_TRACKER_ENV", "production")
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    sys.path.insert(0, API_DIR)
+
+    from app import create_app, analytics_cache
+    from analytics import load_arrays, analyze
+    from db import create_schema
+
+    app = create_app()
+    today = datetime.now().date()
+    with app.app_context():
+        create_schema()
+        started = time.perf_counter()
+        seed(args.purchases, args.items, args.days)
+        seed_seconds = time.perf_counter() - started
+
+        arrays = load_arrays(1)
+        results = {
+            "config": {"purchases": args.purchases, "items_per_purchase": args.items, "days": args.days,
+                       "runs": args.runs, "seed": args.seed},
+            "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                            "cpus": os.cpu_count()},
+            "seed_seconds": round(seed_seconds, 3),
+            "array_bytes": arrays.nbytes,
+            "load_arrays_ms": timed(lambda: load_arrays(1), args.runs),
+            "analyze_ms": timed(lambda: analyze(arrays, today), args.runs),
+            "analyze_365_days_ms": timed(lambda: analyze(arrays, today, days=365), args.runs),
+        }
+
+        analytics_cache.arrays(1)
+        results["cached_analyze_ms"] = timed(lambda: analyze(analytics_cache.arrays(1), today), args.runs)
+        if args.orm_runs:
+            results["orm_ms"] = timed(lambda: orm_trends(1, today), args.orm_runs)
+            results["speedup_cached_vs_orm"] = round(results["orm_ms"] / results["cached_analyze_ms"], 1)
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = "1"
+        client.get("/api/get_analytics/")
+        results["get_analytics_route_ms"] = timed(lambda: client.get("/api/get_analytics/"), args.runs)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
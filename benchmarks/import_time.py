@@ -0,0 +1,114 @@
+"""
+Import time and cold start benchmark of the app
+Runs fresh interpreters from the api directory and prints as JSON the `python -X importtime` cost of
+importing app, the heaviest modules it pulls in, the time to build the app with create_app() and
+serve a first request, and which optional heavy modules are loaded by then
+
+    python benchmarks/import_time.py [--runs 5] [--output results.json]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api")
+# Modules only some routes need, they should not be loaded by a cold start
+HEAVY_MODULES = ["numpy", "PIL", "pytesseract", "receipt", "requests", "jwt"]
+
+COLD_START = """
+import json, sys, time
+start = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+app = create_app()
+created = time.perf_counter()
+app.test_client().get("/")
+served = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - start) * 1000,
+    "create_app_ms": (created - imported) * 1000,
+    "first_request_ms": (served - created) * 1000,
+    "loaded": [name for name in %r if name in sys.modules],
+}))
+""" % HEAVY_MODULES
+
+
+def run_python(args, env):
+    return subprocess.run([sys.executable] + args, cwd=API_DIR, env=env,
+                          capture_output=True, text=True, check=True)
+
+
+def importtime(code, env):
+    """
+    Returns the cumulative `-X importtime` milliseconds of every top-level package imported by code
+    """
+    stderr = run_python(["-X", "importtime", "-c", code], env).stderr
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        name = name.strip()
+        if "." not in name:
+            modules[name] = max(modules.get(name, 0), int(cumulative) / 1000)
+    return modules
+
+
+def import_profile(env, top):
+    """
+    Returns the import time of app and of the slowest packages it imports, in milliseconds
+    Packages the interpreter imports on startup (site, .pth hooks) are left out
+    """
+    startup = importtime("pass", env)
+    modules = importtime("import app", env)
+    slowest = sorted(((name, ms) for name, ms in modules.items() if name != "app" and name not in startup),
+                     key=lambda item: -item[1])
+    return round(modules.get("app", 0), 1), {name: round(ms, 1) for name, ms in slowest[:top]}
+
+
+def median(runs, key):
+    return round(statistics.median(run[key] for run in runs), 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="number of slowest imports to list")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(os.environ, DATABASE_URI="sqlite:///" + os.path.join(workdir, "bench.db"),
+                   EXPENSE_TRACKER_ENV="production", SECRET_KEY="benchmark")
+
+        import_ms, slowest = import_profile(env, args.top)
+        runs = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            child = json.loads(run_python(["-c", COLD_START], env).stdout.splitlines()[-1])
+            child["process_ms"] = (time.perf_counter() - start) * 1000
+            runs.append(child)
+
+    results = {
+        "runs": args.runs,
+        "python": sys.version.split()[0],
+        "importtime_app_ms": import_ms,
+        "slowest_imports_ms": slowest,
+        "cold_start_ms": {key: median(runs, key)
+                          for key in ("import_ms", "create_app_ms", "first_request_ms", "process_ms")},
+        "heavy_modules_loaded": runs[-1]["loaded"],
+    }
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
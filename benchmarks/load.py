@@ -0,0 +1,215 @@
+"""
+Load and latency benchmark of the main API routes against a seeded SQLite database
+Seeds a fresh database with users, purchases and items, stubs the exchange rate API with a
+local server, then drives the routes through the Flask test client and prints per-route
+throughput and p50/p95/p99 latencies as JSON
+
+    python benchmarks/load.py [--users 100] [--purchases 1000] [--items 3] [--requests 500]
+                              [--output results.json] [--compare baseline.json]
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api")
+STUB_RATES = {"USD": 1.0, "EUR": 0.92, "GBP": 0.79, "JPY": 150.2, "CAD": 1.36}
+EXPENSE_TYPES = ["meals", "travel", "groceries", "utilities", "entertainment"]
+PASSWORD = "benchmark"
+SEED_CHUNK = 20000
+LOGGED_IN_CLIENTS = 20
+
+
+def start_rates_stub():
+    """
+    Serve a fixed rates payload in the shape of the upstream currency API, returns its URL
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps({"data": STUB_RATES}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return "http://127.0.0.1:%d/" % server.server_port
+
+
+def seed(app, users, purchases, items):
+    """
+    Fill the empty database with users, purchases per user and items per purchase
+    Purchases go through insert_purchases so the rollups match the purchase table
+    """
+    from db import db, User, Item, assoc_purchases_item, insert_purchases
+    from app import hash_password
+
+    now = datetime.now()
+    with app.app_context():
+        password = hash_password(PASSWORD)
+        db.session.execute(db.insert(User.__table__),
+                           [{"username": "user%d" % n, "password": password} for n in range(users)])
+
+        rows = [{"user_id": user_id, "amount": round(random.uniform(1, 200), 2),
+                 "type": random.choice(EXPENSE_TYPES),
+                 "date": now - timedelta(minutes=random.randrange(365 * 24 * 60))}
+                for user_id in range(1, users + 1) for _ in range(purchases)]
+        for start in range(0, len(rows), SEED_CHUNK):
+            insert_purchases(rows[start:start + SEED_CHUNK])
+
+        # Each purchase gets its own items, like the lines of a receipt, and as the database
+        # is fresh, purchase and item ids are 1..n in insertion order
+        links = [{"purchase_id": purchase_id, "item_id": (purchase_id - 1) * items + n + 1}
+                 for purchase_id in range(1, len(rows) + 1) for n in range(items)]
+        for start in range(0, len(links), SEED_CHUNK):
+            chunk = links[start:start + SEED_CHUNK]
+            db.session.execute(db.insert(Item.__table__), [{"name": "item%d" % link["item_id"]} for link in chunk])
+            db.session.execute(assoc_purchases_item.insert(), chunk)
+        db.session.commit()
+
+
+def login(client, username):
+    return client.post("/api/login/", data={"username": username, "password": PASSWORD})
+
+
+def scenarios(app, users):
+    """
+    Returns (name, request function) pairs, each function performs one request and returns the response
+    """
+    clients = []
+    for n in random.sample(range(users), min(users, LOGGED_IN_CLIENTS)):
+        client = app.test_client()
+        login(client, "user%d" % n)
+        clients.append(client)
+    anonymous = app.test_client()
+
+    def any_client():
+        return random.choice(clients)
+
+    return [
+        ("login", lambda: login(app.test_client(), "user%d" % random.randrange(users))),
+        ("submit_expense", lambda: any_client().post("/api/submit_expense/", data={
+            "amount": random.randrange(1, 200), "type": random.choice(EXPENSE_TYPES)})),
+        ("get_expenses", lambda: any_client().get("/api/get_expenses/")),
+        ("get_summary", lambda: any_client().get("/api/get_summary/")),
+        ("exchange", lambda: anonymous.get("/api/exchange/", query_string={
+            "fromCurrencyAmount": random.uniform(1, 1000), "fromCurrency": random.choice(list(STUB_RATES)),
+            "toCurrency": random.choice(list(STUB_RATES))})),
+    ]
+
+
+def percentile(latencies, fraction):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+
+def run(request, count, warmup):
+    """
+    Time count sequential requests after warmup untimed ones
+    """
+    for _ in range(warmup):
+        request()
+
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    for _ in range(count):
+        start = time.perf_counter()
+        response = request()
+        latencies.append((time.perf_counter() - start) * 1000)
+        errors += response.status_code >= 400
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": count,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(count / elapsed, 1),
+        "mean_ms": round(statistics.fmean(latencies), 3),
+        "p50_ms": round(percentile(latencies, 0.50), 3),
+        "p95_ms": round(percentile(latencies, 0.95), 3),
+        "p99_ms": round(percentile(latencies, 0.99), 3),
+    }
+
+
+def compare(results, baseline):
+    """
+    Returns the relative change of throughput and p95 per route against a previous run
+    """
+    changes = {}
+    for name, current in results["endpoints"].items():
+        previous = baseline.get("endpoints", {}).get(name)
+        if previous:
+            changes[name] = {
+                "requests_per_second": round(current["requests_per_second"] / previous["requests_per_second"] - 1, 3),
+                "p95_ms": round(current["p95_ms"] / previous["p95_ms"] - 1, 3),
+            }
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--purchases", type=int, default=1000, help="purchases per user")
+    parser.add_argument("--items", type=int, default=3, help="items per purchase")
+    parser.add_argument("--requests", type=int, default=500, help="timed requests per route")
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare against")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    workdir = tempfile.mkdtemp(prefix="expense-tracker-bench-")
+    os.environ["DATABASE_URI"] = "sqlite:///" + os.path.join(workdir, "bench.db")
+    os.environ.setdefault("EXPENSE_TRACKER_ENV", "production")
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    sys.path.insert(0, API_DIR)
+
+    from app import create_app
+    from db import create_schema
+    app = create_app({"CURRENCY_API_URL": start_rates_stub()})
+    with app.app_context():
+        create_schema()
+
+    started = time.perf_counter()
+    seed(app, args.users, args.purchases, args.items)
+    seed_seconds = time.perf_counter() - started
+
+    results = {
+        "config": {"users": args.users, "purchases_per_user": args.purchases, "items_per_purchase": args.items,
+                   "requests": args.requests, "warmup": args.warmup, "seed": args.seed},
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "cpus": os.cpu_count(), "env": os.environ["EXPENSE_TRACKER_ENV"]},
+        "seed_seconds": round(seed_seconds, 3),
+        "endpoints": {name: run(request, args.requests, args.warmup)
+                      for name, request in scenarios(app, args.users)},
+    }
+    if args.compare:
+        with open(args.compare) as f:
+            results["changes"] = compare(results, json.load(f))
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
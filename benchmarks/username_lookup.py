@@ -0,0 +1,86 @@
+"""
+Username lookup latency with and without the unique username index
+Builds a throwaway SQLite database per size with the app's user table, then times
+the login lookup (select by username) against a full scan and against ix_user_username
+
+    python benchmarks/username_lookup.py [--sizes 10000 100000 1000000] [--lookups 200]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+
+from sqlalchemy import create_engine, select  # noqa: E402
+
+from db import User  # noqa: E402
+
+INSERT_CHUNK = 50000
+
+
+def seed(engine, size):
+    """
+    Create the user table without its indexes and fill it with size users
+    """
+    User.__table__.create(engine)
+    for index in User.__table__.indexes:
+        index.drop(engine)
+    with engine.begin() as conn:
+        for start in range(0, size, INSERT_CHUNK):
+            conn.execute(User.__table__.insert(), [
+                {"username": "user%d" % n, "password": "sha256$x"}
+                for n in range(start, min(start + INSERT_CHUNK, size))])
+
+
+def time_lookups(engine, size, lookups):
+    """
+    Returns the per-lookup latencies in milliseconds of random existing usernames
+    """
+    names = ["user%d" % random.randrange(size) for _ in range(lookups)]
+    latencies = []
+    with engine.connect() as conn:
+        for name in names:
+            start = time.perf_counter()
+            row = conn.execute(select(User.id, User.password).where(User.username == name)).first()
+            latencies.append((time.perf_counter() - start) * 1000)
+            assert row is not None
+    return latencies
+
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    return {
+        "p50_ms": round(statistics.median(latencies), 3),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1], 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--lookups", type=int, default=200)
+    args = parser.parse_args()
+
+    print("%10s  %-9s  %10s  %10s" % ("users", "index", "p50 ms", "p95 ms"))
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = create_engine("sqlite:///" + os.path.join(tmp, "users.db"))
+            seed(engine, size)
+
+            # Full scans get slow at large sizes, fewer lookups still give a stable median
+            scan = summarize(time_lookups(engine, size, max(10, args.lookups // 10)))
+            print("%10d  %-9s  %10.3f  %10.3f" % (size, "none", scan["p50_ms"], scan["p95_ms"]))
+
+            for index in User.__table__.indexes:
+                index.create(engine)
+            indexed = summarize(time_lookups(engine, size, args.lookups))
+            print("%10d  %-9s  %10.3f  %10.3f" % (size, "unique", indexed["p50_ms"], indexed["p95_ms"]))
+            engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
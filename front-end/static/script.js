@@ -5,9 +5,8 @@ var categoryColors = {}; // Dictionary to store category colors
 // Expense methods
 
 function updateExpense() {
-    var totalAmount = 0;
-  /* Fetch for current user's expense data from backend and update it to local storage and pie chart*/
-  fetch("/api/get_expenses").then((response) => {
+  /* Fetch the current user's spending totals from backend and update the pie chart*/
+  fetch("/api/get_summary/").then((response) => {
     if (!response.ok) {
       console.error("Error:", response.json().errorData.message);
       throw new Error(`HTTP error! Status: ${response.status}`);
@@ -17,18 +16,11 @@ function updateExpense() {
       .then((data) => {
         // Handle the response from the backend
         console.log("Success:", data);
-        purchases = data.purchases;
-        for (var i = 0; i < purchases.length; i++) {
-          var expenseKey = purchases[i].type;
-          expenses[expenseKey] = isNaN(expenses[expenseKey])
-            ? purchases[i].amount
-            : purchases[i].amount + expenses[expenseKey];
-          totalAmount += purchases[i].amount;
+        for (var i = 0; i < data.by_type.length; i++) {
+          expenses[data.by_type[i].type] = data.by_type[i].total;
         }
-      })
-      .then(() => {
         updatePieChart();
-        document.getElementById("totalAmount").textContent = totalAmount.toFixed(2);
+        document.getElementById("totalAmount").textContent = data.total.toFixed(2);
       });
   });
 }
@@ -75,41 +67,68 @@ function submitExpense() {
       throw new Error(`HTTP error! Status: ${response.status}`);
     }
     response.json().then((data) => {
-      // Handle the response from the backend
-      var adjustedAmount = parseFloat(data.adjustedAmount);
-      var totalAmount = parseFloat(
-        document.getElementById("totalAmount").textContent
-      );
-      totalAmount += isNaN(adjustedAmount) ? 0 : adjustedAmount;
-      document.getElementById("totalAmount").textContent =
-        totalAmount.toFixed(2);
-
-      // Add the expense to the dictionary for the chart
-      var expenseKey = data.type;
-      expenses[expenseKey] = isNaN(expenses[expenseKey])
-        ? adjustedAmount
-        : adjustedAmount + expenses[expenseKey];
-
-      // Update the pie chart
-      updatePieChart();
-
-      // Reset the form
-      const receiptInput = document.getElementById('receipt');
-      const previewImage = document.getElementById('preview');
-
-      // Reset the input element
-      receiptInput.value = '';
-
-      // Reset the img element
-      previewImage.src = '';
-      previewImage.style.display = 'none';
-
-      // Reset the expense amount input
-      document.getElementById("amount").value = "";
+      // Receipts are read in the background, wait for the job to finish
+      if (response.status === 202) {
+        pollReceiptJob(data.jobId);
+      } else {
+        addExpense(data);
+      }
+    });
+  });
+}
+
+function pollReceiptJob(jobId) {
+  /* Check the receipt job every second until the amount has been read */
+  fetch(`/api/receipt_job/${jobId}/`).then((response) => {
+    if (!response.ok) {
+      throw new Error(`HTTP error! Status: ${response.status}`);
+    }
+    response.json().then((data) => {
+      if (data.status === "pending") {
+        setTimeout(() => pollReceiptJob(jobId), 1000);
+      } else if (data.status === "failed") {
+        alert("Could not read the receipt: " + data.error);
+      } else {
+        addExpense(data);
+      }
     });
   });
 }
 
+function addExpense(data) {
+  // Handle the response from the backend
+  var adjustedAmount = parseFloat(data.adjustedAmount);
+  var totalAmount = parseFloat(
+    document.getElementById("totalAmount").textContent
+  );
+  totalAmount += isNaN(adjustedAmount) ? 0 : adjustedAmount;
+  document.getElementById("totalAmount").textContent =
+    totalAmount.toFixed(2);
+
+  // Add the expense to the dictionary for the chart
+  var expenseKey = data.type;
+  expenses[expenseKey] = isNaN(expenses[expenseKey])
+    ? adjustedAmount
+    : adjustedAmount + expenses[expenseKey];
+
+  // Update the pie chart
+  updatePieChart();
+
+  // Reset the form
+  const receiptInput = document.getElementById('receipt');
+  const previewImage = document.getElementById('preview');
+
+  // Reset the input element
+  receiptInput.value = '';
+
+  // Reset the img element
+  previewImage.src = '';
+  previewImage.style.display = 'none';
+
+  // Reset the expense amount input
+  document.getElementById("amount").value = "";
+}
+
 function updatePieChart() {
   var ctx = document.getElementById("expenseChart").getContext("2d");
 
@@ -0,0 +1,142 @@
+import json
+import os
+import sys
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from sqlalchemy import event
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+
+from app import create_app, user_cache, http_client, analytics_cache  # noqa: E402
+from db import db, User, Purchase, Item, create_schema  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = create_app({
+        "TESTING": True,
+        "SECRET_KEY": "test",
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///%s" % (tmp_path / "test.db"),
+        "SQLALCHEMY_ECHO": False,
+    })
+    with app.app_context():
+        create_schema()
+        db.session.add(User(username="test", password="x"))
+        db.session.commit()
+    # The extensions are module level, drop users cached by an earlier test's app
+    user_cache.invalidate(1)
+    http_client.breakers = {}
+    analytics_cache.entries.clear()
+    analytics_cache.nbytes = 0
+    yield app
+    with app.app_context():
+        db.engine.dispose()
+
+
+@pytest.fixture
+def client(app):
+    """
+    Test client logged in as the test user
+    """
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["_user_id"] = "1"
+    return client
+
+
+@pytest.fixture
+def add_purchases(app):
+    """
+    Adds count purchases of the test user, each with two items
+    """
+
+    def add(count):
+        now = datetime.now()
+        with app.app_context():
+            for n in range(count):
+                purchase = Purchase(amount=n + 1, date=now - timedelta(days=n), type="meals", user_id=1)
+                purchase.items = [Item(name="item%d" % n), Item(name="side%d" % n)]
+                db.session.add(purchase)
+            db.session.commit()
+
+    return add
+
+
+@pytest.fixture
+def count_queries(app):
+    """
+    Returns a function that runs a request and returns its response and the SQL statements it executed
+    """
+
+    def count(request):
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, "before_cursor_execute", record)
+        try:
+            response = request()
+        finally:
+            event.remove(engine, "before_cursor_execute", record)
+        return response, statements
+
+    return count
+
+
+class StubUpstream:
+    """
+    Local HTTP server standing in for a third-party API
+    handler(request) returns the status and JSON body of a response, by default 200 with the rates
+    requests holds the path of every request and connections the client ports they came from
+    """
+
+    def __init__(self):
+        self.handler = lambda request: (200, {"data": {"USD": 1.0, "EUR": 0.9}})
+        self.requests = []
+        self.connections = set()
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def respond(self):
+                if self.headers.get("Content-Length"):
+                    self.rfile.read(int(self.headers["Content-Length"]))
+                with stub.lock:
+                    stub.requests.append(self.path)
+                    stub.connections.add(self.client_address[1])
+                status, payload = stub.handler(self)
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST = respond
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = "http://127.0.0.1:%d/" % self.server.server_port
+        threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def upstream():
+    stub = StubUpstream()
+    yield stub
+    stub.close()
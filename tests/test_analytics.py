@@ -0,0 +1,139 @@
+import calendar
+import random
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from analytics import load_arrays, analyze
+from app import analytics_cache
+from db import db, User, Purchase, Item, insert_purchases
+
+TODAY = date(2024, 3, 15)
+TYPES = ["meals", "travel", "groceries"]
+NAMES = ["coffee", "bread", "train", "milk", "taxi"]
+
+
+@pytest.fixture
+def spending(app):
+    """
+    Purchases of the test user over the 75 days to TODAY, some with items, as (date, amount, type, item names)
+    """
+    rng = random.Random(7)
+    rows = []
+    for _ in range(120):
+        day = TODAY - timedelta(days=rng.randrange(75))
+        rows.append((datetime(day.year, day.month, day.day, rng.randrange(24), rng.randrange(60)),
+                     rng.randrange(1, 200), rng.choice(TYPES), rng.sample(NAMES, rng.randrange(0, 3))))
+    with app.app_context():
+        for when, amount, expense_type, names in rows:
+            purchase = Purchase(amount=amount, date=when, type=expense_type, user_id=1)
+            purchase.items = [Item(name=name) for name in names]
+            db.session.add(purchase)
+        db.session.commit()
+        yield rows
+
+
+def expected(rows, today, days):
+    """
+    The trends computed in plain Python
+    """
+    daily = defaultdict(float)
+    for when, amount, _, _ in rows:
+        daily[when.date()] += amount
+
+    def window(end, length):
+        return sum(daily[end - timedelta(days=k)] for k in range(length))
+
+    rolling = []
+    for n in range(days - 1, -1, -1):
+        day = today - timedelta(days=n)
+        rolling.append({"date": day.isoformat(), "total": round(daily[day], 2),
+                        "avg_7": round(window(day, 7) / 7, 2), "avg_30": round(window(day, 30) / 30, 2)})
+
+    previous_start = (today.replace(day=1) - timedelta(days=1)).replace(day=1)
+    this_month, last_month = defaultdict(float), defaultdict(float)
+    for when, amount, expense_type, _ in rows:
+        day = when.date()
+        if today.replace(day=1) <= day <= today:
+            this_month[expense_type] += amount
+        elif previous_start <= day < previous_start + timedelta(days=today.day):
+            last_month[expense_type] += amount
+    by_type = {expense_type: (round(this_month[expense_type], 2), round(last_month[expense_type], 2))
+               for expense_type in set(this_month) | set(last_month)}
+
+    spent, counts = defaultdict(float), defaultdict(int)
+    for _, amount, _, names in rows:
+        for name in names:
+            spent[name] += amount / len(names)
+            counts[name] += 1
+    top = sorted(spent, key=lambda name: -spent[name])
+
+    month_spent = sum(daily[day] for day in daily if today.replace(day=1) <= day <= today)
+    rate = window(today, 30) / 30
+    forecast = month_spent + rate * (calendar.monthrange(today.year, today.month)[1] - today.day)
+    return rolling, by_type, [(name, round(spent[name], 2), counts[name]) for name in top], \
+        {"month": today.strftime("%Y-%m"), "spent": round(month_spent, 2), "daily_rate": round(rate, 2),
+         "forecast": round(forecast, 2)}
+
+
+def test_trends_match_a_plain_computation(app, spending):
+    with app.app_context():
+        result = analyze(load_arrays(1), TODAY, days=45, top=3)
+
+    rolling, by_type, top, forecast = expected(spending, TODAY, 45)
+    assert result["purchases"] == len(spending)
+    assert result["rolling"] == rolling
+    assert {row["type"]: (row["this_month"], row["last_month"]) for row in result["month_over_month"]} == by_type
+    assert [(row["name"], row["spent"], row["count"]) for row in result["top_items"]] == top[:3]
+    assert result["forecast"] == forecast
+
+
+def test_amounts_are_converted_at_rate(app, spending):
+    with app.app_context():
+        arrays = load_arrays(1)
+        plain, converted = analyze(arrays, TODAY), analyze(arrays, TODAY, rate=2)
+
+    assert converted["forecast"]["spent"] == pytest.approx(plain["forecast"]["spent"] * 2, abs=0.02)
+    assert converted["top_items"][0]["spent"] == pytest.approx(plain["top_items"][0]["spent"] * 2, abs=0.02)
+
+
+def test_user_without_purchases(app, client):
+    with app.app_context():
+        result = analyze(load_arrays(1), TODAY, days=7)
+
+    assert result["purchases"] == 0
+    assert [row["total"] for row in result["rolling"]] == [0] * 7
+    assert result["month_over_month"] == []
+    assert result["top_items"] == []
+    assert result["forecast"] == {"month": "2024-03", "spent": 0, "daily_rate": 0, "forecast": 0}
+
+    response = client.get("/api/get_analytics/")
+    assert response.status_code == 200
+    assert response.get_json()["purchases"] == 0
+
+
+def test_cache_is_invalidated_by_a_write(app):
+    with app.app_context():
+        first = analytics_cache.arrays(1)
+        hits = analytics_cache.hits
+        assert analytics_cache.arrays(1) is first
+        assert analytics_cache.hits == hits + 1
+
+        insert_purchases([{"user_id": 1, "amount": 9, "type": "meals", "date": datetime(2024, 3, 14)}])
+        db.session.commit()
+
+        second = analytics_cache.arrays(1)
+        assert second is not first
+        assert len(second.amount) == len(first.amount) + 1
+
+
+def test_cache_keeps_users_apart(app):
+    with app.app_context():
+        db.session.add(User(username="other", password="x"))
+        db.session.commit()
+        insert_purchases([{"user_id": 2, "amount": 4, "type": "meals", "date": datetime(2024, 3, 14)}])
+        db.session.commit()
+
+        assert len(analytics_cache.arrays(2).amount) == 1
+        assert len(analytics_cache.arrays(1).amount) == 0
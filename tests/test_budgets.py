@@ -0,0 +1,66 @@
+from datetime import datetime
+
+import pytest
+
+from budgets import budget_status, check_budget
+from db import db, Purchase, insert_purchases
+
+
+@pytest.mark.parametrize("spent, status", [(0, "ok"), (89.99, "ok"), (90, "near"), (100, "near"), (100.5, "over")])
+def test_status_at_the_thresholds(spent, status):
+    assert budget_status(100, spent, "2024-01")["status"] == status
+
+
+def test_submit_expense_reports_the_budget(client):
+    assert client.post("/api/set_budget/", data={"type": "meals", "limit": "100"}).status_code == 200
+
+    statuses = []
+    for amount in ("85", "5", "11"):
+        response = client.post("/api/submit_expense/", data={"amount": amount, "type": "meals"})
+        assert response.status_code == 200
+        budget = response.get_json()["budget"]
+        statuses.append((budget["spent"], budget["remaining"], budget["status"]))
+
+    assert statuses == [(85, 15, "ok"), (90, 10, "near"), (101, -1, "over")]
+    # Types without a budget report none
+    response = client.post("/api/submit_expense/", data={"amount": "5", "type": "travel"})
+    assert response.get_json()["budget"] is None
+
+
+def test_budget_starts_over_each_month(app, client):
+    client.post("/api/set_budget/", data={"type": "meals", "limit": "50"})
+    with app.app_context():
+        insert_purchases([{"user_id": 1, "amount": 60, "type": "meals", "date": datetime(2024, 1, 31, 23, 59)}])
+        db.session.commit()
+
+        assert check_budget(1, "meals", datetime(2024, 1, 15))["status"] == "over"
+        february = check_budget(1, "meals", datetime(2024, 2, 1))
+        assert (february["month"], february["spent"], february["status"]) == ("2024-02", 0, "ok")
+
+
+def test_editing_an_old_expense_moves_its_spend_between_months(app, client):
+    client.post("/api/set_budget/", data={"type": "meals", "limit": "50"})
+    with app.app_context():
+        insert_purchases([{"user_id": 1, "amount": 45, "type": "meals", "date": datetime(2024, 1, 10)},
+                          {"user_id": 1, "amount": 30, "type": "meals", "date": datetime(2024, 2, 10)}])
+        db.session.commit()
+        january_id = db.session.scalar(db.select(Purchase.id).where(Purchase.amount == 45))
+
+    response = client.post("/api/update_expense/%d/" % january_id, data={"date": "2024-02-11T12:00:00"})
+    assert response.status_code == 200
+
+    with app.app_context():
+        january = check_budget(1, "meals", datetime(2024, 1, 1))
+        february = check_budget(1, "meals", datetime(2024, 2, 1))
+    assert (january["spent"], january["status"]) == (0, "ok")
+    assert (february["spent"], february["status"]) == (75, "over")
+
+
+def test_zero_limit_removes_the_budget(client):
+    client.post("/api/set_budget/", data={"type": "meals", "limit": "100"})
+    assert [budget["type"] for budget in client.get("/api/get_budgets/").get_json()["budgets"]] == ["meals"]
+
+    response = client.post("/api/set_budget/", data={"type": "meals", "limit": "0"})
+
+    assert response.get_json()["budget"] is None
+    assert client.get("/api/get_budgets/").get_json()["budgets"] == []
@@ -0,0 +1,99 @@
+import gzip
+import json
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+
+from flask.json.provider import DefaultJSONProvider
+
+from db import db, ExchangeRates
+from json_provider import JSONProvider
+
+
+def test_matching_etag_gets_304(client, add_purchases):
+    add_purchases(3)
+    first = client.get("/api/get_expenses/")
+    assert first.status_code == 200
+    assert first.headers["ETag"]
+
+    second = client.get("/api/get_expenses/", headers={"If-None-Match": first.headers["ETag"]})
+
+    assert second.status_code == 304
+    assert second.headers["ETag"] == first.headers["ETag"]
+    assert "Accept-Encoding" in second.headers["Vary"]
+    assert "Accept-Encoding" in first.headers["Vary"]
+
+
+def test_write_changes_the_etag(client, add_purchases):
+    add_purchases(3)
+    etag = client.get("/api/get_expenses/").headers["ETag"]
+
+    client.post("/api/submit_expense/", data={"amount": "5", "type": "meals"})
+    response = client.get("/api/get_expenses/", headers={"If-None-Match": etag})
+
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert len(response.get_json()["purchases"]) == 4
+
+
+def test_rates_refresh_changes_the_etag_of_converted_amounts(app, client, add_purchases):
+    add_purchases(3)
+    with app.app_context():
+        db.session.add(ExchangeRates(rates=json.dumps({"USD": 1.0, "EUR": 0.5}), fetched_at=datetime.now()))
+        db.session.commit()
+    etag = client.get("/api/get_expenses/?currency=EUR").headers["ETag"]
+    unconverted = client.get("/api/get_expenses/").headers["ETag"]
+    assert client.get("/api/get_expenses/?currency=EUR", headers={"If-None-Match": etag}).status_code == 304
+
+    with app.app_context():
+        db.session.execute(db.update(ExchangeRates.__table__).values(
+            rates=json.dumps({"USD": 1.0, "EUR": 0.25}), fetched_at=datetime.now() + timedelta(seconds=1)))
+        db.session.commit()
+
+    response = client.get("/api/get_expenses/?currency=EUR", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.get_json()["purchases"][0]["amount"] == 0.25
+    # Amounts that are not converted do not depend on the rates
+    assert client.get("/api/get_expenses/", headers={"If-None-Match": unconverted}).status_code == 304
+
+
+def test_compressed_response_has_its_own_etag(client, add_purchases):
+    add_purchases(20)
+
+    response = client.get("/api/get_expenses/", headers={"Accept-Encoding": "gzip"})
+
+    assert response.headers["Content-Encoding"] == "gzip"
+    etag = response.headers["ETag"]
+    assert etag.endswith('-gzip"')
+    assert len(json.loads(gzip.decompress(response.get_data()))["purchases"]) == 20
+
+    again = client.get("/api/get_expenses/", headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.headers["ETag"] == etag
+    assert "Accept-Encoding" in again.headers["Vary"]
+
+
+def test_streamed_export_is_not_compressed(client, add_purchases):
+    add_purchases(50)
+
+    response = client.get("/api/export_expenses/", headers={"Accept-Encoding": "gzip"})
+
+    assert response.status_code == 200
+    assert "Content-Encoding" not in response.headers
+    assert response.get_data(as_text=True).count("\n") == 51
+
+
+def test_json_matches_the_default_provider(app):
+    value = {
+        "naive": datetime(2024, 1, 2, 3, 4, 5, 600),
+        "aware": datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone(timedelta(hours=-5))),
+        "day": date(2024, 2, 29),
+        "price": Decimal("12.30"),
+        "nested": [{"amount": 1.5, "when": datetime(1999, 12, 31, 23, 59, 59)}],
+        "count": 3,
+        "none": None,
+    }
+
+    with app.app_context():
+        assert JSONProvider(app).response(value).get_data() == DefaultJSONProvider(app).response(value).get_data()
+    assert json.loads(JSONProvider(app).dumps(value)) == json.loads(DefaultJSONProvider(app).dumps(value))
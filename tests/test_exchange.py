@@ -0,0 +1,47 @@
+import pytest
+
+from app import exchange_rates
+
+
+@pytest.fixture
+def rates(monkeypatch):
+    monkeypatch.setattr(exchange_rates, "get_rates", lambda: {"USD": 1.0, "EUR": 0.5})
+
+
+def test_batch_converts_amounts(client, rates):
+    response = client.post("/api/exchange/batch/", json={
+        "fromCurrency": "USD", "conversions": [{"amount": 10, "toCurrency": "EUR"},
+                                               {"amount": 3, "fromCurrency": "EUR", "toCurrency": "USD"}]})
+
+    assert response.status_code == 200
+    assert response.get_json()["toCurrencyAmounts"] == [5.0, 6.0]
+
+
+@pytest.mark.parametrize("conversion", [
+    {"amount": 1, "fromCurrency": ["USD"], "toCurrency": "EUR"},
+    {"amount": 1, "fromCurrency": "USD", "toCurrency": 7},
+    {"amount": 1, "fromCurrency": "USD", "toCurrency": {"code": "EUR"}},
+    {"amount": 1, "fromCurrency": "USD"},
+])
+def test_batch_rejects_codes_that_are_not_strings(client, rates, conversion):
+    response = client.post("/api/exchange/batch/", json={"conversions": [conversion]})
+
+    assert response.status_code == 400
+
+
+def test_batch_rejects_unknown_currency(client, rates):
+    response = client.post("/api/exchange/batch/", json={
+        "conversions": [{"amount": 1, "fromCurrency": "USD", "toCurrency": "XYZ"}]})
+
+    assert response.status_code == 400
+
+
+def test_converted_expenses_convert_nested_amounts(client, rates, add_purchases):
+    add_purchases(2)
+
+    for query in ("/api/get_expenses/?currency=EUR", "/api/get_expenses/?currency=EUR&all=true"):
+        purchases = client.get(query).get_json()["purchases"]
+        amounts = {purchase["amount"] for purchase in purchases}
+        assert amounts == {0.5, 1.0}
+        nested = {p["amount"] for purchase in purchases for item in purchase["items"] for p in item["purchases"]}
+        assert nested == amounts
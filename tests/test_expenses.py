@@ -0,0 +1,47 @@
+import pytest
+
+
+@pytest.mark.parametrize("count", [5, 50])
+@pytest.mark.parametrize("query", ["/api/get_expenses/?limit=100", "/api/get_expenses/?all=true"])
+def test_get_expenses_query_count_does_not_grow_with_purchases(client, add_purchases, count_queries, count, query):
+    add_purchases(count)
+    # The first request also loads the user, later ones find it in the user cache
+    client.get("/api/get_expenses/?limit=1")
+
+    response, statements = count_queries(lambda: client.get(query))
+
+    assert response.status_code == 200
+    purchases = response.get_json()["purchases"]
+    assert len(purchases) == count
+    assert all(len(purchase["items"]) == 2 for purchase in purchases)
+    assert len(statements) == 4, statements
+
+
+def test_get_expenses_pages_follow_cursor(client, add_purchases):
+    add_purchases(5)
+
+    first = client.get("/api/get_expenses/?limit=3").get_json()
+    second = client.get("/api/get_expenses/?limit=3&cursor=%s" % first["next_cursor"]).get_json()
+
+    assert [p["amount"] for p in first["purchases"]] == [1, 2, 3]
+    assert [p["amount"] for p in second["purchases"]] == [4, 5]
+    assert second["next_cursor"] is None
+
+
+def test_create_schema_indexes_association_table(app):
+    from db import db
+
+    with app.app_context():
+        indexes = {index["name"] for index in db.inspect(db.engine).get_indexes("association_purchases_items")}
+    assert {"ix_association_purchases_items_purchase_id", "ix_association_purchases_items_item_id"} <= indexes
+
+
+def test_report_page_reads_rows_without_items(client, add_purchases, count_queries):
+    add_purchases(5)
+    client.get("/report/")
+
+    response, statements = count_queries(lambda: client.get("/report/"))
+
+    assert response.status_code == 200
+    assert response.get_data(as_text=True).count("<td>meals</td>") == 5
+    assert not any("association_purchases_items" in statement for statement in statements), statements
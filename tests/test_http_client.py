@@ -0,0 +1,88 @@
+import time
+
+import pytest
+
+from http_client import HttpClient, UpstreamError, CircuitOpen
+
+
+@pytest.fixture
+def client(app):
+    """
+    A client of its own, so no test shares connections or breakers with another
+    """
+    app.config.update(HTTP_RETRIES=2, HTTP_RETRY_BACKOFF=0, HTTP_BREAKER_THRESHOLD=2, HTTP_BREAKER_RESET=0.2)
+    return HttpClient(app)
+
+
+def test_connections_are_reused(client, upstream):
+    for _ in range(5):
+        assert client.get("stub", upstream.url).status_code == 200
+
+    assert len(upstream.requests) == 5
+    assert len(upstream.connections) == 1
+
+
+def test_get_is_retried_after_503(client, upstream):
+    statuses = iter([503, 503, 200])
+    upstream.handler = lambda request: (next(statuses), {})
+
+    assert client.get("stub", upstream.url).status_code == 200
+    assert len(upstream.requests) == 3
+    assert client.status() == {"stub": "closed"}
+
+
+def test_post_is_not_retried_after_503(client, upstream):
+    upstream.handler = lambda request: (503, {})
+
+    assert client.post("stub", upstream.url, json={}).status_code == 503
+    assert len(upstream.requests) == 1
+
+
+def test_read_timeout_raises_upstream_error(app, client, upstream):
+    app.config["HTTP_RETRIES"] = 1
+    upstream.handler = lambda request: time.sleep(1) or (200, {})
+
+    start = time.perf_counter()
+    with pytest.raises(UpstreamError):
+        client.get("stub", upstream.url, timeout=(1, 0.1))
+
+    assert time.perf_counter() - start < 0.9
+    assert len(upstream.requests) == 2
+
+
+def test_breaker_opens_then_half_opens(client, upstream):
+    upstream.handler = lambda request: (500, {})
+    for _ in range(2):
+        assert client.get("stub", upstream.url).status_code == 500
+    assert client.status() == {"stub": "open"}
+
+    with pytest.raises(CircuitOpen):
+        client.get("stub", upstream.url)
+    assert len(upstream.requests) == 2
+
+    time.sleep(0.25)
+    states = []
+    upstream.handler = lambda request: states.append(client.status()["stub"]) or (200, {})
+    assert client.get("stub", upstream.url).status_code == 200
+    # Only the trial request went through while half open, its success closed the breaker
+    assert states == ["half_open"]
+    assert client.status() == {"stub": "closed"}
+
+
+def test_unexpected_error_in_trial_reopens_breaker(client, upstream, monkeypatch):
+    upstream.handler = lambda request: (500, {})
+    for _ in range(2):
+        client.get("stub", upstream.url)
+    time.sleep(0.25)
+
+    session = client.session(upstream.url)
+    monkeypatch.setattr(session, "request", lambda *args, **kwargs: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        client.get("stub", upstream.url)
+    assert client.status() == {"stub": "open"}
+
+    monkeypatch.undo()
+    time.sleep(0.25)
+    upstream.handler = lambda request: (200, {})
+    assert client.get("stub", upstream.url).status_code == 200
+    assert client.status() == {"stub": "closed"}
@@ -0,0 +1,132 @@
+import io
+from datetime import datetime
+
+from db import db, Purchase
+
+
+def import_statement(client, body, filename="statement.csv", **fields):
+    response = client.post("/api/import_expenses/", content_type="multipart/form-data",
+                           data={"statement": (io.BytesIO(body), filename), **fields})
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+
+def purchases(app):
+    with app.app_context():
+        return [(p.date, p.amount, p.type) for p in
+                db.session.scalars(db.select(Purchase).order_by(Purchase.date))]
+
+
+CSV = (b"\xef\xbb\xbfdate,amount,type,description\r\n"
+       b"2024-01-02,-12.00,meals,lunch\r\n"
+       b"01/03/2024,\"-1,204.00\",travel,flight\r\n"
+       b"2024-01-04,100.00,salary,deposit\r\n"
+       b"2024-01-05,(7.00),meals,\"dinner, late\"\r\n")
+
+
+def test_csv_statement_is_imported(app, client):
+    result = import_statement(client, CSV)
+
+    assert result["rows"] == 4
+    assert result["imported"] == 3
+    assert result["skipped"] == 1
+    assert result["negative_is_expense"] is True
+    assert purchases(app) == [(datetime(2024, 1, 2), 12, "meals"), (datetime(2024, 1, 3), 1204, "travel"),
+                              (datetime(2024, 1, 5), 7, "meals")]
+
+
+def test_positive_amounts_are_expenses_without_negative_is_expense(app, client):
+    result = import_statement(client, CSV, negative_is_expense="0")
+
+    assert result["imported"] == 1
+    assert result["skipped"] == 3
+    assert purchases(app) == [(datetime(2024, 1, 4), 100, "salary")]
+
+
+def test_mapped_columns(app, client):
+    body = b"Posted,Value,Category\n2024-02-01,-5.00,\n"
+
+    result = import_statement(client, body, date_column="Posted", amount_column="Value",
+                              type_column="Category", type="groceries")
+
+    assert result["imported"] == 1
+    assert purchases(app) == [(datetime(2024, 2, 1), 5, "groceries")]
+
+
+def test_ofx_statement_is_imported(app, client):
+    body = (b"OFXHEADER:100\nDATA:OFXSGML\n\n<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS><BANKTRANLIST>"
+            b"<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20240131120000[-5:EST]<TRNAMT>-42.00<NAME>Shop</STMTTRN>"
+            b"<STMTTRN><TRNTYPE>CREDIT<DTPOSTED>20240201<TRNAMT>500.00<NAME>Pay</STMTTRN>"
+            b"</BANKTRANLIST></STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>")
+
+    result = import_statement(client, body, filename="statement.ofx", type="shopping")
+
+    assert (result["imported"], result["skipped"]) == (1, 1)
+    assert purchases(app) == [(datetime(2024, 1, 31), 42, "shopping")]
+
+
+def test_reimport_skips_duplicates(app, client):
+    import_statement(client, CSV)
+
+    result = import_statement(client, CSV)
+
+    assert result["imported"] == 0
+    assert result["duplicates"] == 3
+    assert len(purchases(app)) == 3
+
+
+def test_own_export_is_reimported_as_duplicates(app, client, add_purchases):
+    add_purchases(3)
+    export = client.get("/api/export_expenses/").get_data()
+
+    result = import_statement(client, export)
+
+    assert result["negative_is_expense"] is False
+    assert (result["rows"], result["duplicates"], result["skipped"], result["imported"]) == (3, 3, 0, 0)
+
+
+def test_bad_rows_are_reported(app, client):
+    body = b"date,amount,type\n2024-01-02,abc,meals\nnot a date,-3.00,meals\n2024-01-04,-4.00,meals\n"
+
+    result = import_statement(client, body)
+
+    assert result["imported"] == 1
+    assert result["error_count"] == 2
+    assert [error["row"] for error in result["errors"]] == [2, 3]
+
+
+def test_dates_with_an_offset_are_stored_in_utc(app, client):
+    # A chunk mixing dates with and without an offset used to fail comparing them
+    body = b"date,amount,type\n2024-01-02T10:00:00+02:00,-1.00,meals\n2024-01-02 09:00:00,-2.00,meals\n"
+
+    result = import_statement(client, body)
+
+    assert result["imported"] == 2
+    assert purchases(app) == [(datetime(2024, 1, 2, 8), 1, "meals"), (datetime(2024, 1, 2, 9), 2, "meals")]
+
+
+def test_undecodable_bytes_fail_only_their_rows(app, client):
+    body = (b"date,amount,type,description\n2024-01-02,-1.00,caf\xe9,x\n"
+            b"2024-01-03,-2.00,meals,\xff\xfe\n\xff\xfe,-3.00,meals,x\n")
+
+    result = import_statement(client, body)
+
+    # The type and the date of the first and last rows are not UTF-8, the unmapped description does not matter
+    assert result["imported"] == 1
+    assert [error["row"] for error in result["errors"]] == [2, 4]
+
+
+def test_encoding_field_decodes_latin_1(app, client):
+    body = b"date,amount,type\n2024-01-02,-1.00,caf\xe9\n"
+
+    result = import_statement(client, body, encoding="cp1252")
+
+    assert result["imported"] == 1
+    assert purchases(app) == [(datetime(2024, 1, 2), 1, "café")]
+
+
+def test_unknown_encoding_is_rejected(client):
+    response = client.post("/api/import_expenses/", content_type="multipart/form-data",
+                           data={"statement": (io.BytesIO(CSV), "s.csv"), "encoding": "nope"})
+
+    assert response.status_code == 400
@@ -0,0 +1,124 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+
+import pytest
+from flask import Flask
+
+import ocr_jobs
+from db import db, Purchase, ReceiptJob
+from ocr_jobs import ReceiptJobQueue
+
+RESULT = {"total": 12.5, "text": "TOTAL 12.50", "mode": "full", "timings": {}}
+
+
+@pytest.fixture
+def jobs(app, monkeypatch):
+    """
+    A job queue running OCR on threads, with OCR replaced by a fixed result
+    """
+    monkeypatch.setattr(ocr_jobs, "ProcessPoolExecutor", ThreadPoolExecutor)
+    monkeypatch.setattr(ocr_jobs, "run_ocr", lambda data, expected_total=None: RESULT)
+    return ReceiptJobQueue(app)
+
+
+def wait_for_status(app, job_id):
+    for _ in range(100):
+        with app.app_context():
+            job = db.session.get(ReceiptJob, job_id)
+            if job.status != "pending":
+                return job.status, job.amount
+        time.sleep(0.02)
+    raise AssertionError("job %s still pending" % job_id)
+
+
+def purchase_count(app):
+    with app.app_context():
+        return db.session.scalar(db.select(db.func.count(Purchase.id)))
+
+
+def test_result_is_recorded_on_the_finisher_thread(app, jobs, monkeypatch):
+    threads = []
+    finish = jobs.finish
+    monkeypatch.setattr(jobs, "finish", lambda *args: threads.append(threading.current_thread()) or finish(*args))
+
+    with app.app_context():
+        job_id = jobs.submit(b"receipt", 1, "meals")
+
+    assert wait_for_status(app, job_id) == ("done", 12.5)
+    assert threads == [jobs.finisher]
+    assert purchase_count(app) == 1
+    assert jobs.pending == 0
+
+
+def test_stale_pending_job_is_reported_failed(app, client, jobs):
+    with app.app_context():
+        db.session.add(ReceiptJob(id="stale", user_id=1, type="meals",
+                                  created_at=datetime.now() - timedelta(minutes=10)))
+        db.session.commit()
+
+    job = client.get("/api/receipt_job/stale/").get_json()
+    assert job["status"] == "failed"
+
+    # A result arriving after the job expired does not record a purchase the user was told failed
+    future = Future()
+    future.set_result(RESULT)
+    jobs.pending += 1
+    jobs.finish("stale", None, future, None)
+    assert wait_for_status(app, "stale") == ("failed", None)
+    assert purchase_count(app) == 0
+
+
+def test_job_finished_while_expiring_keeps_its_result(app, jobs):
+    with app.app_context():
+        db.session.add(ReceiptJob(id="late", user_id=1, type="meals",
+                                  created_at=datetime.now() - timedelta(minutes=10)))
+        db.session.commit()
+        job = db.session.get(ReceiptJob, "late")
+
+        # The result is recorded after the request loaded the job but before it expires it
+        future = Future()
+        future.set_result(RESULT)
+        jobs.pending += 1
+        jobs.finish("late", None, future, None)
+
+        assert not jobs.expire(job)
+        db.session.commit()
+        assert (job.status, job.amount) == ("done", 12.5)
+    assert purchase_count(app) == 1
+
+
+def test_submit_replaces_a_broken_pool(app, jobs):
+    class BrokenPool:
+        def submit(self, *args):
+            raise BrokenProcessPool()
+
+        def shutdown(self, wait=True, cancel_futures=False):
+            pass
+
+    broken = jobs.executor = BrokenPool()
+    with app.app_context():
+        job_id = jobs.submit(b"receipt", 1, "meals")
+
+    assert wait_for_status(app, job_id) == ("done", 12.5)
+    assert jobs.executor is not broken
+    assert jobs.pending == 0
+
+
+def test_recent_pending_job_stays_pending(app, client):
+    with app.app_context():
+        db.session.add(ReceiptJob(id="recent", user_id=1, type="meals", created_at=datetime.now()))
+        db.session.commit()
+
+    assert client.get("/api/receipt_job/recent/").get_json()["status"] == "pending"
+
+
+def test_ocr_processes_are_divided_between_web_workers(monkeypatch):
+    monkeypatch.setenv("OCR_HOST_WORKERS", "8")
+    monkeypatch.setenv("WEB_CONCURRENCY", "3")
+    assert ReceiptJobQueue(Flask(__name__)).app.config["OCR_WORKERS"] == 2
+
+    monkeypatch.setenv("WEB_CONCURRENCY", "17")
+    assert ReceiptJobQueue(Flask(__name__)).app.config["OCR_WORKERS"] == 1
@@ -0,0 +1,110 @@
+import json
+import threading
+from datetime import datetime, timedelta
+
+from app import exchange_rates, http_client
+from db import db, ExchangeRates
+from rates import ExchangeRateStore
+
+OLD_RATES = {"USD": 1.0, "EUR": 0.8}
+NEW_RATES = {"USD": 1.0, "EUR": 0.9}
+
+
+def use_stub(app, upstream):
+    app.config["CURRENCY_API_URL"] = upstream.url
+    app.config["HTTP_RETRIES"] = 0
+
+
+def store_rates(app, age, refresh_until=None):
+    with app.app_context():
+        row = ExchangeRates(rates=json.dumps(OLD_RATES), fetched_at=datetime.now() - age)
+        row.refresh_until = refresh_until
+        db.session.add(row)
+        db.session.commit()
+
+
+def stored_row(app):
+    with app.app_context():
+        row = db.session.get(ExchangeRates, 1)
+        return json.loads(row.rates), row.refresh_until, row.last_error
+
+
+def test_stale_rates_are_served_while_a_refresh_is_in_flight(app, upstream):
+    use_stub(app, upstream)
+    store_rates(app, age=timedelta(days=2))
+    release = threading.Event()
+    upstream.handler = lambda request: release.wait(5) and (200, {"data": NEW_RATES})
+
+    with app.app_context():
+        assert exchange_rates.get_rates() == OLD_RATES
+        # The refresh holds the lease, later requests keep getting the old rates without starting another
+        assert exchange_rates.get_rates() == OLD_RATES
+        release.set()
+        exchange_rates.thread.join(5)
+        db.session.expire_all()
+        assert exchange_rates.get_rates() == NEW_RATES
+
+    assert len(upstream.requests) == 1
+
+
+def test_failed_refresh_keeps_the_old_rates(app, upstream):
+    use_stub(app, upstream)
+    store_rates(app, age=timedelta(days=2))
+    upstream.handler = lambda request: (500, {"error": "down"})
+
+    with app.app_context():
+        assert exchange_rates.get_rates() == OLD_RATES
+        exchange_rates.thread.join(5)
+        db.session.expire_all()
+        # The lease is kept until the retry delay has passed, so no request calls the upstream again
+        assert exchange_rates.get_rates() == OLD_RATES
+
+    rates, refresh_until, last_error = stored_row(app)
+    assert rates == OLD_RATES
+    assert refresh_until > datetime.now()
+    assert "500" in last_error
+    assert len(upstream.requests) == 1
+
+
+def test_a_single_refresh_wins_the_lease(app, upstream):
+    use_stub(app, upstream)
+    store_rates(app, age=timedelta(days=2))
+    release = threading.Event()
+    upstream.handler = lambda request: release.wait(5) and (200, {"data": NEW_RATES})
+    # One store per simulated worker process, each would start its own refresh if it won the lease
+    workers = [ExchangeRateStore(app, http=http_client) for _ in range(4)]
+    served = []
+
+    def serve(store):
+        with app.app_context():
+            served.append(store.get_rates())
+
+    threads = [threading.Thread(target=serve, args=(store,)) for store in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    release.set()
+    for store in workers:
+        if store.thread is not None:
+            store.thread.join(5)
+
+    assert served == [OLD_RATES] * len(workers)
+    assert sum(store.thread is not None for store in workers) == 1
+    assert len(upstream.requests) == 1
+    assert stored_row(app)[0] == NEW_RATES
+
+
+def test_held_lease_is_not_claimed_again(app, upstream, count_queries):
+    use_stub(app, upstream)
+    store_rates(app, age=timedelta(days=2), refresh_until=datetime.now() + timedelta(minutes=1))
+
+    def get_rates():
+        with app.app_context():
+            return exchange_rates.get_rates()
+
+    rates, statements = count_queries(get_rates)
+
+    assert rates == OLD_RATES
+    assert all(statement.lstrip().upper().startswith("SELECT") for statement in statements), statements
+    assert upstream.requests == []
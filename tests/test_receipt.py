@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+from receipt import otsu_threshold, preprocess_image, RECEIPT_WIDTH_INCHES
+
+
+@pytest.mark.parametrize("level", [0, 128, 255])
+def test_uniform_image_is_preprocessed(level):
+    pixels = np.full((40, 30), level, dtype=np.uint8)
+
+    assert otsu_threshold(pixels) <= level
+    img, _ = preprocess_image(Image.fromarray(pixels).convert("RGB"))
+    assert img.size == (30, 40)
+
+
+def test_scale_comes_from_the_cropped_receipt():
+    # A 1000 px wide receipt photographed on a dark table four times as wide
+    photo = Image.new("RGB", (4000, 3000), (40, 40, 40))
+    draw = ImageDraw.Draw(photo)
+    draw.rectangle((1500, 200, 2499, 2799), fill=(250, 250, 250))
+    for y in range(300, 2700, 60):
+        draw.text((1550, y), "ITEM 12.00   TOTAL 55.00", fill=(0, 0, 0))
+
+    img, timings = preprocess_image(photo, target_dpi=300)
+
+    assert list(timings)[:2] == ["orient", "crop"]
+    assert abs(img.width - round(300 * RECEIPT_WIDTH_INCHES)) <= 2
@@ -0,0 +1,127 @@
+from collections import defaultdict
+from datetime import datetime
+
+import pytest
+
+from db import db, Purchase, DailyRollup, MonthlyRollup, insert_purchases, delete_purchases, \
+    update_purchase, rebuild_rollups, verify_rollups
+from reports import summarize_purchases, PERIOD_FORMATS
+
+# Purchases on both sides of a day boundary and of a month boundary
+ROWS = [
+    (datetime(2024, 1, 30, 12, 0), 10, "meals"),
+    (datetime(2024, 1, 31, 23, 30), 27, "meals"),
+    (datetime(2024, 1, 31, 23, 45), 5, "travel"),
+    (datetime(2024, 2, 1, 0, 10), 12, "meals"),
+    (datetime(2024, 2, 1, 9, 0), 40, "travel"),
+    (datetime(2024, 2, 14, 18, 0), 8, "meals"),
+    (datetime(2024, 3, 1, 0, 0), 3, "groceries"),
+]
+NO_MISMATCHES = {"purchase_rollup_daily": 0, "purchase_rollup_monthly": 0}
+
+
+@pytest.fixture
+def seeded(app):
+    with app.app_context():
+        insert_purchases([{"user_id": 1, "amount": amount, "type": expense_type, "date": date}
+                          for date, amount, expense_type in ROWS])
+        db.session.commit()
+        yield
+        db.session.rollback()
+
+
+def purchase_ids():
+    return db.session.scalars(db.select(Purchase.id).order_by(Purchase.date)).all()
+
+
+def rollup(model, period, key):
+    return db.session.execute(
+        db.select(model.total, model.count).where(getattr(model, period) == key)
+        .where(model.type == "meals")).one_or_none()
+
+
+def test_inserts_are_rolled_up(seeded):
+    assert verify_rollups() == NO_MISMATCHES
+    assert rollup(MonthlyRollup, "month", "2024-01") == (37, 2)
+    assert rollup(DailyRollup, "day", datetime(2024, 2, 1).date()) == (12, 1)
+
+
+def test_deletes_leave_the_rollups_in_step(seeded):
+    ids = purchase_ids()
+
+    assert delete_purchases(1, [ids[1], ids[3]]) == 2
+    db.session.commit()
+
+    assert verify_rollups() == NO_MISMATCHES
+    assert rollup(MonthlyRollup, "month", "2024-01") == (10, 1)
+    # Emptied buckets are removed rather than left at zero
+    assert rollup(DailyRollup, "day", datetime(2024, 2, 1).date()) is None
+
+
+def test_moving_purchases_across_day_and_month_boundaries(seeded):
+    ids = purchase_ids()
+
+    assert update_purchase(1, ids[1], date=datetime(2024, 2, 1, 0, 5))
+    assert update_purchase(1, ids[3], date=datetime(2024, 1, 31, 23, 55), amount=15, type="travel")
+    assert not update_purchase(2, ids[0], amount=1)
+    db.session.commit()
+
+    assert verify_rollups() == NO_MISMATCHES
+    assert rollup(MonthlyRollup, "month", "2024-01") == (10, 1)
+    assert rollup(MonthlyRollup, "month", "2024-02") == (35, 2)
+
+
+def test_verify_finds_and_rebuild_repairs_drift(seeded):
+    db.session.execute(db.update(MonthlyRollup.__table__).values(total=MonthlyRollup.total + 1))
+    db.session.execute(db.delete(DailyRollup.__table__).where(DailyRollup.type == "groceries"))
+
+    mismatches = verify_rollups()
+    assert mismatches["purchase_rollup_monthly"] > 0
+    assert mismatches["purchase_rollup_daily"] == 1
+
+    rebuild_rollups()
+    assert verify_rollups() == NO_MISMATCHES
+
+
+def raw_summary(period, since, until, expense_type):
+    """
+    The summary computed in Python from ROWS
+    """
+    rows = [(date, amount, kind) for date, amount, kind in ROWS
+            if (since is None or date >= since) and (until is None or date < until)
+            and (expense_type is None or kind == expense_type)]
+    by_type, by_period = defaultdict(lambda: [0, 0]), defaultdict(lambda: [0, 0])
+    for date, amount, kind in rows:
+        for buckets, key in ((by_type, kind), (by_period, date.strftime(PERIOD_FORMATS[period]))):
+            buckets[key][0] += amount
+            buckets[key][1] += 1
+    return (sum(amount for _, amount, _ in rows), len(rows),
+            {key: tuple(value) for key, value in by_type.items()},
+            {key: tuple(value) for key, value in by_period.items()})
+
+
+@pytest.mark.parametrize("period, since, until, expense_type", [
+    # Whole months, read from the monthly rollups
+    ("month", datetime(2024, 1, 1), datetime(2024, 3, 1), None),
+    ("month", None, None, "meals"),
+    # Whole days, read from the daily rollups
+    ("day", datetime(2024, 1, 31), datetime(2024, 2, 2), None),
+    ("week", datetime(2024, 1, 15), None, None),
+    ("month", datetime(2024, 1, 31), datetime(2024, 2, 15), "travel"),
+    # Part days, read from the purchase rows
+    ("month", datetime(2024, 1, 31, 23, 40), datetime(2024, 2, 1, 1, 0), None),
+    ("day", datetime(2024, 1, 30, 12, 0), datetime(2024, 2, 14, 12, 0), "meals"),
+    # Nothing in range
+    ("month", datetime(2025, 1, 1), datetime(2025, 2, 1), None),
+    ("month", datetime(2025, 1, 1, 6, 0), datetime(2025, 2, 1), None),
+])
+def test_summary_matches_the_purchase_rows(seeded, period, since, until, expense_type):
+    summary = summarize_purchases(1, period=period, since=since, until=until, expense_type=expense_type)
+
+    total, count, by_type, by_period = raw_summary(period, since, until, expense_type)
+    assert (summary["total"], summary["count"]) == (total, count)
+    assert {row["type"]: (row["total"], row["count"]) for row in summary["by_type"]} == by_type
+    assert {row["period"]: (row["total"], row["count"]) for row in summary["by_period"]} == by_period
+    # Rollup and row totals are the same type whichever path the range takes
+    assert all(type(value) is float for value in
+               [summary["total"]] + [row["total"] for row in summary["by_type"] + summary["by_period"]])
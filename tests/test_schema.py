@@ -0,0 +1,80 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import event
+
+from app import create_app
+from db import db, User, Purchase, Budget, create_schema, verify_rollups
+
+# Tables as they were before the unique username index, the rollups and the later tables existed
+BASELINE_SCHEMA = [
+    "CREATE TABLE user (id INTEGER PRIMARY KEY AUTOINCREMENT, username VARCHAR NOT NULL, password VARCHAR NOT NULL)",
+    "CREATE TABLE purchase (id INTEGER PRIMARY KEY AUTOINCREMENT, amount INTEGER NOT NULL, date DATETIME NOT NULL,"
+    " type VARCHAR NOT NULL, user_id INTEGER REFERENCES user (id))",
+    "CREATE TABLE item (id INTEGER PRIMARY KEY AUTOINCREMENT, name VARCHAR NOT NULL)",
+    "CREATE TABLE association_purchases_items (purchase_id INTEGER REFERENCES purchase (id),"
+    " item_id INTEGER REFERENCES item (id))",
+]
+
+
+@pytest.fixture
+def baseline_app(tmp_path):
+    app = create_app({"TESTING": True, "SECRET_KEY": "test", "SQLALCHEMY_ECHO": False,
+                      "SQLALCHEMY_DATABASE_URI": "sqlite:///%s" % (tmp_path / "baseline.db")})
+    with app.app_context():
+        with db.engine.begin() as connection:
+            for statement in BASELINE_SCHEMA:
+                connection.exec_driver_sql(statement)
+            connection.exec_driver_sql(
+                "INSERT INTO user (username, password) VALUES ('ann', 'a'), ('bob', 'b'), ('ann', 'c'), ('ann', 'd')")
+            connection.exec_driver_sql(
+                "INSERT INTO purchase (amount, date, type, user_id) VALUES"
+                " (10, '2024-01-05 10:00:00.000000', 'meals', 1), (20, '2024-01-06 10:00:00.000000', 'meals', 3),"
+                " (30, '2024-02-01 10:00:00.000000', 'travel', 4), (7, '2024-01-07 10:00:00.000000', 'meals', 2)")
+        yield app
+        db.engine.dispose()
+
+
+def test_baseline_database_is_migrated_once(baseline_app):
+    with baseline_app.app_context():
+        create_schema()
+
+        assert [(user.id, user.username) for user in db.session.scalars(db.select(User).order_by(User.id))] == \
+            [(1, "ann"), (2, "bob")]
+        owners = db.session.execute(db.select(Purchase.amount, Purchase.user_id).order_by(Purchase.amount)).all()
+        assert owners == [(7, 2), (10, 1), (20, 1), (30, 1)]
+        indexes = {index["name"]: index["unique"] for index in db.inspect(db.engine).get_indexes("user")}
+        assert indexes["ix_user_username"]
+        assert verify_rollups() == {"purchase_rollup_daily": 0, "purchase_rollup_monthly": 0}
+        monthly = db.metadata.tables["purchase_rollup_monthly"]
+        assert db.session.scalar(db.select(db.func.count()).select_from(monthly)) == 3
+
+        statements = []
+        record = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            create_schema()
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+
+        # The second run only inspects the schema
+        writes = [statement for statement in statements
+                  if statement.split()[0].upper() in ("INSERT", "UPDATE", "DELETE", "CREATE", "DROP")]
+        assert writes == []
+        assert db.session.scalar(db.select(db.func.count(User.id))) == 2
+
+
+def test_kept_users_budget_wins_when_merging(baseline_app):
+    with baseline_app.app_context():
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql(
+                "CREATE TABLE budget (user_id INTEGER NOT NULL REFERENCES user (id), type VARCHAR NOT NULL,"
+                " monthly_limit FLOAT NOT NULL, PRIMARY KEY (user_id, type))")
+            connection.exec_driver_sql(
+                "INSERT INTO budget VALUES (1, 'meals', 100), (3, 'meals', 500), (4, 'travel', 200)")
+
+        create_schema()
+
+        budgets = db.session.execute(db.select(Budget.user_id, Budget.type, Budget.monthly_limit)
+                                     .order_by(Budget.type)).all()
+        assert budgets == [(1, "meals", 100), (1, "travel", 200)]
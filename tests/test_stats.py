@@ -0,0 +1,22 @@
+import pytest
+
+STATS_ROUTES = ["/metrics", "/api/ocr_cache/stats/", "/api/user_cache/stats/", "/api/analytics/stats/",
+                "/api/exchange/status/"]
+
+
+@pytest.mark.parametrize("route", STATS_ROUTES)
+def test_stats_need_a_login_without_a_token(app, client, route):
+    assert app.test_client().get(route).status_code == 401
+    assert client.get(route).status_code == 200
+
+
+@pytest.mark.parametrize("route", STATS_ROUTES)
+def test_stats_need_the_token_when_configured(app, client, route):
+    app.config["METRICS_TOKEN"] = "secret"
+    anonymous = app.test_client()
+
+    assert anonymous.get(route, headers={"Authorization": "Bearer secret"}).status_code == 200
+    assert anonymous.get(route, headers={"Authorization": "Bearer wrong"}).status_code == 401
+    assert anonymous.get(route).status_code == 401
+    # A user login does not stand in for the operator token
+    assert client.get(route).status_code == 401
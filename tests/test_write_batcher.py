@@ -0,0 +1,61 @@
+import threading
+import time
+from datetime import datetime
+
+import pytest
+
+import write_batcher
+from db import db, Purchase
+from write_batcher import PurchaseWriter, WriteTimeout
+
+
+@pytest.fixture
+def writer(app):
+    app.config.update(WRITE_BEHIND=True, WRITE_BATCH_TIMEOUT=0.1)
+    return PurchaseWriter(app)
+
+
+def rows(amount):
+    return [{"user_id": 1, "amount": amount, "type": "meals", "date": datetime.now()}]
+
+
+def amounts(app):
+    with app.app_context():
+        return sorted(db.session.scalars(db.select(Purchase.amount)))
+
+
+def test_concurrent_requests_are_all_written(app, writer):
+    def request(amount):
+        with app.app_context():
+            writer.write(rows(amount))
+
+    threads = [threading.Thread(target=request, args=(n,)) for n in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert amounts(app) == [0, 1, 2, 3, 4]
+    assert writer.rows == 5
+
+
+def test_rows_still_queued_at_timeout_are_withdrawn(app, writer, monkeypatch):
+    # No flusher is running, so the rows wait in the queue past the timeout
+    monkeypatch.setattr(writer, "start", lambda: None)
+    with app.app_context():
+        with pytest.raises(WriteTimeout):
+            writer.write(rows(1))
+
+    monkeypatch.undo()
+    with app.app_context():
+        writer.write(rows(2))
+    assert amounts(app) == [2]
+
+
+def test_rows_being_written_at_timeout_are_waited_for(app, writer, monkeypatch):
+    insert = write_batcher.insert_purchases
+    monkeypatch.setattr(write_batcher, "insert_purchases", lambda rows: time.sleep(0.3) or insert(rows))
+
+    with app.app_context():
+        writer.write(rows(1))
+    assert amounts(app) == [1]